@@ -9,7 +9,7 @@ import uncertainties as unc
 from uncertainties import unumpy as unp
 from numpy.matlib import repmat
 from collections import namedtuple, Iterable, OrderedDict
-from copy import deepcopy, copy
+from copy import copy
 from lmfit import Model
 import pickle as pkl
 import time
@@ -739,8 +739,29 @@ class StructureFactorModel(object):
         self.coords = np.asanyarray(coords)
         self.values = np.asanyarray(values)
         self.errors = np.asanyarray(errors)
+        self.absent = None
         return
 
+    def setAbsent(self, absent=None):
+        """
+        Flags the systematically absent reflections with a boolean mask over the coords (None to clear the flags).
+        """
+        self.absent = None if absent is None else np.asanyarray(absent, dtype=bool)
+        return
+
+    def compress(self):
+        """
+        Returns a copy of the model without the reflections flagged as absent.
+        """
+        keep = slice(None) if self.absent is None else np.logical_not(self.absent)
+        errors = self.errors[keep] if self.errors.ndim else self.errors
+        model = copy(self)
+        model.coords = self.coords[keep]
+        model.values = self.values[keep]
+        model.errors = errors
+        model.absent = None
+        return model
+
     def __getitem__(self, key):
         """
         TODO:
@@ -902,16 +923,17 @@ class StructureFactorModel(object):
         TODO:
         * For magnetic, add a column that normalizes intensity to the closest Bragg peak.
         """
-        QA = crystal.nuclear.rlu2ang(deepcopy(self.coords))
+        QA = crystal.nuclear.rlu2ang(self.coords)
+        dspacing = crystal.nuclear.lattice.dspacing(self.coords)
         headers = [r'Q (r.l.u.)', r'Q (\AA$^{-1}$)', r'd (\AA)', r'|F(Q)|$^2$']
         coords = []
         for coord in self.coords:
             coords.append('('+str(coord[0])+', '+str(coord[1])+', '+str(coord[2])+')')
         coords = np.array(coords)
         
-        dat = [coords, QA, 2.*np.pi / np.linalg.norm(QA,axis=-1), self.values]
+        dat = [coords, QA, dspacing, self.values]
         headers = ['Q (r.l.u.)', 'd (\AA)', '|F(Q)|$^{2}$']
-        dat = [coords, 2.*np.pi / np.linalg.norm(QA,axis=-1), self.values]        
+        dat = [coords, dspacing, self.values]        
         
         # Sort in order of descending peak intensity.
         idx = np.argsort(-dat[2])
@@ -996,16 +1018,17 @@ class StructureFactor(Data):
         TODO:
         * For magnetic, add a column that normalizes intensity to the closest Bragg peak.
         """
-        QA = crystal.nuclear.rlu2ang(deepcopy(self.coords))
+        QA = crystal.nuclear.rlu2ang(self.coords)
+        dspacing = crystal.nuclear.lattice.dspacing(self.coords)
         headers = [r'Q (r.l.u.)', r'Q (\AA$^{-1}$)', r'd (\AA)', r'|F(Q)|$^2$']
         coords = []
         for coord in self.coords:
             coords.append('('+str(coord[0])+', '+str(coord[1])+', '+str(coord[2])+')')
         coords = np.array(coords)
         
-        dat = [coords, QA, 2.*np.pi / np.linalg.norm(QA,axis=-1), self.values]
+        dat = [coords, QA, dspacing, self.values]
         headers = ['Q (r.l.u.)', 'd (\AA)', '|F(Q)|$^{2}$']
-        dat = [coords, 2.*np.pi / np.linalg.norm(QA,axis=-1), self.values]        
+        dat = [coords, dspacing, self.values]        
         
         # Sort in order of descending peak intensity.
         idx = np.argsort(-dat[2])
@@ -1,7 +1,6 @@
 import typing
-import string
 import numpy as np
-import periodictable as pt
+from collections import OrderedDict
 from lmfit import Minimizer
 import tempfile
 import platform
@@ -15,7 +14,19 @@ elif platform.system() in ['Windows']:
 
 tempfile.tempdir = '/var/tmp'
 
+# working from Eq. 59 in Chapter 1 of Chatterji
+GN = -3.82608545 # neutron g-factor from: http://physics.nist.gov/cgi-bin/cuu/Value?gnn|search_for=all!
+R0 = np.sqrt(0.07941124) # electron 'radius' in sqrt(barn)
+# The magnetic scattering length gamma r0/2 per Bohr magneton (sqrt(barn)), with gamma = gn/2
+MAGNETIC_LENGTH = GN/2*R0/2
+
 from .material import Atom, AtomGroup, NuclearStructure, Crystal
+from .reciprocal import getSitePermutations, getLaueOperations, LaueReduction, SatelliteTable, getCommensurability
+from .util.tables import getFormFactor, getLandeFactor
+from .util.functions import fingerprint
+from .util.kernels import getChunkSize, getPrecision, magneticStructureFactor, magneticInteractionVector, \
+    basisAmplitudes, intensityMatrices, quadraticFormIntensities
+from .util.stream import iterChunks, writeBlocks
 from .rep.rep import BasisVectorCollection, MagRepGroup
 from .data.data import MagneticStructureFactorModel
 
@@ -33,16 +44,18 @@ class MagAtom(Atom):
     * Eventually, it would be nice to have a lookup table for the gj.
     * Need better way of initializing that takes the positions as reference but can still edit other fields. Perhaps input line by line for each attribute needed?
     """
+    # MagAtoms share the row of their Atom in the AtomTable, but keep their own label.
+    label = None
+
     def __init__(self, basisvectorcollection=None, gj=2., mu=1., atom=None, elname=None, label=None, copy=False):
         """
         This requires a BasisVectorGroup be provided, but it may be a default instance.
         """
 
         if atom is not None:
-            # Copy over all fields of the atom
+            # Copy over all fields of the atom (the view of its row in the AtomTable)
             self.__dict__.update(atom.__dict__)
-            if not copy:
-                self.label = label
+            self.label = atom.label if copy else label
         else:
             # Create a new atom from input and copy it to the magatom
             Atom(elname, label=label)
@@ -51,6 +64,7 @@ class MagAtom(Atom):
         self.gj = gj
         self.mu  = mu
         self.moment = 0#np.array([0, 0, 0])
+        self.kmoments = None
         self.phi = 0
         self.t = None
         self.qms = []
@@ -71,53 +85,26 @@ class MagAtom(Atom):
         return self.get_form_factor(Qm, **kwargs)
 
     def get_form_factor(self, Qm, rlu=True, S=1 / 2, L=3,
-                        orbital=True, return_Q=False):
+                        orbital=True, return_Q=False, interpolate=None):
         """
+        The form factor of the ion is memoized on |Q| by util.tables.getFormFactor, so repeated calls with the same Qm
+        only cost a lookup. With interpolate='linear' or 'cubic', it is interpolated from a fine table of |Q| (see
+        util.tables.FormFactorTable for the error), e.g. for dense grids.
         TODO:
         <done> Qm is converted from rlu to ang within the routine.
         * Generalize to include the other options provided by periodictable
         """
-        J = np.abs(L-S)
+        Qm = np.atleast_2d(Qm)
         if rlu:
-            # Convert Q into the proper units
-            Qm = self.rlu2ang(Qm)
-
-        # Due to a bug in the code, we need to pass a 'charge key' that is not the charge for cerium
-        # Or it may be that 3+, and 4+ are only there for j2_Q and greater?
-        elname = self.element
-        elall = b"".maketrans(b"",b"")
-        pstr = string.ascii_letters
-        elnolet = elall.translate(elall, pstr.encode('utf-8'))
-        elname = elname.translate(elall, elnolet)
-        charge = self.oxidation
-        # assert here
-        if charge is None:
-            pass
-        else:
-            try:
-                charge = int(charge)
-            except ValueError:
-                charge = 3 if elname.decode() == 'Ce' else charge
-                charge = 3 if elname.decode() == 'Mn' else charge
-        charge_key = 2 if elname.decode() == 'Ce' else charge
-
-        # Get the element from the periodic table
-        element = pt.elements.isotope(elname.decode())
-
-        gL = 1./2. + (L*(L+1)-S*(S+1))/(2*J*(J+1))
-        gS = 1. + (S*(S+1)-L*(L+1))/(J*(J+1))
-        gJ = gL + gS # Lande splitting factor
-
-        # Return the form factor
-        Q = np.sqrt(np.sum(np.square(Qm),axis=1))
-        j0 = element.ion[charge].magnetic_ff[charge_key].j0_Q(Q)
-        j2 = element.ion[charge].magnetic_ff[charge_key].j2_Q(Q)
-        if orbital:
-            fQ = (gS*j0 + gL*j0 + gL*j2)/gJ #Lovesey, Eq. 7.26 for full J
+            # |Q| in the proper units from the lattice service
+            Q = self.nuclear.lattice.norm(Qm)
         else:
-            fQ = j0 + j2*(gJ-2)/gJ #Lovesey, Eq. 7.23 for S with quenched L
+            Q = np.linalg.norm(Qm, axis=1)
+
+        # The element, charge (and the charge key quirks of Ce and Mn) are resolved once in the ion table
+        fQ = getFormFactor(self.element, Q, charge=self.oxidation, S=S, L=L, orbital=orbital, interpolate=interpolate)
         if return_Q:
-            return Q, fQ, gJ
+            return Q, fQ, getLandeFactor(S=S, L=L)[2]
         else:
             return np.repeat(fQ.reshape((len(Qm),1)), 3, axis=1)
 
@@ -177,6 +164,23 @@ class MagAtom(Atom):
         else:
             return self.moment
 
+    def setFourierComponents(self, m=None):
+        """
+        Sets the Fourier components (K,3) of the moment for the K propagation vectors of the MagneticStructure (in the
+        order of its qms), e.g. for multi-k structures. With None, self.moment is used for every propagation vector.
+        """
+        self.kmoments = None if m is None else np.asanyarray(m, dtype=np.complex128).reshape((-1,3))
+        return
+
+    def getFourierComponent(self, n=0, sign=1):
+        """
+        Returns the Fourier component (3,) of the moment for the propagation vector k_n, or its complex conjugate for
+        -k_n (sign=-1).
+        """
+        m = self.moment if self.kmoments is None else self.kmoments[n]
+        m = np.broadcast_to(np.asanyarray(m), (1,3)).reshape(3).astype(np.complex128)
+        return np.conj(m) if sign < 0 else m
+
     def setMomentFromIR(self, m, phi=0):
         raise NotImplementedError
 
@@ -244,6 +248,35 @@ class MagAtomGroup(AtomGroup):
         return
 
 
+class MagneticDomains(object):
+    """
+    The magnetic domains of a MagneticStructure: the configurations generated from the reference one by the point group
+    operations which do not leave it invariant (including those mapping k onto the other arms of its star). Domain n is
+    the image of the reference under the rotation R_n (acting on fractional coordinates), so that its intensity is
+    I_n(Q) = I_0(Q R_n). The populations are the weights of the domains in the averaged intensity.
+    """
+    def __init__(self, R, populations=None):
+        """"""
+        self.R = np.asanyarray(R, dtype=float).reshape((-1,3,3))
+        self.setPopulations(populations)
+        return
+
+    def __len__(self):
+        return len(self.R)
+
+    def setPopulations(self, populations=None):
+        """
+        Sets the populations (Ndomains,) of the domains, equal populations summing to one by default.
+        """
+        if populations is None:
+            populations = np.repeat(1./len(self.R), len(self.R))
+        populations = np.asanyarray(populations, dtype=float).reshape(-1)
+        if len(populations) != len(self.R):
+            raise ValueError('Give one population for each of the ' + str(len(self.R)) + ' domains.')
+        self.populations = populations
+        return
+
+
 class MagneticStructure(NuclearStructure):
     """"""
     familyname = 'magnetic'
@@ -327,139 +360,569 @@ class MagneticStructure(NuclearStructure):
 
         return
 
-    def setMagneticStructureFactor(self, Q=None, units=None):
+    def setMagneticStructureFactor(self, Q=None, units=None, precision='double'):
         """
+        Sets the MagneticStructureFactorModel self.Fm on Q, or on the satellites self.Q + k of each propagation vector in
+        self.qms with Q=None.
         TODO:
         * Combine with getStructureFactor
         *! This and similar operations should probably happen at the level of Crystal!!!
         """
 
+        self._fmtable = None
         if Q is None:
-            try:
-                coords = self.nuclear.Fn.coords
-            except:
-                # make the coordinates
-                coords = []
-                for qm in self.qms:
-                    coords.append(self.Q+qm)
-                coords = np.vstack(coords).reshape(len(self.qms)*len(self.Q),3)
-                sidx = np.argsort(np.linalg.norm(self.rlu2ang(coords), axis=1))
-                coords = coords[sidx,:]
+            # the satellites of self.Q at each qm, sorted by |Q| once (see getSatelliteTable)
+            self._fmtable = self.getSatelliteTable(pairs=False)
+            coords = self._fmtable.Q
         else:
             coords = np.asanyarray(Q)
             print('Using input Q array for magnetic structure factor model.')
 
         # Construct the MagneticStructureFactorModel with
-        self.Fm = MagneticStructureFactorModel(coords, np.zeros(coords.shape, dtype=np.complex128), units=units)
+        self.Fm = MagneticStructureFactorModel(coords, np.zeros(coords.shape, dtype=getPrecision(precision)[1]), units=units)
 
         return
 
+    def getMagneticArrays(self, k=None, sign=1):
+        """
+        Returns the fractional coordinates (Nmag,3) and moments (Nmag,3) of all magnetic atoms stacked into arrays.
+        With k, the Fourier components of the moments for the propagation vector self.qms[k] (or -k for sign=-1) are
+        returned instead (see MagAtom.getFourierComponent).
+        """
+        magatoms = list(self.magatoms.values())
+        d = np.array([magatom.d for magatom in magatoms], dtype=float).reshape((-1,3))
+        if k is None:
+            m = np.array([np.broadcast_to(np.asanyarray(magatom.moment), (1,3)).reshape(3) for magatom in magatoms],
+                         dtype=np.complex128).reshape((-1,3))
+        else:
+            m = np.array([magatom.getFourierComponent(k, sign=sign) for magatom in magatoms],
+                         dtype=np.complex128).reshape((-1,3))
+        return d, m
+
+    def getSatelliteTable(self, hkl=None, pairs=True):
+        """
+        Returns the reciprocal.SatelliteTable of the parent reflections hkl (self.Q by default) and the propagation
+        vectors self.qms, sorted by |Q|. The table of the last hkl, qms and pairs is kept, so the satellites are only
+        built and sorted once.
+        """
+        hkl = self.Q if hkl is None else hkl
+        key = (fingerprint(hkl), fingerprint(np.asanyarray(self.qms, dtype=float)), pairs)
+        cached = getattr(self, '_satellites', None)
+        if cached is None or cached[0] != key:
+            cached = self._satellites = (key, SatelliteTable(hkl, self.qms, pairs=pairs, lattice=self.lattice))
+        return cached[1]
+
+    def getMagneticSymmetryOperations(self, tol=1e-4):
+        """
+        Returns the indices of the space group operations which leave the magnetic configuration invariant, i.e. map
+        each magnetic atom onto another with its moment transformed as an axial vector (up to a common phase), and
+        whether Friedel's law holds (moments real up to a common phase).
+        """
+        R, t = self.nuclear.getSymmetryOperations()
+        # The moments are Cartesian, so they are rotated by Rc = A R A^-1 rather than R
+        Rc = self.nuclear.getCartesianRotations(R)
+        d, m = self.getMagneticArrays()
+        perm, L = getSitePermutations(d, R, t, labels=[magatom.element for magatom in self.magatoms.values()])
+        ok = np.all(perm >= 0, axis=1)
+        mmax = np.abs(m).max() if m.size else 0.
+        for k in np.where(ok)[0]:
+            mr = np.linalg.det(R[k]) * np.dot(m, Rc[k].T)
+            target = m[perm[k]]
+            i = np.unravel_index(np.argmax(np.abs(target)), target.shape)
+            alpha = target[i] / mr[i] if np.abs(mr[i]) > tol*mmax else 0.
+            ok[k] = np.isclose(np.abs(alpha), 1.) and np.allclose(target, alpha*mr, atol=tol*mmax)
+        phase = np.exp(-1j*np.angle(m.reshape(-1)[np.argmax(np.abs(m))])) if m.size else 1.
+        friedel = np.allclose(np.imag(m*phase), 0., atol=tol*mmax)
+        return np.where(ok)[0], friedel, L
+
+    def getLaueReduction(self, Q, friedel=True):
+        """
+        Returns the LaueReduction of Q (r.l.u.) under the operations which leave the magnetic configuration invariant.
+        This is only valid for the squared structure factor. The reduction of the last Q and set of operations is kept.
+        """
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        ops, mfriedel, L = self.getMagneticSymmetryOperations()
+        friedel = friedel and mfriedel
+        key = (tuple(ops), friedel)
+        cached = getattr(self, '_laue', None)
+        if cached is not None and cached[1] == key and cached[0].shape == Q.shape and np.array_equal(cached[0], Q):
+            return cached[2]
+
+        R, t = self.nuclear.getSymmetryOperations()
+        reduction = LaueReduction(Q, *getLaueOperations(R[ops], t[ops], L[ops], friedel=friedel))
+        self._laue = (Q.copy(), key, reduction)
+        return reduction
+
+    def getFormFactors(self, Qm, **kwargs):
+        """
+        Returns the (N, Nspecies) table of magnetic form factors at Qm (r.l.u.) and the species (Nmag,) giving the
+        column of each magnetic atom. Atoms of the same element and charge share a column, so each form factor is only
+        evaluated once. kwargs are passed to MagAtom.get_form_factor.
+        """
+        magatoms = list(self.magatoms.values())
+        ions = OrderedDict()
+        for magatom in magatoms:
+            ions.setdefault((magatom.element, magatom.oxidation), magatom)
+        keys = list(ions.keys())
+        species = np.array([keys.index((magatom.element, magatom.oxidation)) for magatom in magatoms], dtype=int)
+        f = np.empty((len(np.atleast_2d(Qm)), len(ions)))
+        for s, magatom in enumerate(ions.values()):
+            f[:, s] = magatom.get_form_factor(Qm, return_Q=True, **kwargs)[1]
+        return f, species
+
+    def getScatteringArrays(self, Qm, k=None, sign=1, **kwargs):
+        """
+        Returns the fractional coordinates (Nmag,3) and the moments times the magnetic scattering length gamma r0/2
+        (Nmag,3) of all magnetic atoms (see getMagneticArrays), and the form factor table and species at Qm (see
+        getFormFactors), so that F_M(Qm) is in sqrt(barn).
+        """
+        d, m = self.getMagneticArrays(k=k, sign=sign)
+        f, species = self.getFormFactors(Qm, **kwargs)
+        return d, MAGNETIC_LENGTH*m, f, species
+
+    def getAtomColumns(self, tol=1e-6):
+        """
+        Returns the rows (Nmag,) of the magnetic atoms in the AtomTable of the nuclear structure, so that the magnetic
+        sites are a subset of the columns of the nuclear phase matrix. MagAtoms share the row of their Atom; others are
+        matched by their fractional coordinates.
+        """
+        table = self.nuclear.table
+        columns = []
+        for magatom in self.magatoms.values():
+            if getattr(magatom, '_table', None) is table:
+                columns.append(magatom._index)
+                continue
+            found = np.where(np.all(np.abs(table.d - np.asanyarray(magatom.d, dtype=float).reshape(3)) < tol, axis=1))[0]
+            if len(found) == 0:
+                raise ValueError('The magnetic atom ' + str(magatom.label) + ' is not on a site of the nuclear structure.')
+            columns.append(found[0])
+        return np.array(columns, dtype=int)
+
+    def getSharedPhases(self, Qm, precision='double', workers=None):
+        """
+        Returns the phase matrix of all atoms at Qm kept by the Crystal (see Crystal.getPhaseMatrix) and the columns of
+        the magnetic atoms in it (see getAtomColumns), or (None, None) without a Crystal, while its phase caching is off
+        or if the magnetic atoms are not on the sites of its nuclear structure. The kernels then evaluate the phases of
+        the magnetic atoms only.
+        """
+        crystal = getattr(self, 'crystal', None)
+        if not isinstance(crystal, Crystal) or crystal.nuclear is not self.nuclear or not crystal.phasecaching:
+            return None, None
+        try:
+            columns = self.getAtomColumns()
+        except ValueError:
+            return None, None
+        phases = crystal.getPhaseMatrix(Qm, precision=precision, workers=workers)
+        return (None, None) if phases is None else (phases, columns)
+
+    def calcMagneticStructureFactor(self, Qm, precision='double', workers=None, perpendicular=True, k=None, sign=1,
+                                    cache=True, **kwargs):
+        """
+        Returns the projection of the magnetic structure factor onto the plane perpendicular to Qm (r.l.u.) as a
+        complex (N,3) array (the full F_M with perpendicular=False). All magnetic atoms are summed at once by
+        util.kernels.magneticStructureFactor.
+        With k (and sign), the Fourier components of the moments for that propagation vector are used (see
+        getMagneticArrays), e.g. for the satellites of a multi-k structure.
+        With precision='single' it is computed in complex64 (see util.kernels for the accuracy).
+        With workers > 1 (0 for all cores), the chunks of Qm are evaluated by a pool of threads.
+        The form factors are computed by getFormFactors with kwargs, e.g. interpolate='cubic' for dense grids.
+        With cache=False, the phase matrices kept by the Crystal (see getSharedPhases) are not used.
+        """
+        Qm = np.atleast_2d(Qm)
+        # Stack the moments and form factors of all magnetic ions; only the magnetic ions contribute.
+        d, m, f, species = self.getScatteringArrays(Qm, k=k, sign=sign, **kwargs)
+        phases, columns = self.getSharedPhases(Qm, precision=precision, workers=workers) if cache else (None, None)
+        Fm = magneticStructureFactor(Qm, d, m, f=f, species=species, precision=precision, workers=workers,
+                                     phases=phases, columns=columns)
+        # see pg. 291 of Lovesey vol. 2 for the spin density calculation
+        if not perpendicular:
+            return Fm
+
+        # Calculate the projection of the magnetic structure factor onto the plane perpendicular to the (cached) unit
+        # vectors along the magnetic peaks.
+        return magneticInteractionVector(Fm, self.lattice.unit(Qm))
+
+    def calcMagneticIntensity(self, Qm, symmetrize=False, chiral=False, **kwargs):
+        """
+        Returns the squared magnetic structure factor |M_perp|^2 at Qm (r.l.u.), computed straight from F_M by
+        util.kernels.magneticInteractionVector.
+        With chiral=True, the chiral term i (M_perp x M_perp^*) (N,3) is returned as well.
+        With symmetrize=True, it is only evaluated for the reflections unique under the magnetic symmetry operations
+        and then scattered back onto the full set of Qm.
+        """
+        if symmetrize:
+            if chiral:
+                raise ValueError('The chiral term is not invariant under the symmetry operations; use symmetrize=False.')
+            reduction = self.getLaueReduction(Qm)
+            return reduction.expand(self.calcMagneticIntensity(reduction.unique, **kwargs), squared=True)
+        Fm = self.calcMagneticStructureFactor(Qm, perpendicular=False, **kwargs)
+        return magneticInteractionVector(Fm, self.lattice.unit(Qm), vector=False, intensity=True, chiral=chiral)
+
+    def getDomains(self, tol=1e-6):
+        """
+        Returns the MagneticDomains of the current configuration: one rotation of the space group for each coset of the
+        rotations H which leave the moment configuration invariant (see getConfigurationStabilizer), so that domains
+        with the same configuration up to a lattice translation are merged. The domains are kept, with their
+        populations, until the configuration changes.
+        """
+        d, m = self.getMagneticArrays()
+        key = (fingerprint(d), fingerprint(m), fingerprint(np.asanyarray(self.qms, dtype=float)))
+        cached = getattr(self, '_domains', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        R, t = self.nuclear.getSymmetryOperations()
+        H = R[self.getConfigurationStabilizer()]
+        domains = []
+        for Rk in R:
+            # R_m = R_n R_h gives the same configuration, and so I_0(Q R_m) = I_0(Q R_n) for all Q
+            if not any(np.any(np.all(np.abs(np.dot(np.linalg.inv(Rn), Rk) - H) < tol, axis=(1,2))) for Rn in domains):
+                domains.append(Rk)
+        populations = None
+        if cached is not None and len(cached[1]) == len(domains) and np.allclose(cached[1].R, domains):
+            populations = cached[1].populations
+        self._domains = (key, MagneticDomains(domains, populations=populations))
+        return self._domains[1]
+
+    def getConfigurationStabilizer(self, tol=1e-4):
+        """
+        Returns the indices of the space group operations (R, t) which map the moment configuration onto itself up to a
+        lattice translation. With R d_j + t = d_p(j) + L_j, the moment at d_j + l, m_j exp(-2 pi i k.l), is carried to
+        d_p(j) + L_j + R l as the axial vector det(R) Rc m_j (Rc the Cartesian rotation), so the operation must keep
+        each k (or send it to -k, which conjugates the Fourier components) and
+            det(R) Rc m_j = c m_p(j) exp(-2 pi i k.L_j)
+        with c = exp(2 pi i k.l) the phase of a lattice translation l. All the lattice shifts L_j enter the phases.
+        """
+        R, t = self.nuclear.getSymmetryOperations()
+        Rc = self.nuclear.getCartesianRotations(R)
+        d, m = self.getMagneticArrays()
+        perm, L = getSitePermutations(d, R, t, labels=[magatom.element for magatom in self.magatoms.values()])
+        ks = np.asanyarray(self.qms, dtype=float).reshape((-1,3))
+        ks = np.zeros((1,3)) if len(ks) == 0 else ks
+        ok = np.all(perm >= 0, axis=1)
+        mmax = np.abs(m).max() if m.size else 0.
+        if mmax == 0.:
+            return np.where(ok)[0]
+
+        def isTranslation(mr, target, D):
+            # mr = c target with c = exp(2 pi i k.l), i.e. c^D = 1 (any |c| = 1 for an incommensurate k)
+            i = np.unravel_index(np.argmax(np.abs(target)), target.shape)
+            c = mr[i] / target[i]
+            return np.isclose(np.abs(c), 1., atol=tol) and np.allclose(mr, c*target, atol=tol*mmax) \
+                and (D == 0 or np.isclose(c**D, 1., atol=D*tol))
+
+        for g in np.where(ok)[0]:
+            mr = np.linalg.det(R[g]) * np.dot(m, Rc[g].T)
+            for k in ks:
+                D = getCommensurability(k)
+                kr = np.dot(k, R[g])
+                phase = np.exp(2j*np.pi*np.dot(L[g], k))[:, None]
+                kept = np.allclose(kr - k, np.round(kr - k), atol=tol) and isTranslation(mr, m[perm[g]]/phase, D)
+                flipped = np.allclose(kr + k, np.round(kr + k), atol=tol) and \
+                    isTranslation(mr, np.conj(m[perm[g]])*phase, D)
+                if not (kept or flipped):
+                    ok[g] = False
+                    break
+        return np.where(ok)[0]
+
+    def getDomainMask(self, Qm, domains=None, tol=1e-6):
+        """
+        Returns the (Ndomains, N) mask of the domains contributing at Qm (r.l.u.): those for which Qm R_n is a satellite
+        +-k of the reference domain for one of self.qms, i.e. Qm lies on the satellites of the corresponding arm of
+        the star of k.
+        """
+        domains = self.getDomains() if domains is None else domains
+        Qr = np.einsum('ni,dij->dnj', np.atleast_2d(np.asanyarray(Qm, dtype=float)), domains.R)
+        mask = np.zeros(Qr.shape[:2], dtype=bool)
+        for k in np.asanyarray(self.qms, dtype=float).reshape((-1,3)):
+            for x in (Qr - k, Qr + k):
+                mask |= np.all(np.abs(x - np.round(x)) < tol, axis=2)
+        return mask
+
+    def calcDomainIntensities(self, Qm, mask=True, **kwargs):
+        """
+        Returns the intensities I_n(Qm) = I_0(Qm R_n) (Ndomains, N) of all domains (see getDomains). The rotated Q of
+        all domains are stacked and deduplicated, and evaluated by a single call of calcMagneticIntensity (kwargs).
+        With mask=True, a domain only contributes at the satellites of its arm of the star of k (see getDomainMask);
+        use mask=False for Q off the reciprocal lattice.
+        The stack of the last Qm and configuration is kept, so that refining the populations costs nothing more.
+        """
+        Qm = np.atleast_2d(np.asanyarray(Qm, dtype=float))
+        domains = self.getDomains()
+        d, m = self.getMagneticArrays()
+        key = (fingerprint(Qm), fingerprint(d), fingerprint(m), fingerprint(domains.R), mask,
+               tuple(sorted((name, repr(value)) for name, value in kwargs.items())))
+        cached = getattr(self, '_domainstack', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        Qr = np.einsum('ni,dij->dnj', Qm, domains.R).reshape((-1,3))
+        valid = self.getDomainMask(Qm, domains=domains).reshape(-1) if mask else np.ones(len(Qr), dtype=bool)
+        I = np.zeros(len(Qr))
+        if valid.any():
+            unique, index, inverse = np.unique(np.round(Qr[valid], 6), axis=0, return_index=True, return_inverse=True)
+            I[valid] = self.calcMagneticIntensity(Qr[valid][index], **kwargs)[inverse.reshape(-1)]
+        I = I.reshape((len(domains), len(Qm)))
+        I.flags.writeable = False
+        self._domainstack = (key, I)
+        return I
+
+    def calcDomainIntensity(self, Qm, populations=None, **kwargs):
+        """
+        Returns the domain averaged |M_perp|^2 at Qm (r.l.u.), sum_n p_n I_n(Qm), with the populations p_n of
+        getDomains() unless given. kwargs are passed to calcDomainIntensities.
+        """
+        I = self.calcDomainIntensities(Qm, **kwargs)
+        populations = self.getDomains().populations if populations is None else np.asanyarray(populations, float)
+        return np.dot(populations, I)
+
+    def calcSatelliteStructureFactor(self, table=None, perpendicular=True, precision='double', workers=None, cache=True,
+                                     **kwargs):
+        """
+        Returns the magnetic structure factor (N,3) at the rows of a reciprocal.SatelliteTable (getSatelliteTable() by
+        default), with the Fourier components of the propagation vector of each row. The Fourier components of all
+        satellite groups are stacked, so all rows are evaluated by one call of util.kernels.magneticStructureFactor.
+        kwargs are passed to getFormFactors; see calcMagneticStructureFactor for the rest.
+        """
+        table = self.getSatelliteTable() if table is None else table
+        d, m, f, species = self.getScatteringArrays(table.Q, **kwargs)
+        m = MAGNETIC_LENGTH*np.array([self.getMagneticArrays(k=n, sign=sign)[1] for n, sign, rows in table.groups])
+        phases, columns = self.getSharedPhases(table.Q, precision=precision, workers=workers) if cache else (None, None)
+        Fm = magneticStructureFactor(table.Q, d, m, f=f, species=species, precision=precision, workers=workers,
+                                     phases=phases, columns=columns, groups=table.group)
+        if not perpendicular:
+            return Fm
+        return magneticInteractionVector(Fm, self.lattice.unit(table.Q))
+
+    def calcSatelliteIntensity(self, table=None, chiral=False, **kwargs):
+        """
+        Returns |M_perp|^2 (and with chiral=True the chiral term) at the rows of a reciprocal.SatelliteTable
+        (getSatelliteTable() by default); see calcSatelliteStructureFactor.
+        """
+        table = self.getSatelliteTable() if table is None else table
+        Fm = self.calcSatelliteStructureFactor(table, perpendicular=False, **kwargs)
+        return magneticInteractionVector(Fm, self.lattice.unit(table.Q), vector=False, intensity=True, chiral=chiral)
+
+    def getBasisVectorGroups(self, Nrep=None):
+        """
+        Returns the BasisVectorGroups of the MagRepGroup of the Crystal and their coefficients (see
+        MagRepGroup.getBasisVectorGroups).
+        """
+        return self.crystal.magrepgroup.getBasisVectorGroups(Nrep=Nrep)
+
+    def getBasisVectorArrays(self, Nrep=None):
+        """
+        Returns the basis vectors psi_v (Nbv,3) of getBasisVectorGroups on the magnetic atoms, the magnetic atom (Nbv,)
+        and the group (Nbv,) of each, and the names of the groups. The basis vectors of a group on the same atom are
+        summed, as in BasisVectorGroup.getMagneticMoment.
+        """
+        groups = self.getBasisVectorGroups(Nrep=Nrep)
+        d = self.getMagneticArrays()[0]
+        psi = np.zeros((len(groups), len(d), 3), dtype=np.complex128)
+        for g, (bvg, coeff) in enumerate(groups.values()):
+            for bv in bvg.values():
+                found = np.isclose(d, np.asanyarray(bv.d, dtype=float).reshape(3)).all(axis=1)
+                psi[g, found] += np.asanyarray(bv).reshape(3)
+        members, atoms = np.nonzero(psi.any(axis=2))
+        return psi[members, atoms], atoms, members, list(groups.keys())
+
+    def getBasisWeights(self, coeffs=None, mu=None, Nrep=None):
+        """
+        Returns the weights w_v = c_g(v) mu_j(v) (Nbv,) of the basis vectors of getBasisVectorArrays, for the group
+        coefficients c_g (by default those of getBasisVectorGroups; an array in the order of the groups or a mapping
+        of their names, e.g. the values of the refinement parameters) and the moment sizes mu_j (by default the mu of
+        the MagAtoms; an array or a mapping with the keys 'mu1', 'mu2', ...).
+        """
+        groups = self.getBasisVectorGroups(Nrep=Nrep)
+        c = np.array([coeff for bvg, coeff in groups.values()], dtype=np.complex128)
+        if hasattr(coeffs, 'keys'):
+            c = np.array([coeffs.get(name, cg) for name, cg in zip(groups.keys(), c)], dtype=np.complex128)
+        elif coeffs is not None:
+            c = np.asanyarray(coeffs, dtype=np.complex128).reshape(-1)
+        sizes = np.array([magatom.mu for magatom in self.magatoms.values()], dtype=float)
+        if hasattr(mu, 'keys'):
+            sizes = np.array([mu.get('mu'+str(j+1), mj) for j, mj in enumerate(sizes)], dtype=float)
+        elif mu is not None:
+            sizes = np.broadcast_to(np.asanyarray(mu, dtype=float), sizes.shape)
+        psi, atoms, members, names = self.getBasisVectorArrays(Nrep=Nrep)
+        return c[members] * sizes[atoms]
+
+    def getBasisAmplitudes(self, Qm, Nrep=None, precision='double', workers=None, **kwargs):
+        """
+        Returns the magnetic structure factor amplitudes A_v(Qm) (N, Nbv, 3) of the basis vectors of
+        getBasisVectorArrays, in sqrt(barn) and not yet projected perpendicular to Qm (see
+        util.kernels.basisAmplitudes). The amplitudes of the last Qm are kept until Qm, the positions, the basis vectors
+        or the form factors change, so that during a refinement of the coefficients and moment sizes the Fourier sum is
+        done once and every evaluation is a product of size N Nbv (see calcBasisStructureFactor).
+        kwargs are passed to getScatteringArrays.
+        """
+        Qm = np.atleast_2d(np.asanyarray(Qm, dtype=float))
+        d = self.getMagneticArrays()[0]
+        psi, atoms, members, names = self.getBasisVectorArrays(Nrep=Nrep)
+        ions = tuple((magatom.element, magatom.oxidation) for magatom in self.magatoms.values())
+        key = (fingerprint(Qm), fingerprint(d), fingerprint(psi), ions, repr(sorted(kwargs.items())), precision)
+        cached = getattr(self, '_basisamplitudes', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        d, m, f, species = self.getScatteringArrays(Qm, **kwargs)
+        phases, columns = self.getSharedPhases(Qm, precision=precision, workers=workers)
+        A = basisAmplitudes(Qm, d, psi*MAGNETIC_LENGTH, atoms, f=f, species=species, precision=precision,
+                            workers=workers, phases=phases, columns=columns)
+        A.flags.writeable = False
+        self._basisamplitudes = (key, A)
+        return A
+
+    def calcBasisStructureFactor(self, Qm, coeffs=None, mu=None, perpendicular=True, Nrep=None, **kwargs):
+        """
+        Returns the magnetic structure factor (N,3) at Qm (r.l.u.) of the moments m_j = mu_j sum_g c_g psi_g(j) from the
+        kept basis vector amplitudes, F_M = sum_v w_v A_v (see getBasisAmplitudes and getBasisWeights).
+        This is the linear model of the coefficients: unlike MagAtom.addMoment, the moments are not normalized to the
+        size mu_j, so the coefficients set both the direction and (with mu_j) the size of each moment.
+        kwargs are passed to getBasisAmplitudes.
+        """
+        Qm = np.atleast_2d(np.asanyarray(Qm, dtype=float))
+        A = self.getBasisAmplitudes(Qm, Nrep=Nrep, **kwargs)
+        w = self.getBasisWeights(coeffs=coeffs, mu=mu, Nrep=Nrep).astype(A.dtype)
+        Fm = np.matmul(w, A)
+        if not perpendicular:
+            return Fm
+        return magneticInteractionVector(Fm, self.lattice.unit(Qm))
+
+    def calcBasisIntensity(self, Qm, coeffs=None, mu=None, chiral=False, Nrep=None, **kwargs):
+        """
+        Returns |M_perp|^2 (and with chiral=True the chiral term) at Qm (r.l.u.) of the linear model of
+        calcBasisStructureFactor.
+        """
+        Fm = self.calcBasisStructureFactor(Qm, coeffs=coeffs, mu=mu, perpendicular=False, Nrep=Nrep, **kwargs)
+        return magneticInteractionVector(Fm, self.lattice.unit(Qm), vector=False, intensity=True, chiral=chiral)
+
+    def getIntensityFactors(self, Qm, mu=None, Nrep=None, **kwargs):
+        """
+        Returns the perpendicular amplitudes P_g(Qm) (N, G, 3) of the coefficients c_g of getBasisVectorGroups, with the
+        moment sizes mu (see getBasisWeights) folded in, so that M_perp = sum_g c_g P_g in the linear model of
+        calcBasisStructureFactor. kwargs are passed to getBasisAmplitudes.
+        """
+        Qm = np.atleast_2d(np.asanyarray(Qm, dtype=float))
+        A = self.getBasisAmplitudes(Qm, Nrep=Nrep, **kwargs)
+        psi, atoms, members, names = self.getBasisVectorArrays(Nrep=Nrep)
+        # The moment size of each basis vector in the column of its group
+        S = np.zeros((len(psi), len(names)), dtype=A.dtype)
+        S[np.arange(len(psi)), members] = self.getBasisWeights(coeffs=np.ones(len(names)), mu=mu, Nrep=Nrep)
+        B = np.matmul(A.transpose((0, 2, 1)), S).transpose((0, 2, 1))
+        Qh = np.repeat(self.lattice.unit(Qm), len(names), axis=0)
+        return magneticInteractionVector(B.reshape((-1, 3)), Qh).reshape(B.shape)
+
+    def getIntensityMatrices(self, Qm, mu=None, Nrep=None, **kwargs):
+        """
+        Returns the Hermitian matrices H(Qm) (N, G, G) for which |M_perp|^2 = c^H H c in the coefficients c (G,) of
+        getBasisVectorGroups (see getIntensityFactors and util.kernels.intensityMatrices).
+        """
+        return intensityMatrices(self.getIntensityFactors(Qm, mu=mu, Nrep=Nrep, **kwargs))
+
+    def calcCandidateIntensities(self, Qm, coeffs, mu=None, Nrep=None, chunk=None, workers=None, **kwargs):
+        """
+        Returns the intensities |M_perp|^2 = c^H H(Qm) c (K, N) at Qm (r.l.u.) of a batch of K candidate coefficient
+        vectors coeffs (K, G), in the order of getBasisVectorGroups, for scans over the coefficients and moment
+        directions. The amplitudes are computed once (see getIntensityFactors) and each chunk of candidates is a single
+        matrix product (see util.kernels.quadraticFormIntensities). As in calcBasisStructureFactor the moments are
+        not normalized, so candidates of different norm give intensities in proportion to |c|^2.
+        kwargs are passed to getBasisAmplitudes.
+        """
+        P = self.getIntensityFactors(Qm, mu=mu, Nrep=Nrep, workers=workers, **kwargs)
+        return quadraticFormIntensities(P, coeffs, chunk=chunk, workers=workers)
+
     def getMagneticStructureFactor(self, gjs=None, useDebyeWaller=False, squared=True, returned=False, scale_factor=1.,
-                                   Qm=None, update=True, S=1/2, L=3, plane='hhl', from_IR=True, **kwargs):
+                                   Qm=None, update=True, S=1/2, L=3, plane='hhl', from_IR=True, symmetrize=False,
+                                   linear=False, domains=False, **kwargs):
         """
         gj is the Lande g-factor
+        With symmetrize=True the squared structure factor is only evaluated for the symmetry-unique reflections.
+        With linear=True it is computed from the kept basis vector amplitudes (see calcBasisStructureFactor).
+        With domains=True the squared structure factor is averaged over the domains weighted by their populations (see
+        calcDomainIntensity), e.g. when the populations are refined.
+        With Qm=None it is evaluated on the satellites self.Q + k of every propagation vector in self.qms (see
+        setMagneticStructureFactor and getSatelliteTable), each with the Fourier components of its k (see
+        calcSatelliteStructureFactor); with symmetrize, linear or domains, the moments are used for all of them.
+        With precision='single' (in kwargs) the calculation runs in float32/complex64 (see util.kernels).
+        With workers=n (in kwargs), Q is split into chunks evaluated by a pool of n threads (0 for all cores).
         TODO:
         * Update to include new class structure for MagneticStructureFactorModel
         * Need a way to check that the atom in each calculation loop is in the proper location for its moment and phase.
         <done> Confident that the form factor is computed with Qm rather than Q.
         """
-        # working from Eq. 59 in Chapter 1 of Chatterji
-        gn = -3.82608545 # neutron g-factor from: http://physics.nist.gov/cgi-bin/cuu/Value?gnn|search_for=all!
-        gamma = gn/2
-        r0 = np.sqrt(0.07941124) # electron 'radius' in sqrt(barn)
-
+        if domains:
+            if linear or not squared:
+                raise ValueError('The domain average is taken of the intensities of the moments; use squared=True and '
+                                 'linear=False.')
+            calcIntensity = lambda Qm, **kwargs: self.calcDomainIntensity(Qm, symmetrize=symmetrize, **kwargs)
+            calcStructureFactor = None
+        elif linear:
+            if symmetrize:
+                raise ValueError('The linear model is evaluated on the full set of Qm; use symmetrize=False.')
+            calcIntensity, calcStructureFactor = self.calcBasisIntensity, self.calcBasisStructureFactor
+        else:
+            calcIntensity = lambda Qm, **kwargs: self.calcMagneticIntensity(Qm, symmetrize=symmetrize, **kwargs)
+            calcStructureFactor = self.calcMagneticStructureFactor
         if Qm is None:
-            self.setMagneticStructureFactor()
+            self.setMagneticStructureFactor(precision=kwargs.get('precision', 'double'))
             Qm = 1.*self.Fm.coords
-            N = len(Qm)
-            for magatom in list(self.magatoms.values()):
-                d = magatom.d
-                # Get the moment and form factor for the particular ion in question
-                fd   = magatom.ff(Qm,**kwargs)
-                fd   = fd+0j
-                md = np.repeat(magatom.moment, N, axis=0)
-                Qmp = np.repeat(np.inner(Qm, d).reshape(N,1), 3, axis=1)
-
-                # Determine the contribution to the structure factor. This only has contributions from magnetic ions.
-
-                Fm0 = (gamma*r0/2)*fd*md* np.exp(2.*np.pi*1.j * Qmp)
-                self.Fm.values += Fm0
-                # see pg. 291 of Lovesey vol. 2 for the spin density calculation
-
-            # Get a unit vector in direction of the magnetic peaks.
-            Q = self.rlu2ang(Qm) #nodeepcopy
-            Qh = np.zeros(Q.shape)
-            Qnorm = np.repeat(np.linalg.norm(Q,axis=1),3)
-            idx = np.where(Qnorm==0)
-            Qnorm[idx] = 1
-            Qnorm = Qnorm.reshape((Q.shape))
-            Qh = Q / Qnorm
-
-
-            # Caclulate the projection of the magnetic structure factor onto the
-            # perpendicular plane
-            self.Fm.values =   np.cross(Qh, np.cross(self.Fm.values, Qh))
+            if self._fmtable is not None and not (domains or linear or symmetrize):
+                # the satellites carry the Fourier components of their own propagation vector
+                table = self._fmtable
+                calcIntensity = lambda Qm, **kwargs: self.calcSatelliteIntensity(table, **kwargs)
+                calcStructureFactor = lambda Qm, **kwargs: self.calcSatelliteStructureFactor(table, **kwargs)
 
             # Constants have been checked.
             # I feel confident they are correct so that the norm of the fourier component is the size of the moment when only one harmonic is visible.
             if squared:
-                #self.Fm.values = np.abs(self.Fm.values)**2.
-                self.Fm.values = np.abs(np.sum(self.Fm.values.conjugate() * self.Fm.values, axis=1))
-                self.Fm.values.reshape(N,1)
+                self.Fm.values = calcIntensity(Qm, **kwargs)
                 self.Fm.values *= scale_factor
                 if returned: return self.Fm # make sure numpy has implemented this correctly for complex numbers.
             else:
+                self.Fm.values += calcStructureFactor(Qm, **kwargs)
                 if returned: return  self.Fm
         else:
             Qm = np.asanyarray(Qm)
-            Fm = 0.+0j
-            N = len(Qm)
             if len(Qm.shape)==1:
-                N=1
                 Qm=Qm.reshape(1,len(Qm))
-            for magatom in list(self.magatoms.values()):
-                d = magatom.d
-                # Get the moment and form factor for the particular ion in question
-                fd   = magatom.ff(Qm,**kwargs)
-                fd   = fd+0j
-                md = np.repeat(magatom.moment, N, axis=0)
-                Qmp = np.repeat(np.inner(Qm, d).reshape(N,1), 3, axis=1)
-
-                # Determine the contribution to the structure factor. This only has contributions from magnetic ions.
-                Fm0 = (gamma*r0/2)*fd*md* np.exp(2.*np.pi*1.j * Qmp)
-                Fm += Fm0
-                # see pg. 291 of Lovesey vol. 2 for the spin density calculation
-
-            # Get a unit vector in direction of the magnetic peaks.
-            Q = self.rlu2ang(Qm) #nodeepcopy
-            Qh = np.zeros(Q.shape)
-            Qnorm = np.repeat(np.linalg.norm(Q,axis=1),3)
-            idx = np.where(Qnorm==0)
-            Qnorm[idx] = 1
-            Qnorm = Qnorm.reshape((Q.shape))
-            Qh = Q / Qnorm
-
-            # Calculate the projection of the magnetic structure factor onto the
-            # perpendicular plane
-            Fm =   np.cross(Qh, np.cross(Fm, Qh))
 
+            # Constants have been checked.
+            # I feel confident they are correct so that the norm of the fourier component is the size of the moment when only one harmonic is visible.
+            if squared:
+                Fm = calcIntensity(Qm, **kwargs)
+                Fm *= scale_factor
+            else:
+                Fm = calcStructureFactor(Qm, **kwargs)
             if update:
-                #self.setMagneticStructureFactor(Q=Qm)
                 self.Fm.values = Fm
                 self.Fm.coords = Qm
-                # Constants have been checked.
-            # I feel confident they are correct so that the norm of the fourier component is the size of the moment when only one harmonic is visible.
+            return Fm
+
+    def iterMagneticStructureFactor(self, Qm, budget=None, squared=True, **kwargs):
+        """
+        Yields (start, stop, Fm) for consecutive blocks of Qm (r.l.u.), which may be any sliceable (N,3) array such as
+        a memmap or an HDF5 dataset, with the block size set by the memory budget (bytes, util.kernels.CHUNK_BYTES by
+        default). With squared=True the blocks are |M_perp|^2 (N,) from calcMagneticIntensity, otherwise the complex
+        M_perp (N,3) from calcMagneticStructureFactor.
+        """
+        # Per row: the Nmag complex phases, up to 3 Nmag phase-weighted moments (one 3-vector per form factor species)
+        # and about eight complex 3-vectors of the projection
+        rows = getChunkSize(4*len(self.magatoms) + 24, budget=budget)
+        for start, stop in iterChunks(len(Qm), rows):
+            Q = np.asanyarray(Qm[start:stop], dtype=float)
             if squared:
-                #self.Fm.values = np.abs(self.Fm.values)**2.
-                Fm = np.abs(np.sum(Fm.conjugate() * Fm, axis=1))
-                Fm.reshape(N,1)
-                Fm *= scale_factor
-                if update:
-                    self.Fm.values = Fm
-                    self.Fm.coords = Qm
-                return Fm
+                yield start, stop, self.calcMagneticIntensity(Q, cache=False, **kwargs)
             else:
-                return  Fm
+                yield start, stop, self.calcMagneticStructureFactor(Q, cache=False, **kwargs)
+
+    def writeMagneticStructureFactor(self, filename, Qm, dataset='Fm', coords=False, budget=None, **kwargs):
+        """
+        Writes the blocks of iterMagneticStructureFactor straight into the dataset of an HDF5 file (see
+        util.stream.writeBlocks), with the Q in dataset + '_Q' if coords=True. Returns the number of rows written.
+        """
+        blocks = self.iterMagneticStructureFactor(Qm, budget=budget, **kwargs)
+        return writeBlocks(filename, blocks, len(Qm), dataset=dataset, coords=Qm if coords else None)
 
     def setMagneticRefinement(self, params, **kwargs):
         """"""
@@ -467,7 +930,15 @@ class MagneticStructure(NuclearStructure):
         return
 
     def refineMagneticStructure(self, params=None, **kwargs):
-        self.res = self.fitter.minimize(params=params, **kwargs)
+        """
+        Runs the refinement set up by setMagneticRefinement. Since every evaluation uses the same Qm, the phase matrices
+        are kept by the Crystal while it runs (see Crystal.setPhaseCaching).
+        """
+        previous = self.crystal.setPhaseCaching(True)
+        try:
+            self.res = self.fitter.minimize(params=params, **kwargs)
+        finally:
+            self.crystal.setPhaseCaching(previous)
         return self.res
 
     def residual(self, params, **kwargs):
@@ -479,7 +950,22 @@ class MagneticStructure(NuclearStructure):
         res = (data - calc) / err
         return res
 
-    def update(self, params, **kwargs):
+    def update(self, params, linear=False, **kwargs):
+        """
+        Sets the coefficients, moment sizes, phases and domain populations from the refinement parameters and
+        recomputes the structure factor. With linear=True, the moments are not rebuilt; the structure factor follows
+        from the kept basis vector amplitudes of the linear model instead (see calcBasisStructureFactor). The phases are
+        not applied there and the moment sizes only scale the coefficients, so the phi and mu parameters must be fixed.
+        If the domain populations pop1, pop2, ... are among the parameters, the domain averaged intensities are computed
+        (domains=True in getMagneticStructureFactor), so that the populations enter the fit.
+        """
+        if linear:
+            varied = [name for name, param in params.items() if getattr(param, 'vary', False)
+                      and name.rstrip('0123456789') in ('mu', 'phi') and name.rstrip('0123456789') != name]
+            if varied:
+                raise ValueError('With linear=True only the coefficients are refined; fix ' + ', '.join(varied) +
+                                 ' (vary=False), since the phases are not applied and the moment sizes are degenerate '
+                                 'with the scale of the coefficients.')
         Nrep = self.crystal.magrepgroup.IR0
         # vector direction
         coeffs = {}
@@ -494,31 +980,37 @@ class MagneticStructure(NuclearStructure):
         # moment size
         _cnt = 1
         for magatom in list(self.magatoms.values()):
-            magatom.setMomentSize(params['mu'+str(_cnt)])
-            magatom.setPhase(params['phi'+str(_cnt)])
-            magatom.addMoment(self.magrepgroup.getMagneticMoment(d=magatom.d,Nrep=Nrep))
+            if linear:
+                magatom.mu = params['mu'+str(_cnt)].value
+            else:
+                magatom.setMomentSize(params['mu'+str(_cnt)])
+                magatom.setPhase(params['phi'+str(_cnt)])
+                magatom.addMoment(self.magrepgroup.getMagneticMoment(d=magatom.d,Nrep=Nrep))
             _cnt+=1
-
-        self.getMagneticStructureFactor(**kwargs)
+        bvc = self.crystal.magrepgroup.bvc
+        if linear and bvc:
+            bvc.update(*[coeffs.get(name, c) for name, c in zip(bvc.keys(), np.atleast_1d(bvc.coeffs))])
+        # domain populations, if refined
+        if 'pop1' in coeffs:
+            domains = self.getDomains()
+            domains.setPopulations([coeffs.get('pop'+str(n+1), 0.) for n in range(len(domains))])
+            kwargs.setdefault('domains', True)
+
+        self.getMagneticStructureFactor(linear=linear, **kwargs)
         return
 
+    @property
+    def lattice(self):
+        """
+        The ReciprocalLattice of the NuclearStructure.
+        """
+        return self.nuclear.lattice
+
     def rlu2ang(self, Q):
         """
-        TODO:
-        * implement so that lattice constants are accessed at the crystal level.
-        """
-        Q = np.asanyarray(Q)
-        N = len(Q.shape)
-        if N == 1:
-            Q = Q.reshape((1,3))
-        vec = 2*np.pi/np.array([self.nuclear.a, self.nuclear.b, self.nuclear.c])
-        Q = np.stack(list(map(np.diag, np.einsum('...i,j', Q, vec))))
-        #Q[:,0] = np.reshape(Q[:,0]*2.*np.pi/self.nuclear.a, Q.shape)
-        #print(Q[:,0]*2.*np.pi/self.nuclear.a)
-        #Q[:,1] = Q[:,1]*2.*np.pi/self.nuclear.b
-        #Q[:,2] = Q[:,2]*2.*np.pi/self.nuclear.c
-        #print(Q)
-        return Q
+        Converts Q from r.l.u. to inv. Ang. using the lattice of the NuclearStructure. The input is not modified.
+        """
+        return self.lattice.rlu2ang(Q)
 
     def gen_smb(self):
         smb = []
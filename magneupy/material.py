@@ -3,17 +3,111 @@ from cmath import polar
 from lmfit import minimize, Parameters
 import numpy as np
 from collections import OrderedDict
-from itertools import combinations_with_replacement, product
-import periodictable as pt
-from pymatgen.io.cif import CifFile, CifParser
 import string
 
-from .util.functions import getFamilyAttributes
+from .util.functions import getFamilyAttributes, fingerprint
+from .util.kernels import getChunkSize, getPrecision, nuclearStructureFactor, nufftStructureFactor, debyeWallerFactors, \
+    IncrementalStructureFactor, sharedStructureFactors, magneticInteractionVector, phaseMatrix, mapChunks, \
+    getParallelChunkSize
+from .util.stream import iterChunks, writeBlocks
+from .util.tables import getIon
+from .util.cifcache import loadCIF, SPACEGROUP_KEY, SYMOP_KEYS
+from .reciprocal import ReciprocalLattice, planeVectors, combineAxes, makeGrid, makeShell, getSymmetryOperations, \
+    getSitePermutations, getLaueOperations, LaueReduction, ReflectionConditions
+from .powder import Reflections, renderPattern
+from .polarization import getCrossSections, getPolarizationFrame
 from .rep.rep import BasisVectorCollection, NucRepGroup, MagRepGroup
 from .data.data import StructureFactorModel, NuclearStructureFactorModel
 
 rec2pol = np.vectorize(polar)
 
+# Memory budget (in bytes) of the phase matrices kept by each Crystal (see Crystal.getPhaseMatrix)
+PHASE_CACHE_BYTES = 2**28
+
+
+class AtomTable(object):
+    """
+    Struct-of-arrays storage of the atoms of a NuclearStructure. Each Atom is a view of one row.
+    ----------
+    Attributes:
+    Z: atomic numbers (N,)
+    element, oxidation, label: element names and charges (bytes) and labels (N,) object arrays
+    d, r: fractional and Cartesian (Ang.) coordinates (N,3)
+    bc: coherent scattering lengths (N,), complex once any absorber is stored
+    occupancy: site occupancies (N,)
+    Uiso, Uaniso, aniso: isotropic and anisotropic (CIF U_ij) displacement parameters (N,) and (N,3,3), and whether
+    Uaniso is set (N,)
+    ----------
+    TODO:
+    * Removing rows.
+    """
+    fields = OrderedDict([('Z', (int, ())), ('element', (object, ())), ('oxidation', (object, ())),
+                          ('label', (object, ())), ('d', (float, (3,))), ('r', (float, (3,))), ('bc', (float, ())),
+                          ('occupancy', (float, ())), ('Uiso', (float, ())), ('Uaniso', (float, (3,3))),
+                          ('aniso', (bool, ()))])
+
+    def __init__(self, capacity=8):
+        """"""
+        self._size = 0
+        self._data = OrderedDict((name, np.zeros((capacity,)+shape, dtype=dtype))
+                                 for name, (dtype, shape) in self.fields.items())
+        self._data['occupancy'][:] = 1.
+        return
+
+    def __len__(self):
+        return self._size
+
+    def __getattr__(self, name):
+        """
+        The columns are returned as views of the first len(self) rows.
+        """
+        data = self.__dict__.get('_data')
+        if data is not None and name in data:
+            return data[name][:self._size]
+        raise AttributeError(name)
+
+    def append(self, **values):
+        """
+        Adds a row with the given values (the rest are defaults) and returns its index.
+        """
+        capacity = len(self._data['Z'])
+        if self._size == capacity:
+            for name, column in self._data.items():
+                grown = np.zeros((2*capacity,)+column.shape[1:], dtype=column.dtype)
+                grown[:capacity] = column
+                self._data[name] = grown
+            self._data['occupancy'][capacity:] = 1.
+        index = self._size
+        self._size += 1
+        for name, value in values.items():
+            self.set(index, name, value)
+        return index
+
+    def get(self, index, name):
+        """"""
+        return self._data[name][index]
+
+    def set(self, index, name, value):
+        """"""
+        column = self._data[name]
+        if (value is not None) and np.iscomplexobj(value) and not np.iscomplexobj(column):
+            column = self._data[name] = column.astype(np.complex128)
+        if value is None and column.dtype != object:
+            value = 0.
+        column[index] = value
+        return
+
+
+def _tableField(name, doc=None):
+    """
+    A property of an Atom which reads and writes its row in the AtomTable.
+    """
+    def fget(self):
+        return self._table.get(self._index, name)
+    def fset(self, value):
+        self._table.set(self._index, name, value)
+    return property(fget, fset, doc=doc)
+
 
 class Atom(object):
     """
@@ -21,36 +115,33 @@ class Atom(object):
     ----------
     Attributes:
     ...
+    The element, oxidation, label, coordinates (d, r), bc, occupancy and displacement parameters are stored in the
+    AtomTable of the parent structure (or in one of its own).
     ----------
     TODO:
     * 
     """
-
-    def __init__(self, elname, oxidation, label=None, parent=None):
+    Z         = _tableField('Z')
+    element   = _tableField('element')
+    oxidation = _tableField('oxidation')
+    label     = _tableField('label')
+    d         = _tableField('d', 'fractional coordinates')
+    r         = _tableField('r', 'Cartesian coordinates (Ang.)')
+    bc        = _tableField('bc', 'neutron scattering length')
+    occupancy = _tableField('occupancy')
+    Uiso      = _tableField('Uiso', 'isotropic displacement parameter (Ang.^2)')
+
+    def __init__(self, elname, oxidation, label=None, parent=None, table=None):
         """
         TODO:
         * Long term, it would be nice to make this extensible for use with RIXS and/or ARPES spectral function modeling. This would mean including those cross-sections and/or scattering lengths.
         * Decide on what the parent of the Atom should be (general class passed initial test that changes to a reference continue to work -- as they should in pythonic fashion)
         """
-
-        # Set initial values of...
-        #...the coordinates
-        self.d = None
-        self.r = None
-        #...the element name and label
-        self.element = None
-        self.label = None
-        #...the neutron scattering length
-        self.bc = None
-
-
-        # Set the atom name
-        self.element = elname
-        self.oxidation = oxidation
-        if label is not None:
-            self.label = label
-        else:
-            self.label = elname
+        # Set the row of the atom table with the atom name and label
+        self._table = AtomTable(capacity=1) if table is None else table
+        self._index = self._table.append(element=elname, oxidation=oxidation,
+                                         label=label if label is not None else elname)
+        self.Z = getIon(elname).Z
 
         # Set the neutron scattering length
         self.bc = self.getNeutronScatteringLength()
@@ -63,13 +154,28 @@ class Atom(object):
 
         return
 
-    def getNeutronScatteringLength(self):
+    @property
+    def Uaniso(self):
         """
-        The neutron coherent scattering length is pulled from the 'pt' module <-- will we need to make sure the incident NEUTRON WAVELENGTH is incorporated?
+        The anisotropic displacement parameters (CIF U_ij in Ang.^2), or None if only Uiso is set.
+        """
+        return self._table.get(self._index, 'Uaniso') if self._table.get(self._index, 'aniso') else None
+
+    @Uaniso.setter
+    def Uaniso(self, value):
+        self._table.set(self._index, 'aniso', value is not None)
+        self._table.set(self._index, 'Uaniso', value)
+        return
+
+    def getNeutronScatteringLength(self, absorption=False):
+        """
+        The neutron coherent scattering length is pulled from the 'pt' module (through the ion table in util.tables) <-- will we need to make sure the incident NEUTRON WAVELENGTH is incorporated?
+        With absorption=True the complex scattering length is returned.
         UNITS: The scattering lengths are given here in femtometers (fm). 
         UNITS: We will divide the calculated factors by 10 so that when they are squared, the units are in barn (since barn = 100 fm^2).
         """
-        return pt.elements.isotope(self.element.decode()).neutron.b_c / 10.
+        ion = getIon(self.element)
+        return (ion.b if absorption else ion.b_c) / 10.
 
     def setLocation(self, frac_coords, ang_coords, a, b, c, alpha, beta, gamma):
         """
@@ -88,23 +194,28 @@ class Atom(object):
 
         return
 
+    def setDisplacement(self, Uiso=None, Uaniso=None, Biso=None):
+        """
+        Sets the atomic displacement parameters in Ang.^2, either isotropic (Uiso, or Biso = 8 pi^2 Uiso) or anisotropic
+        as the symmetric 3x3 matrix of U_ij in the CIF convention (i.e. along the reciprocal axes a*, b*, c*).
+        """
+        if Biso is not None:
+            Uiso = Biso / (8. * np.pi**2)
+        if Uiso is not None:
+            self.Uiso = float(Uiso)
+            self.Uaniso = None
+        if Uaniso is not None:
+            Uaniso = np.asanyarray(Uaniso, dtype=float).reshape((3,3))
+            if not np.allclose(Uaniso, Uaniso.T): raise ValueError('Uaniso must be a symmetric 3x3 matrix.')
+            self.Uaniso = Uaniso
+            self.Uiso = np.trace(Uaniso) / 3.
+        return
+
     def rlu2ang(self, Q):
         """
-        TODO:
-        * Needs to be generalized!
-        """
-        Q = np.asanyarray(Q)
-        N = len(Q.shape)
-        if N == 1:
-            Q = Q.reshape((1,3))
-        vec = 2*np.pi/np.array([self.nuclear.a, self.nuclear.b, self.nuclear.c])
-        Q = np.stack(list(map(np.diag, np.einsum('...i,j', Q, vec))))
-        #Q[:,0] = np.reshape(Q[:,0]*2.*np.pi/self.nuclear.a, Q.shape)
-        #print(Q[:,0]*2.*np.pi/self.nuclear.a)
-        #Q[:,1] = Q[:,1]*2.*np.pi/self.nuclear.b
-        #Q[:,2] = Q[:,2]*2.*np.pi/self.nuclear.c
-        #print(Q)
-        return Q
+        Converts Q from r.l.u. to inv. Ang. using the lattice of the parent structure.
+        """
+        return self.nuclear.rlu2ang(Q)
 
     def setParent(self, parent):
         """
@@ -154,14 +265,17 @@ class NuclearStructure(object):
     """
     # Set the initial state for various fields
     familyname = 'nuclear'
-    atoms = []
-    names = []
 
     def __init__(self, cifname=None, structure_info=None, Q=None, Qmax=7, parents=None, plane=None):
         """"""
         # Set up the NuclearStructure family
         self.setParents(parents)
 
+        # The atoms of this structure are views of the rows of its own AtomTable
+        self.table = AtomTable()
+        self.atoms = []
+        self.names = []
+
         # make the Q values at which to sample
         plane = 'hhl' if plane is None else plane
         self.Q = self.makeQ(Qmax=Qmax,plane=plane) if Q is None else Q
@@ -173,28 +287,24 @@ class NuclearStructure(object):
         self.claimChildren()
         return
 
-    def setStructure(self, cifname=None, structure_info=None):
-        """"""
+    def setStructure(self, cifname=None, structure_info=None, cache=True):
+        """
+        With cache=True the parsed CIF is read from (or stored in) the on-disk cache of util.cifcache.
+        """
         if cifname is not None:
             assert(isinstance(cifname, str))
 
-            # Use pymatgen methods to parse the CIF file.
-            cifparser = CifParser(cifname)
-            ciffile   = CifFile.from_file(cifname)
-            cfkeys    = list(ciffile.data.keys())[0]
-            cifblock  = ciffile.data[cfkeys]
-
-            # obtain the final object from which to pull the pertinent info
-            struc     = cifparser.get_structures(False)[0]
+            # Parse the CIF file (with pymatgen on a cache miss) into arrays.
+            cif = loadCIF(cifname, cache=cache)
 
             # Set the lattice definition parameters
-            self.setLattice(struc)
+            self.setLattice(cif['matrix'])
 
             # Place the atoms in their locations
-            self.placeAtoms(struc)
+            self.placeAtoms(cif)
 
             # set Spacegroup in H-M string form by default.
-            self.setSpaceGroup(cifblock.data)
+            self.setSpaceGroup(dict((key, cif[key].tolist()) for key in [SPACEGROUP_KEY]+SYMOP_KEYS if key in cif))
 
         elif structure_info is not None:
             assert(isinstance(structure_info, dict))
@@ -211,44 +321,145 @@ class NuclearStructure(object):
             self.spacegroup = None
             print('Failed to extract nuclear spacegroup from provided CIF file... Did you forget to include it? ')
             pass
+
+        # Keep the listed symmetry operations since they match the setting of the atomic coordinates.
+        self.symops = None
+        for key in ['_symmetry_equiv_pos_as_xyz', '_space_group_symop_operation_xyz']:
+            if key in cifdict:
+                self.symops = list(cifdict[key])
         return
 
-    def setLattice(self, struc):
+    def getSymmetryOperations(self):
         """
-        TODO:
-        * Do a more exhaustive search of quantities or methods from pymatgen subclasses that would be useful to retain.
+        Returns the rotations (Nops,3,3) and translations (Nops,3) of the space group of this structure.
+        """
+        if getattr(self, '_symmetry', None) is None:
+            self._symmetry = getSymmetryOperations(spacegroup=self.spacegroup, xyz=getattr(self, 'symops', None))
+        return self._symmetry
+
+    def getLaueReduction(self, Q, friedel=True):
+        """
+        Returns the LaueReduction of Q (r.l.u.) under the space group of this structure. Only the operations which map
+        the atoms onto each other are used. The reduction of the last Q is kept for reuse.
         """
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        d, bc = self.getAtomArrays()
+        R, t, L = self.getInvariantOperations()
+        cached = getattr(self, '_laue', None)
+        if cached is not None and cached[0].shape == Q.shape and np.array_equal(cached[0], Q) \
+                and np.array_equal(cached[1], d) and cached[3] is R:
+            return cached[2]
+
+        # Friedel's law requires real scattering lengths
+        friedel = friedel and not np.any(np.imag(bc))
+        reduction = LaueReduction(Q, *getLaueOperations(R, t, L, friedel=friedel))
+        self._laue = (Q.copy(), d, reduction, R)
+        return reduction
+
+    def getInvariantOperations(self):
+        """
+        Returns the rotations, translations and site lattice shifts (see reciprocal.getSitePermutations) of the space
+        group operations which map the atoms onto each other.
+        """
+        d, bc = self.getAtomArrays()
+        U = self.getDisplacementArrays()
+        cached = getattr(self, '_invariant', None)
+        if cached is not None and np.array_equal(cached[0], d) and np.array_equal(cached[1], U):
+            return cached[2]
+
+        R, t = self.getSymmetryOperations()
+        perm, L = getSitePermutations(d, R, t, labels=self.table.label)
+        ok = np.all(perm >= 0, axis=1)
+        # The displacement tensors must map onto each other as well, U_p(j) = Rc U_j Rc^T.
+        if np.any(U):
+            Rc = self.getCartesianRotations(R)
+            rotated = np.einsum('kab,jbc,kdc->kjad', Rc, U, Rc)
+            ok &= np.all(np.isclose(rotated, U[np.where(perm >= 0, perm, 0)], atol=1e-6), axis=(1,2,3))
+        self._invariant = (d, U, (R[ok], t[ok], L[ok]))
+        return self._invariant[2]
+
+    def getCartesianRotations(self, R):
+        """
+        Returns the rotations (Nops,3,3) acting on fractional coordinates as the Cartesian rotations Rc = A R A^-1, with
+        the lattice vectors as the columns of A, e.g. for the moments and displacement tensors.
+        """
+        A = np.asanyarray(self._matrix, dtype=float).T
+        return np.einsum('ij,kjl,lm->kim', A, np.asanyarray(R, dtype=float).reshape((-1,3,3)), np.linalg.inv(A))
+
+    def getReflectionConditions(self):
+        """
+        Returns the ReflectionConditions of the space group, built from the operations which map the atoms onto each
+        other, or None if the space group is unknown or its operations cannot be resolved (e.g. a symbol pymatgen does
+        not recognize and no symmetry operations in the CIF). They are kept (with their absences of the last Q) until the
+        set of these operations changes, not merely the positions.
+        """
+        if (getattr(self, 'spacegroup', None) is None) and not getattr(self, 'symops', None):
+            return None
+        try:
+            R, t, L = self.getInvariantOperations()
+        except ValueError:
+            return None
+        key = (fingerprint(R), fingerprint(np.asanyarray(t, dtype=float) % 1.))
+        cached = getattr(self, '_conditions', None)
+        if cached is None or cached[0] != key:
+            self._conditions = (key, ReflectionConditions(R, t))
+        return self._conditions[1]
+
+    def getAbsences(self, Q):
+        """
+        Returns a boolean mask over Q (r.l.u.) flagging the systematically absent reflections, or None if the space
+        group is unknown (see getReflectionConditions).
+        """
+        conditions = self.getReflectionConditions()
+        if conditions is None:
+            return None
+        return conditions.isAbsent(Q)
+
+    def setLattice(self, matrix):
+        """
+        Sets the lattice from the direct lattice vectors as the rows of matrix (3,3) in Ang.
+        """
+        matrix = np.array(matrix, dtype=float).reshape((3,3))
+
         # Setup the lattice parameters
-        self.a = struc.lattice.a
-        self.b = struc.lattice.b
-        self.c = struc.lattice.c
+        self.a, self.b, self.c = np.linalg.norm(matrix, axis=1)
 
         # Setup the lattice angles
-        self.alpha = struc.lattice.alpha
-        self.beta  = struc.lattice.beta
-        self.gamma = struc.lattice.gamma
+        def angle(u, v):
+            return np.degrees(np.arccos(np.clip(np.dot(u, v) / (np.linalg.norm(u) * np.linalg.norm(v)), -1., 1.)))
+        self.alpha = angle(matrix[1], matrix[2])
+        self.beta  = angle(matrix[2], matrix[0])
+        self.gamma = angle(matrix[0], matrix[1])
 
         # Add some convenience attributes
         self.abc = (self.a, self.b, self.c)
-        self.volume = struc.lattice.volume
+        self.volume = np.abs(np.linalg.det(matrix))
         self.angles = (self.alpha, self.beta, self.gamma)
         self.abc_angles = (self.a, self.b, self.c, self.alpha, self.beta, self.gamma)
-        self._matrix = struc.lattice.matrix
+        self._matrix = matrix
         self.basis = (self._matrix[0,:], self._matrix[1,:], self._matrix[2,:])
         ar = 2.*np.pi * np.cross(self.basis[1],self.basis[2]) / self.volume
         br = 2.*np.pi * np.cross(self.basis[2], self.basis[0]) / self.volume
         cr = 2.*np.pi * np.cross(self.basis[0], self.basis[1]) / self.volume
         self.recip = (ar,br,cr)
+        self.lattice = ReciprocalLattice(self.recip)
 
         return
 
-    def placeAtoms(self, struc):
-        """"""
+    def placeAtoms(self, sites):
+        """
+        Places the atoms from the arrays of species strings, fractional and Cartesian coordinates and occupancies of
+        the sites (see util.cifcache.parseCIF).
+        """
 
         # Place the atoms in their locations
-        for site in struc.sites:
-            atom = Atom(self.getElementName(site), self.getOxidationState(site), label=site.species_string)
-            atom.setLocation(site.frac_coords, site.coords, *self.abc_angles)
+        for species, frac_coords, coords, occupancy in zip(sites['species'], sites['frac_coords'], sites['coords'],
+                                                           sites['occupancy']):
+            species = str(species)
+            atom = Atom(self.getElementName(species), self.getOxidationState(species), label=species,
+                        table=self.table)
+            atom.setLocation(frac_coords, coords, *self.abc_angles)
+            atom.occupancy = occupancy
             self.atoms.append(atom)
 
         return
@@ -261,7 +472,7 @@ class NuclearStructure(object):
         Maybe just read first two characters (handle element lengths of only 1) and keep if they are numbers.
         """
         pstr = string.ascii_letters
-        elname = site.species_string
+        elname = getattr(site, 'species_string', site)
         elname = elname.encode('ascii','ignore')
         elall = b"".maketrans(b"",b"")
         elnolet = elall.translate(elall, pstr.encode('utf-8'))
@@ -279,7 +490,7 @@ class NuclearStructure(object):
         * Needs to retain information about +/-
         """
         pstr = string.digits
-        charge = site.species_string
+        charge = getattr(site, 'species_string', site)
         charge = charge.encode('ascii','ignore')
         elall = b"".maketrans(b"",b"")
         elnolet = elall.translate(elall, pstr.encode('utf-8'))
@@ -313,148 +524,264 @@ class NuclearStructure(object):
 
     def rlu2ang(self, Q):
         """
-        TODO:
-        * Needs to be generalized! (Move it up to crystal level)
-        * Be more careful about modifying the value. Give an option or change the name
+        Converts Q from r.l.u. to inv. Ang. (see the ReciprocalLattice in self.lattice). The input is not modified.
         """
-
-        Q[:,0] = Q[:,0]*2.*np.pi/self.a
-        Q[:,1] = Q[:,1]*2.*np.pi/self.b
-        Q[:,2] = Q[:,2]*2.*np.pi/self.c
-
-        return Q
+        return self.lattice.rlu2ang(Q)
 
     @staticmethod
     def makeQ(Qmax=4, firstQuad=False, sym=True, plane='hhl'):
         """
-        TODO: 
-        * Needs to be considerably generalized. Shouldn't be hard. Include human intuitive input: 'hhl' -> 2 repeats, according arrangement of peaks
+        Builds the integer points of a plane (or volume) given by a human intuitive string, e.g. 'hhl', 'h0l', 'hk0',
+        'hkk' or 'hkl'. With sym=False only one of each permutation of the coefficients is kept.
+        For general axes, ranges, steps and cutoffs use makeQGrid.
+        TODO:
         * The logic needs to be fixed. firstQuad and sym don't really make sense.
         """
-        print(plane)
-        if plane == 'hhl':
-            if firstQuad:
-                qs = np.arange(Qmax+1.)
-                if sym:
-                    Qiter = product(qs, repeat=2)
-                else:
-                    Qiter = combinations_with_replacement(qs, 2)
-            else:
-                qs = -1.*np.hstack((np.arange(Qmax)+1., -np.arange(Qmax+1.)))
-                if sym:
-                    Qiter = product(qs, repeat=2)
-                else:
-                    Qiter = combinations_with_replacement(qs, 2)
-
-            Q = []
-            for q in Qiter:
-                Q.append(np.asanyarray(q))
-            Q = np.asanyarray(Q)
-            Q = np.vstack((Q[:,0],Q[:,0],Q[:,1])).transpose()
-
-        if plane == 'h0l':
-            if firstQuad:
-                qs = np.arange(Qmax+1.)
-                if sym:
-                    Qiter = product(qs, repeat=2)
-                else:
-                    Qiter = combinations_with_replacement(qs, 2)
-            else:
-                qs = -1.*np.hstack((np.arange(Qmax)+1., -np.arange(Qmax+1.)))
-                if sym:
-                    Qiter = product(qs, repeat=2)
-                else:
-                    Qiter = combinations_with_replacement(qs, 2)
-
-            Q = []
-            for q in Qiter:
-                Q.append(np.asanyarray(q))
-            Q = np.asanyarray(Q)
-            Q = np.vstack((Q[:,0],0.*Q[:,0],Q[:,1])).transpose()
-
-        if plane == 'hk0':
-            if firstQuad:
-                qs = np.arange(Qmax+1.)
-                if sym:
-                    Qiter = product(qs, repeat=2)
-                else:
-                    Qiter = combinations_with_replacement(Q, 2)
-            else:
-                qs = -1.*np.hstack((np.arange(Qmax)+1., -np.arange(Qmax+1.)))
-                if sym:
-                    Qiter = product(qs, repeat=2)
-                else:
-                    Qiter = combinations_with_replacement(Q, 2)
-
-            Q = []
-            for q in Qiter:
-                Q.append(np.asanyarray(q))
-            Q = np.asanyarray(Q)
-            Q = np.vstack((Q[:,0],Q[:,1],np.zeros(Q[:,1].shape))).transpose()
-
+        if firstQuad:
+            qs = np.arange(Qmax+1.)
+        else:
+            qs = -1.*np.hstack((np.arange(Qmax)+1., -np.arange(Qmax+1.)))
+
+        axes = planeVectors(plane)
+        Q = combineAxes(axes, [qs]*len(axes))
+        if not sym:
+            # Keep only index combinations in non-decreasing order (as combinations_with_replacement).
+            idx = np.indices((len(qs),)*len(axes)).reshape((len(axes), -1))
+            Q = Q[np.all(np.diff(idx, axis=0) >= 0, axis=0)]
         return Q
 
-    def setNuclearStructureFactor(self, Q=None, units=None):
+    def makeQGrid(self, u, v=None, w=None, **kwargs):
+        """
+        Builds a grid of Q (r.l.u.) spanned by any axes u, v (and w for a volume) using reciprocal.makeGrid.
+        The Qmax (inv. Ang.) and dmin (Ang.) cutoffs use the lattice of this structure.
+        """
+        kwargs.setdefault('recip', self.lattice.B)
+        return makeGrid(u, v=v, w=w, **kwargs)
+
+    def setNuclearStructureFactor(self, Q=None, units=None, precision='double'):
         """
         *! This and similar operations should probably happen at the level of Crystal!!!
         """
         if Q is not None:
             self.Q = Q
         # Construct the MagneticStructureFactorModel with
-        self.Fn = NuclearStructureFactorModel(self.Q, np.zeros(np.max(self.Q.shape), dtype=complex))#, units=units)
+        self.Fn = NuclearStructureFactorModel(self.Q, np.zeros(np.max(self.Q.shape), dtype=getPrecision(precision)[1]))#, units=units)
         return
 
-    def getNuclearStructureFactor(self, useDebyeWaller=False, squared=True, scale_factor=1., x0=1, y0=0, Q=None):
+    def getAtomArrays(self):
+        """
+        Returns copies of the fractional coordinates (Natoms,3) and the scattering lengths weighted by the site
+        occupancies (Natoms,) from the AtomTable.
+        """
+        return self.table.d.copy(), self.table.bc * self.table.occupancy
+
+    def setDisplacement(self, label=None, **kwargs):
+        """
+        Sets the displacement parameters (see Atom.setDisplacement) of all atoms with the given label or element name,
+        or of all atoms if no label is given.
+        """
+        if label is None:
+            found = np.ones(len(self.table), dtype=bool)
+        else:
+            element = label if isinstance(label, bytes) else str(label).encode()
+            found = (self.table.label == label) | (self.table.element == element)
+        if not found.any(): raise KeyError('No atom with the label or element ' + str(label) + ' was found.')
+        for j in np.where(found)[0]:
+            self.atoms[j].setDisplacement(**kwargs)
+        return
+
+    def getDisplacementArrays(self):
+        """
+        Returns the displacement tensors (Natoms,3,3) of all atoms in Cartesian coordinates (Ang.^2).
+        The CIF U_ij are converted as A N U N A^T, with A the direct lattice vectors as columns and N the diagonal of the
+        reciprocal lattice lengths (without 2 pi).
+        """
+        table = self.table
+        U = table.Uiso[:,None,None] * np.eye(3)
+        if table.aniso.any():
+            A = np.asanyarray(self._matrix).T * (np.linalg.norm(self.lattice.B, axis=1) / (2. * np.pi))
+            U[table.aniso] = np.einsum('ij,njk,lk->nil', A, table.Uaniso[table.aniso], A)
+        return U
+
+    def getDebyeWaller(self, Q):
+        """
+        Returns the (N, Nspecies) table of Debye-Waller factors at Q (r.l.u.) and the species (column) of each atom.
+        Atoms sharing the same displacement tensor form one species. The table of the last Q is kept and only
+        recomputed when Q or the displacement parameters change.
+        """
+        U = self.getDisplacementArrays()
+        U, species = np.unique(U.reshape((-1,9)), axis=0, return_inverse=True)
+        species = species.reshape(-1)
+        key = (fingerprint(np.atleast_2d(Q)), U.tobytes())
+        cached = getattr(self, '_debyewaller', None)
+        if cached is None or cached[0] != key:
+            T = debyeWallerFactors(self.rlu2ang(Q), U)
+            T.flags.writeable = False
+            cached = self._debyewaller = (key, T)
+        return cached[1], species
+
+    def calcNuclearStructureFactor(self, Q, chunk=None, symmetrize=False, absences=True, useDebyeWaller=False,
+                                   incremental=False, precision='double', workers=None, backend='direct', tol=1e-6,
+                                   cache=True):
+        """
+        Returns the complex nuclear structure factor at Q (r.l.u.) from the fused kernel in util.kernels.
+        With symmetrize=True, it is only evaluated for the reflections unique under the space group and then
+        scattered back onto the full set of Q.
+        With absences=True, the systematically absent reflections are removed before the evaluation and set to zero.
+        With useDebyeWaller=True, each atom is attenuated by its Debye-Waller factor (see getDebyeWaller).
+        With incremental=True, F of the last Q is kept and only the terms of the atoms that changed since the last call
+        are recomputed (see util.kernels.IncrementalStructureFactor), e.g. for positional refinements. F is kept over
+        all of Q and the absences are set to zero afterwards, so that a move changing the absences does not start over.
+        Since the absences and the symmetrization are derived again from the moved atoms, use absences=False and
+        symmetrize=False for sampling that breaks the space group symmetry.
+        With precision='single', F is computed in complex64 (see util.kernels for the accuracy).
+        With workers > 1 (0 for all cores), the chunks of Q are evaluated by a pool of threads.
+        With backend='nufft', F is evaluated on the regular grid of a reciprocal.QGrid (e.g. from makeQGrid without
+        cutoffs) by a nonuniform FFT with an absolute error of about tol sum_j |b_j| (see
+        util.kernels.nufftStructureFactor). This is meant for supercells, where the direct sum is too slow.
+        With cache=False, the phase matrices kept by the Crystal (see Crystal.setPhaseCaching) are neither read nor
+        stored, e.g. for streamed blocks.
+        """
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        if backend == 'nufft':
+            return self.calcGridStructureFactor(Q, tol=tol, absences=absences, useDebyeWaller=useDebyeWaller,
+                                                precision=precision)
+        elif backend != 'direct':
+            raise ValueError("The backend must be 'direct' or 'nufft', not " + str(backend))
+        absent = self.getAbsences(Q) if absences else None
+        if incremental and (absent is not None) and absent.any():
+            Fn = self.calcNuclearStructureFactor(Q, chunk=chunk, symmetrize=symmetrize, absences=False,
+                                                 useDebyeWaller=useDebyeWaller, incremental=True, precision=precision,
+                                                 workers=workers, cache=cache)
+            Fn[absent] = 0.
+            return Fn
+        if (absent is not None) and absent.any():
+            Fn = np.zeros(len(Q), dtype=getPrecision(precision)[1])
+            present = np.logical_not(absent)
+            Fn[present] = self.calcNuclearStructureFactor(Q[present], chunk=chunk, symmetrize=symmetrize,
+                                                          absences=False, useDebyeWaller=useDebyeWaller,
+                                                          incremental=incremental, precision=precision,
+                                                          workers=workers, cache=cache)
+            return Fn
+
+        d, bc = self.getAtomArrays()
+        if symmetrize:
+            reduction = self.getLaueReduction(Q)
+            Q = reduction.unique
+        T, species = self.getDebyeWaller(Q) if useDebyeWaller else (None, None)
+        if incremental:
+            cached = self.getIncrementalStructureFactor(Q, chunk=chunk, precision=precision)
+            cached.workers = workers
+            Fn = cached.update(d, bc, T=T, species=species).copy()
+        else:
+            phases = self.getPhaseMatrix(Q, precision, workers) if cache else None
+            Fn = nuclearStructureFactor(Q, d, bc, chunk=chunk, T=T, species=species, precision=precision,
+                                        workers=workers, phases=phases)
+        return reduction.expand(Fn) if symmetrize else Fn
+
+    def calcGridStructureFactor(self, Q, tol=1e-6, absences=True, useDebyeWaller=False, precision='double'):
+        """
+        Returns the complex nuclear structure factor on a reciprocal.QGrid by the nonuniform FFT backend (see
+        calcNuclearStructureFactor).
+        """
+        if not getattr(Q, 'isGrid', False):
+            raise ValueError('The nufft backend needs a regular grid of Q, e.g. from makeQGrid without cutoffs.')
+        d, bc = self.getAtomArrays()
+        T, species = self.getDebyeWaller(Q) if useDebyeWaller else (None, None)
+        Fn = nufftStructureFactor(Q.origin, Q.steps, Q.gridshape, d, bc, tol=tol, T=T, species=species)
+        Fn = Fn.astype(getPrecision(precision)[1], copy=False)
+        absent = self.getAbsences(Q) if absences else None
+        if absent is not None:
+            Fn[absent] = 0.
+        return Fn
+
+    def getPhaseMatrix(self, Q, precision='double', workers=None):
+        """
+        Returns the phase matrix of all atoms at Q kept by the parent Crystal (see Crystal.getPhaseMatrix), or None
+        unless this is the nuclear structure of a Crystal.
+        """
+        crystal = getattr(self, 'crystal', None)
+        if not isinstance(crystal, Crystal) or crystal.nuclear is not self:
+            return None
+        return crystal.getPhaseMatrix(Q, precision=precision, workers=workers)
+
+    def getIncrementalStructureFactor(self, Q, chunk=None, precision='double'):
+        """
+        Returns the IncrementalStructureFactor kept for Q (r.l.u.), which is replaced when Q changes.
+        """
+        key = (fingerprint(Q), chunk, precision)
+        cached = getattr(self, '_incremental', None)
+        if cached is None or cached[0] != key:
+            d, bc = self.getAtomArrays()
+            cached = self._incremental = (key, IncrementalStructureFactor(Q, d, bc, chunk=chunk, precision=precision))
+        return cached[1]
+
+    def getNuclearStructureFactor(self, useDebyeWaller=False, squared=True, scale_factor=1., x0=1, y0=0, Q=None,
+                                  chunk=None, symmetrize=False, absences=True, incremental=False, precision='double',
+                                  workers=None, backend='direct', tol=1e-6):
         """
         Q is given in units of rlu
-        TODO:
-        * Implement Debye Waller correction.
+        The sum over atoms is performed by the fused kernel in util.kernels, blocked over Q by 'chunk' rows.
+        With symmetrize=True only the symmetry-unique reflections are evaluated (see calcNuclearStructureFactor).
+        With absences=True the systematically absent reflections are skipped and flagged in self.Fn.absent.
+        With useDebyeWaller=True the displacement parameters of the atoms are included (see setDisplacement).
+        With incremental=True only the contributions of the atoms moved since the last call are recomputed.
+        With precision='single' the calculation runs in float32/complex64 (see util.kernels for the accuracy).
+        With workers > 1 (0 for all cores), Q is split into chunks evaluated by a pool of threads.
+        With backend='nufft' and Q a grid from makeQGrid, a nonuniform FFT of accuracy tol replaces the direct sum.
         """
         if Q is None:
             Q = self.Fn.coords
-            #print(Q)
-            self.Fn.values = np.complex128(self.Fn.values+0j)
-            for atom in self.atoms:
-                # Determine the contribution to the NuclearStructure factor.
-                Fa = atom.bc * np.exp(2. * np.pi * 1j * np.einsum('...i,i',Q, atom.d))
-
-
-                if useDebyeWaller:
-                    self.Fn[Q] += Fa #* DebyeWaller_factor(self.Q, u)# where is u from?
-                else:
-                    self.Fn.values += Fa # The StructureFactorModel classes need to be fixed to do assignment properly...
+            self.Fn.values = self.Fn.values.astype(getPrecision(precision)[1])
+            # Determine the contribution of all atoms to the NuclearStructure factor at once.
+            self.Fn.values += self.calcNuclearStructureFactor(Q, chunk=chunk, symmetrize=symmetrize, absences=absences,
+                                                           useDebyeWaller=useDebyeWaller, incremental=incremental,
+                                                           precision=precision, workers=workers, backend=backend, tol=tol)
+            self.Fn.setAbsent(self.getAbsences(Q) if absences else None)
 
             if squared:
                 self.Fn.values = np.abs(self.Fn.values)**2.
                 # Units are in barn. Internally modifed by periodictable.
-                #norm = self.Fn.values[(self.Fn.coords[:,0]==x0)&(self.Fn.coords[:,2]==y0)]
-                #self.Fn.values /= norm
                 self.Fn.values *= scale_factor
-                return self.Fn # make sure numpy has implemented this correctly for complex numbers. see magnetic part for other implementation.
+                return self.Fn
             else:
                 return self.Fn
         else:
             Q = np.asanyarray(Q)
-            Fn = 0.+0j
-            for atom in self.atoms:
-                # Determine the contribution to the NuclearStructure factor.
-                Fa = atom.bc * np.exp(2. * np.pi * 1j * np.einsum('...i,i',Q, atom.d))
-
-                if useDebyeWaller:
-                    Fn += Fa #* DebyeWaller_factor(self.Q, u)# where is u from?
-                else:
-                    Fn += Fa
+            Fn = self.calcNuclearStructureFactor(Q, chunk=chunk, symmetrize=symmetrize, absences=absences,
+                                                 useDebyeWaller=useDebyeWaller, incremental=incremental,
+                                                 precision=precision, workers=workers, backend=backend, tol=tol)
+            if Q.ndim == 1:
+                Fn = Fn[0]
 
             if squared:
                 Fn2 = scale_factor*(np.abs(Fn)**2.)
-                #print("Square structure factor for "+str(Q)+" is:"+str(Fn2))
-                return Fn2
                 # Units are in barn/sr; Internally modifed by periodictable.
-
+                return Fn2
             else:
-                #print("Structure factor for "+str(Q)+" is:"+str(Fn))
                 return np.sqrt(scale_factor)*Fn
 
+    def iterNuclearStructureFactor(self, Q, budget=None, squared=False, **kwargs):
+        """
+        Yields (start, stop, F) for consecutive blocks of Q (r.l.u.), which may be any sliceable (N,3) array such as a
+        memmap or an HDF5 dataset. The block size keeps the temporaries of the kernel within the memory budget (bytes,
+        util.kernels.CHUNK_BYTES by default). kwargs are passed to calcNuclearStructureFactor; with squared=True, |F|^2
+        is yielded.
+        """
+        rows = getChunkSize(2*len(self.table), budget=budget)
+        for start, stop in iterChunks(len(Q), rows):
+            Fn = self.calcNuclearStructureFactor(np.asanyarray(Q[start:stop], dtype=float), chunk=rows, cache=False,
+                                                 **kwargs)
+            yield start, stop, (np.abs(Fn)**2. if squared else Fn)
+
+    def writeNuclearStructureFactor(self, filename, Q, dataset='Fn', coords=False, budget=None, **kwargs):
+        """
+        Writes the blocks of iterNuclearStructureFactor straight into the dataset of an HDF5 file (see
+        util.stream.writeBlocks), with the Q in dataset + '_Q' if coords=True. Returns the number of rows written.
+        """
+        blocks = self.iterNuclearStructureFactor(Q, budget=budget, **kwargs)
+        return writeBlocks(filename, blocks, len(Q), dataset=dataset, coords=Q if coords else None)
+
     def claimChildren(self, family=['atoms']):
         """
         This is performed in the init stage so that all consitituents of the Nuclear Structure may back-refernece it by name.
@@ -512,6 +839,8 @@ class Crystal(object):
 
         # Initialize the data container
         self.data = {}
+        self._phases = OrderedDict()
+        self.phasecaching = False
         self.Qm = None
         self.Fm_exp = None
         self.Qn = None
@@ -648,6 +977,168 @@ class Crystal(object):
             print("No valid input type string. Sorry!")
         return
 
+    def getPowderReflections(self, dmin, dmax=np.inf, nuclear=True, magnetic=True, useDebyeWaller=False,
+                             precision='double', workers=None):
+        """
+        Returns the symmetry-unique nuclear and magnetic Reflections (see powder.Reflections) with d-spacings between
+        dmin and dmax (Ang.), sorted by decreasing d-spacing. The systematic absences are left out.
+        The magnetic reflections are found at h + k for each propagation vector k of self.magnetic; the satellites at
+        h - k have the same |Q| and intensity and are counted in the multiplicity unless k = -k (mod 1).
+        """
+        lattice = self.nuclear.lattice
+        parts = []
+        if nuclear:
+            Q = makeShell(lattice.B, dmin, dmax)
+            reduction = self.nuclear.getLaueReduction(Q)
+            Qu = reduction.unique
+            Fn = self.nuclear.calcNuclearStructureFactor(Qu, absences=False, useDebyeWaller=useDebyeWaller,
+                                                         precision=precision, workers=workers)
+            absent = self.nuclear.getAbsences(Qu)
+            keep = np.ones(len(Qu), dtype=bool) if absent is None else np.logical_not(absent)
+            parts.append(Reflections(Qu[keep], lattice.dspacing(Qu)[keep], reduction.multiplicity[keep],
+                                     np.abs(Fn[keep])**2., np.zeros(keep.sum(), dtype=bool)))
+
+        magstructure = getattr(self, 'magnetic', None)
+        if magnetic and (magstructure is not None):
+            for k in magstructure.qms:
+                k = np.asanyarray(k, dtype=float).reshape(3)
+                Q = makeShell(lattice.B, dmin, dmax, offset=k)
+                reduction = magstructure.getLaueReduction(Q)
+                Qu = reduction.unique
+                F2 = magstructure.calcMagneticIntensity(Qu, precision=precision, workers=workers)
+                pairs = 1 if np.allclose(2.*k, np.round(2.*k)) else 2
+                parts.append(Reflections(Qu, lattice.dspacing(Qu), pairs*reduction.multiplicity, np.asarray(F2, float),
+                                         np.ones(len(Qu), dtype=bool)))
+        return Reflections.concatenate(parts)
+
+    def getPowderPattern(self, x, instrument, axis='tth', dmin=None, dmax=None, scale=1., components=False, **kwargs):
+        """
+        Returns the powder pattern on the sorted axis x, in 2 theta (deg., axis='tth') or |Q| (inv. Ang., axis='Q'),
+        measured with a powder.PowderInstrument. By default all reflections whose peaks reach into x are included.
+        With components=True the nuclear and magnetic patterns are returned separately.
+        kwargs are passed to getPowderReflections.
+        """
+        instrument.checkAxis(axis)
+        if (dmin is None) or (dmax is None):
+            drange = instrument.getDRange(x, axis=axis)
+            dmin = drange[0] if dmin is None else dmin
+            dmax = drange[1] if dmax is None else dmax
+        reflections = self.getPowderReflections(dmin, dmax, **kwargs)
+        if not components:
+            return renderPattern(x, reflections, instrument, axis=axis, scale=scale)
+        return tuple(renderPattern(x, Reflections(*[field[mask] for field in reflections]), instrument, axis=axis,
+                                   scale=scale) for mask in (np.logical_not(reflections.magnetic), reflections.magnetic))
+
+    def getPhaseMatrix(self, Q, precision='double', workers=None):
+        """
+        Returns the read-only phase matrix exp(2 pi i Q D^T) (N, Natoms) of all atoms of the nuclear structure at Q
+        (r.l.u.), which the nuclear and magnetic structure factors share (the magnetic atoms are a subset of its
+        columns, see MagneticStructure.getAtomColumns), while phase caching is on (see setPhaseCaching).
+        The matrices are kept, keyed by Q, the atomic positions and the precision, up to PHASE_CACHE_BYTES in total with
+        the least recently used dropped first, so e.g. a refinement of the moments or the scattering lengths evaluates
+        the phases only once. Returns None if caching is off or the matrix alone exceeds the budget, in which case the
+        kernels evaluate the phases chunk by chunk (and only those of the magnetic atoms for the magnetic kernels).
+        """
+        if not self.phasecaching:
+            return None
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        d = self.nuclear.table.d
+        ctype = getPrecision(precision)[1]
+        nbytes = len(Q) * len(d) * np.dtype(ctype).itemsize
+        if nbytes > PHASE_CACHE_BYTES:
+            return None
+        key = (fingerprint(Q), fingerprint(d), precision)
+        phases = self._phases
+        if key in phases:
+            phases.move_to_end(key)
+            return phases[key]
+
+        E = np.empty((len(Q), len(d)), dtype=ctype)
+        def block(start, stop):
+            E[start:stop] = phaseMatrix(Q[start:stop], d, precision=precision)
+        mapChunks(block, len(Q), getParallelChunkSize(len(Q), len(d), np.dtype(ctype).itemsize, workers), workers)
+        E.flags.writeable = False
+        while phases and sum(E.nbytes for E in phases.values()) + nbytes > PHASE_CACHE_BYTES:
+            phases.popitem(last=False)
+        phases[key] = E
+        return E
+
+    def setPhaseCaching(self, enabled=True):
+        """
+        Turns the phase matrix cache (see getPhaseMatrix) on or off; turning it off drops the kept matrices.
+        It is meant for loops evaluating the same Q over and over, e.g. refinements (refineMagneticStructure of the
+        MagneticStructure turns it on while it runs); one-off and streamed evaluations do not profit from it.
+        Returns the previous setting.
+        """
+        previous = self.phasecaching
+        self.phasecaching = bool(enabled)
+        if not enabled:
+            self.clearPhaseMatrices()
+        return previous
+
+    def clearPhaseMatrices(self):
+        """
+        Drops the kept phase matrices (see getPhaseMatrix).
+        """
+        self._phases.clear()
+        return
+
+    def getPolarizedAmplitudes(self, Q, useDebyeWaller=False, precision='double', workers=None, **kwargs):
+        """
+        Returns the nuclear amplitudes N (N,) and the magnetic interaction vectors M_perp (N,3) in sqrt(barn), and the
+        chiral terms i (M_perp x M_perp^*) (N,3) in barn, at Q (r.l.u.) in the Cartesian frame of rlu2ang.
+        Both amplitudes come from one phase matrix over all atoms, with the magnetic atoms as a subset of its columns
+        (see util.kernels.sharedStructureFactors). N is set to zero at the systematic absences and off the integer
+        lattice, e.g. at the satellites of k != 0, where it does not interfere with the magnetic scattering.
+        The amplitudes of the last Q are kept until Q or the structure change, so that any number of polarizations
+        (see getPolarizedCrossSections) cost one evaluation. kwargs (e.g. k, interpolate) are passed to
+        MagneticStructure.getScatteringArrays.
+        """
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        nuclear, magnetic = self.nuclear, self.magnetic
+        d, bc = nuclear.getAtomArrays()
+        dm, m, f, fspecies = magnetic.getScatteringArrays(Q, **kwargs)
+        U = nuclear.getDisplacementArrays() if useDebyeWaller else None
+        key = (fingerprint(Q), fingerprint(d), fingerprint(bc), fingerprint(m), fingerprint(f),
+               None if U is None else fingerprint(U), precision)
+        cached = getattr(self, '_polarized', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        T, species = nuclear.getDebyeWaller(Q) if useDebyeWaller else (None, None)
+        Fn, Fm = sharedStructureFactors(Q, d, bc, m, magnetic.getAtomColumns(), f=f, species=fspecies, T=T,
+                                        Tspecies=species, precision=precision, workers=workers,
+                                        phases=self.getPhaseMatrix(Q, precision=precision, workers=workers))
+        offlattice = np.any(np.abs(Q - np.round(Q)) > 1e-6, axis=1)
+        absent = nuclear.getAbsences(Q)
+        Fn[offlattice if absent is None else (offlattice | absent)] = 0.
+        M, C = magneticInteractionVector(Fm, nuclear.lattice.unit(Q), chiral=True)
+        amplitudes = (Fn, M, C)
+        for amplitude in amplitudes:
+            amplitude.flags.writeable = False
+        self._polarized = (key, amplitudes)
+        return amplitudes
+
+    def getPolarizedCrossSections(self, Q, P=None, plane='hhl', chiral=True, **kwargs):
+        """
+        Returns the polarized cross sections (see polarization.CrossSections) at Q (r.l.u.) for the unit polarization
+        P, a Cartesian vector (3,) or one per Q (N,3) in the frame of rlu2ang.
+        Without P, all channels of the XYZ method are returned as (3, N) arrays, for P along x (parallel to Q), y and z
+        (the normal of the scattering plane, given as a plane string such as 'hhl' or by two vectors in r.l.u.).
+        With chiral=False the chiral term is left out, as for a structure without net chirality (e.g. equal domains).
+        kwargs are passed to getPolarizedAmplitudes.
+        """
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        N, M, C = self.getPolarizedAmplitudes(Q, **kwargs)
+        if P is None:
+            axes = planeVectors(plane) if isinstance(plane, str) else plane
+            u, v = self.nuclear.rlu2ang(np.asanyarray(axes, dtype=float).reshape((2, 3)))
+            P = getPolarizationFrame(self.nuclear.rlu2ang(Q), np.cross(u, v))
+        else:
+            P = np.asanyarray(P, dtype=float)
+            P = P / np.linalg.norm(P, axis=-1, keepdims=True)
+        return getCrossSections(N, M, P, C=C if chiral else None)
+
     def rietveld_refinement(self, Nreps_fit=[], Qs_fit=None):
         """
         Driver for the refinement
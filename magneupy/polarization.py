@@ -0,0 +1,78 @@
+"""
+Polarized neutron cross sections from the nuclear amplitude N and the magnetic interaction vector M_perp at the same Q.
+With the scattering amplitude N + sigma.M_perp and the neutron polarization along the unit vector P, the channels are
+(Blume, Phys. Rev. 130, 1670 (1963); Maleev et al., Sov. Phys. Solid State 4, 2533 (1963))
+
+    non spin flip:  sigma(++) = |N + P.M_perp|^2             sigma(--) = |N - P.M_perp|^2
+    spin flip:      sigma(+-) = |M_perp|^2 - |P.M_perp|^2 - P.C   sigma(-+) = |M_perp|^2 - |P.M_perp|^2 + P.C
+
+where C = i (M_perp x M_perp^*) is the chiral term, real and parallel to Q. All channels are evaluated for whole arrays
+of Q at once, for one polarization or the stacked x, y, z of the XYZ method.
+"""
+from collections import namedtuple
+import numpy as np
+
+
+class CrossSections(namedtuple('CrossSections', ['pp', 'mm', 'pm', 'mp'])):
+    """
+    The polarized cross sections (in barn) of the non spin flip channels (++, --) and the spin flip channels (+-, -+).
+    For the XYZ method each is a (3, N) array with the rows for P along x, y and z.
+    """
+    __slots__ = ()
+
+    @property
+    def nsf(self):
+        """The non spin flip cross section, averaged over the incident polarization."""
+        return (self.pp + self.mm) / 2.
+
+    @property
+    def sf(self):
+        """The spin flip cross section, averaged over the incident polarization."""
+        return (self.pm + self.mp) / 2.
+
+    def flippingRatio(self, analyzed=False):
+        """
+        Returns the flipping ratio: I(+)/I(-) = (++ + +-)/(-- + -+) of a polarized beam without polarization analysis,
+        or the ratio of the non spin flip channels (++)/(--) with analyzed=True.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if analyzed:
+                return self.pp / self.mm
+            return (self.pp + self.pm) / (self.mm + self.mp)
+
+
+def getPolarizationFrame(Qc, vertical):
+    """
+    Returns the XYZ frame (3, N, 3) of the polarization analysis at the Cartesian Q (N,3): x along Q, z along the
+    Cartesian vertical (the normal of the scattering plane) made perpendicular to Q, and y = z x x in the scattering
+    plane.
+    """
+    Qc = np.atleast_2d(np.asanyarray(Qc, dtype=float))
+    norm = np.linalg.norm(Qc, axis=1)
+    x = Qc / np.where(norm > 0., norm, 1.)[:, None]
+    z = np.broadcast_to(np.asanyarray(vertical, dtype=float).reshape((-1, 3)), Qc.shape)
+    z = z - np.einsum('na,na->n', z, x)[:, None] * x
+    z = z / np.linalg.norm(z, axis=1)[:, None]
+    y = np.cross(z, x)
+    return np.stack((x, y, z))
+
+
+def getCrossSections(N, M, P, C=None):
+    """
+    Returns the CrossSections of the nuclear amplitudes N (N,) and interaction vectors M_perp (N,3) for the unit
+    polarization P, either a single vector (3,), one per Q (N,3) or a stack of them (..., N, 3) such as the XYZ frame
+    from getPolarizationFrame. C is the chiral term (N,3) (see util.kernels.magneticInteractionVector) or None to leave
+    it out.
+    """
+    N = np.asanyarray(N)
+    M = np.asanyarray(M)
+    P = np.asanyarray(P, dtype=float)
+    MP = np.einsum('...a,...a->...', M, P)
+    M2 = np.einsum('na,na->n', M.real, M.real) + np.einsum('na,na->n', M.imag, M.imag)
+    MP2 = MP.real**2 + MP.imag**2
+    N2 = N.real**2 + N.imag**2
+    interference = 2.*(N.real*MP.real + N.imag*MP.imag)
+    chiral = 0. if C is None else np.einsum('...a,...a->...', np.asanyarray(C, dtype=float), P)
+    nsf = N2 + MP2
+    sf = M2 - MP2
+    return CrossSections(nsf + interference, nsf - interference, sf - chiral, sf + chiral)
@@ -0,0 +1,198 @@
+"""
+Powder diffraction patterns built from the single-crystal structure factors.
+The reflections in a d-spacing range are reduced to the symmetry-unique ones (see reciprocal.LaueReduction), weighted by
+their multiplicities and Lorentz factors, and rendered as Gaussian or pseudo-Voigt peaks on a 2 theta or |Q| axis.
+"""
+from collections import namedtuple
+import numpy as np
+
+from .util.kernels import CHUNK_BYTES
+
+AXES = ('tth', 'Q')
+
+
+class Reflections(namedtuple('Reflections', ['Q', 'dspacing', 'multiplicity', 'F2', 'magnetic'])):
+    """
+    The symmetry-unique reflections of a powder pattern.
+    ----------
+    Attributes:
+    Q: (N,3) representative reflections in r.l.u.
+    dspacing: d-spacings (Ang.)
+    multiplicity: the number of equivalent reflections in the shell, including the -k satellites of magnetic reflections
+    F2: |F|^2 (nuclear) or |M_perp|^2 (magnetic) of a single reflection, in barn
+    magnetic: whether the reflection is magnetic
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.dspacing)
+
+    @classmethod
+    def concatenate(cls, reflections):
+        """
+        Joins several Reflections and sorts them by decreasing d-spacing.
+        """
+        reflections = list(reflections)
+        if not reflections:
+            return cls(np.zeros((0, 3)), np.zeros(0), np.zeros(0, dtype=int), np.zeros(0), np.zeros(0, dtype=bool))
+        fields = [np.concatenate([getattr(r, name) for r in reflections]) for name in cls._fields]
+        order = np.argsort(-fields[1], kind='stable')
+        return cls(*[field[order] for field in fields])
+
+
+class PowderInstrument(object):
+    """
+    The geometry and resolution of a powder diffractometer.
+    The full widths at half maximum follow Caglioti, FWHM^2 = U tan^2(theta) + V tan(theta) + W (deg.^2), for a
+    constant wavelength (Ang.). Without a wavelength only |Q| patterns are possible and the widths are set by the
+    relative resolution dQ/Q (e.g. for time of flight), which may also be used with a wavelength.
+    The peaks are pseudo-Voigt functions with the Lorentzian fraction eta (0 for Gaussian peaks).
+    """
+    def __init__(self, wavelength=None, U=0., V=0., W=1e-2, eta=0., resolution=None, window=None):
+        """
+        window is the half width (in FWHM) over which each peak is rendered. By default this is 5 for Gaussian peaks
+        and 50 with a Lorentzian fraction, which misses about eta*0.6% of the area of each peak in the tails.
+        """
+        self.wavelength = wavelength
+        self.U, self.V, self.W = U, V, W
+        self.eta = eta
+        self.resolution = resolution
+        self.window = (5. if eta == 0. else 50.) if window is None else window
+        return
+
+    def checkAxis(self, axis):
+        """"""
+        if axis not in AXES:
+            raise ValueError("The axis must be 'tth' (deg.) or 'Q' (inv. Ang.), not " + str(axis))
+        if (axis == 'tth') and (self.wavelength is None):
+            raise ValueError('A wavelength is needed for a 2 theta pattern.')
+        if (self.wavelength is None) and (self.resolution is None):
+            raise ValueError('Without a wavelength the widths are given by the resolution dQ/Q.')
+        return
+
+    def getTheta(self, d):
+        """
+        Returns the Bragg angles theta (rad.) of the d-spacings (Ang.), nan for reflections beyond 2 theta = 180 deg.
+        """
+        s = self.wavelength / (2.*np.asanyarray(d, dtype=float))
+        with np.errstate(invalid='ignore'):
+            return np.arcsin(np.where(s <= 1., s, np.nan))
+
+    def getPosition(self, d, axis='tth'):
+        """
+        Returns the positions of the reflections with d-spacings d (Ang.) on the axis.
+        """
+        if axis == 'tth':
+            return np.degrees(2.*self.getTheta(d))
+        return 2.*np.pi / np.asanyarray(d, dtype=float)
+
+    def getDSpacing(self, x, axis='tth'):
+        """
+        Returns the d-spacings (Ang.) at the positions x on the axis.
+        """
+        x = np.asanyarray(x, dtype=float)
+        if axis == 'tth':
+            with np.errstate(divide='ignore'):
+                return self.wavelength / (2.*np.sin(np.radians(x)/2.))
+        with np.errstate(divide='ignore'):
+            return 2.*np.pi / x
+
+    def getWidth(self, d, axis='tth'):
+        """
+        Returns the FWHM of the reflections with d-spacings d (Ang.) on the axis.
+        """
+        d = np.asanyarray(d, dtype=float)
+        if self.resolution is not None:
+            fwhm = self.resolution * 2.*np.pi / d
+            return fwhm if axis == 'Q' else np.degrees(fwhm / (2.*np.pi/self.wavelength*np.cos(self.getTheta(d))))
+        t = np.tan(self.getTheta(d))
+        fwhm = np.sqrt(np.maximum(self.U*t**2. + self.V*t + self.W, 0.))
+        # dQ = (2 pi/lambda) cos(theta) d(2 theta)
+        return fwhm if axis == 'tth' else 2.*np.pi/self.wavelength * np.cos(self.getTheta(d)) * np.radians(fwhm)
+
+    def getLorentzFactor(self, d):
+        """
+        Returns the Lorentz factors of the integrated intensities of powder reflections with d-spacings d (Ang.):
+        1/(sin(theta) sin(2 theta)) for a constant wavelength, d^2 = (2 pi/|Q|)^2 otherwise.
+        """
+        d = np.asanyarray(d, dtype=float)
+        if self.wavelength is None:
+            return d**2.
+        theta = self.getTheta(d)
+        return 1. / (np.sin(theta) * np.sin(2.*theta))
+
+    def getDRange(self, x, axis='tth'):
+        """
+        Returns the range of d-spacings (Ang.) of the reflections whose peaks reach into the sorted axis x.
+        """
+        x = np.asanyarray(x, dtype=float)
+        d = self.getDSpacing(x[[0, -1]], axis=axis)
+        lo, hi = x[0], x[-1]
+        with np.errstate(invalid='ignore'):
+            lo -= np.nan_to_num(self.window * self.getWidth(d[0], axis=axis))
+            hi += np.nan_to_num(self.window * self.getWidth(d[1], axis=axis))
+        if axis == 'tth':
+            lo, hi = max(lo, 0.), min(hi, 180.)
+        else:
+            lo = max(lo, 0.)
+        dmax, dmin = self.getDSpacing([lo, hi], axis=axis)
+        return dmin, dmax
+
+
+def pseudoVoigt(dx, fwhm, eta=0.):
+    """
+    Returns the pseudo-Voigt function of unit area, (1-eta) G(dx) + eta L(dx), with the Gaussian G and the Lorentzian
+    L of the same FWHM.
+    """
+    dx = np.asanyarray(dx, dtype=float)
+    fwhm = np.asanyarray(fwhm, dtype=float)
+    x2 = (2.*dx/fwhm)**2.
+    y = (1.-eta) * np.sqrt(4.*np.log(2.)/np.pi)/fwhm * np.exp(-np.log(2.)*x2)
+    if np.any(eta):
+        y = y + eta * (2./(np.pi*fwhm)) / (1. + x2)
+    return y
+
+
+def splatPeaks(x, centers, areas, fwhm, eta=0., window=5., budget=None):
+    """
+    Renders peaks of the given centers, areas and FWHM onto the sorted axis x and returns the summed profile.
+    Each peak is only evaluated within window FWHM of its center. All points of a block of peaks are evaluated at once
+    and accumulated with bincount, with the blocks sized to the memory budget (bytes, util.kernels.CHUNK_BYTES by
+    default).
+    """
+    x = np.asanyarray(x, dtype=float)
+    centers = np.asanyarray(centers, dtype=float).reshape(-1)
+    areas = np.broadcast_to(np.asanyarray(areas, dtype=float), centers.shape)
+    fwhm = np.broadcast_to(np.asanyarray(fwhm, dtype=float), centers.shape)
+    ok = np.isfinite(centers) & np.isfinite(fwhm) & (fwhm > 0.) & (areas != 0.)
+    centers, areas, fwhm = centers[ok], areas[ok], fwhm[ok]
+
+    lo = np.searchsorted(x, centers - window*fwhm, side='left')
+    hi = np.searchsorted(x, centers + window*fwhm, side='right')
+    n = hi - lo
+    # About six float temporaries per rendered point
+    limit = max(int((CHUNK_BYTES if budget is None else budget) // 48), int(n.max(initial=1)))
+    ends = np.cumsum(n)
+    y = np.zeros(len(x))
+    start = 0
+    while start < len(n):
+        stop = max(int(np.searchsorted(ends, ends[start] - n[start] + limit, side='right')), start + 1)
+        nb = n[start:stop]
+        peak = np.repeat(np.arange(start, stop), nb)
+        idx = np.arange(nb.sum()) - np.repeat(np.cumsum(nb) - nb, nb) + lo[peak]
+        values = areas[peak] * pseudoVoigt(x[idx] - centers[peak], fwhm[peak], eta)
+        y += np.bincount(idx, weights=values, minlength=len(x))
+        start = stop
+    return y
+
+
+def renderPattern(x, reflections, instrument, axis='tth', scale=1.):
+    """
+    Returns the powder profile on the sorted axis x of the Reflections measured with the PowderInstrument.
+    The integrated intensity of each peak is scale * multiplicity * |F|^2 * Lorentz factor.
+    """
+    instrument.checkAxis(axis)
+    d = reflections.dspacing
+    areas = scale * reflections.multiplicity * reflections.F2 * instrument.getLorentzFactor(d)
+    return splatPeaks(x, instrument.getPosition(d, axis=axis), areas, instrument.getWidth(d, axis=axis),
+                      eta=instrument.eta, window=instrument.window)
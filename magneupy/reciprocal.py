@@ -1,3 +1,489 @@
 """
-Placeholder for classes defining the reciprocal given a nuclear structure.
-"""
\ No newline at end of file
+Classes and functions defining the reciprocal space of a nuclear structure.
+"""
+import re
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from .util.kernels import getChunkSize
+from .util.functions import fingerprint
+
+
+class ReciprocalLattice(object):
+    """
+    Conversion service between r.l.u. and inv. Ang. for any (triclinic) lattice. With the rows of B being the
+    reciprocal basis vectors (a*, b*, c*) including the factor 2 pi, Q (inv. Ang.) = Q (r.l.u.) B.
+    |Q|, the unit vectors and the d-spacings are memoized for the last few Q arrays (keyed by their content).
+    None of the conversions modify their input.
+    """
+    def __init__(self, recip, maxsize=8):
+        """"""
+        self.B = np.array(recip, dtype=float).reshape((3, 3))
+        self.Binv = np.linalg.inv(self.B)
+        self.G = np.dot(self.B, self.B.T)  # reciprocal metric tensor
+        self.maxsize = maxsize
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+    def _getMemo(self, Q):
+        """
+        Returns the dict of memoized quantities for this Q array. This is safe to call from several threads.
+        """
+        key = fingerprint(Q)
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+            else:
+                self._memo[key] = {}
+                while len(self._memo) > self.maxsize:
+                    self._memo.popitem(last=False)
+            return self._memo[key]
+
+    def rlu2ang(self, Q):
+        """Returns Q (r.l.u.) in inv. Ang. as a new (N,3) array."""
+        return np.dot(np.atleast_2d(np.asanyarray(Q, dtype=float)), self.B)
+
+    def ang2rlu(self, Q):
+        """Returns Q (inv. Ang.) in r.l.u. as a new (N,3) array."""
+        return np.dot(np.atleast_2d(np.asanyarray(Q, dtype=float)), self.Binv)
+
+    def norm(self, Q):
+        """Returns |Q| (inv. Ang.) for Q in r.l.u."""
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        memo = self._getMemo(Q)
+        if 'norm' not in memo:
+            memo['norm'] = np.sqrt(np.einsum('ij,jk,ik->i', Q, self.G, Q))
+            memo['norm'].flags.writeable = False
+        return memo['norm']
+
+    def unit(self, Q):
+        """Returns the Cartesian unit vectors along Q (r.l.u.), with zero vectors for Q = 0."""
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        memo = self._getMemo(Q)
+        if 'unit' not in memo:
+            Qnorm = self.norm(Q).copy()
+            Qnorm[Qnorm == 0.] = 1.
+            memo['unit'] = self.rlu2ang(Q) / Qnorm[:, None]
+            memo['unit'].flags.writeable = False
+        return memo['unit']
+
+    def dspacing(self, Q):
+        """Returns the d-spacings 2 pi/|Q| (Ang.) for Q in r.l.u., inf for Q = 0."""
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        memo = self._getMemo(Q)
+        if 'dspacing' not in memo:
+            with np.errstate(divide='ignore'):
+                memo['dspacing'] = 2.*np.pi / self.norm(Q)
+            memo['dspacing'].flags.writeable = False
+        return memo['dspacing']
+
+
+def planeVectors(plane):
+    """
+    Translates a human intuitive plane string into the axis vectors spanning it, e.g. 'hhl' -> (1,1,0), (0,0,1).
+    Each distinct letter (in order of appearance) gives one axis, so 'hkl' spans the full volume.
+    """
+    plane = str(plane).lower()
+    if len(plane) != 3 or not set(plane) <= set('hkl0'):
+        raise ValueError("The plane should be given by three of the characters 'h', 'k', 'l' or '0', e.g. 'hhl'.")
+    axes = []
+    for letter in plane:
+        if letter != '0' and not any(letter == done for done, _ in axes):
+            axes.append((letter, np.array([float(c == letter) for c in plane])))
+    return [axis for _, axis in axes]
+
+
+def combineAxes(axes, values, origin=None):
+    """
+    Returns the contiguous (N,3) array of points origin + sum_i values_i * axes_i over the outer product of the
+    coefficient arrays (the first axis varies slowest).
+    """
+    axes = [np.asanyarray(axis, dtype=float).reshape(3) for axis in axes]
+    values = [np.asanyarray(vals, dtype=float).reshape(-1) for vals in values]
+    shape = tuple(len(vals) for vals in values)
+    Q = np.zeros(shape + (3,))
+    if origin is not None:
+        Q += np.asanyarray(origin, dtype=float).reshape(3)
+    for i, (axis, vals) in enumerate(zip(axes, values)):
+        idx = [None]*len(axes)
+        idx[i] = slice(None)
+        Q += vals[tuple(idx)][..., None] * axis
+    return Q.reshape((-1, 3))
+
+
+def axisValues(qrange, step):
+    """
+    Returns the coefficients from qrange[0] to qrange[1] (inclusive) in increments of step.
+    """
+    lo, hi = qrange
+    if step <= 0:
+        raise ValueError('The step must be positive.')
+    n = int(np.floor((hi - lo) / step + 1e-9)) + 1
+    return lo + step*np.arange(max(n, 0))
+
+
+class QGrid(np.ndarray):
+    """
+    The (N,3) points in r.l.u. of a regular grid origin + sum_a n_a steps_a (n_a = 0..gridshape_a-1, the first axis
+    varying slowest) as returned by makeGrid, remembering the origin (3,), steps (D,3) and gridshape (D,) of the grid,
+    e.g. for the NUFFT backend. Arrays derived from a QGrid (slices, copies, arithmetic) lose the grid description.
+    """
+    def __new__(cls, Q, origin, steps, gridshape):
+        """"""
+        grid = np.ascontiguousarray(Q, dtype=float).view(cls)
+        grid.origin = np.asanyarray(origin, dtype=float).reshape(3)
+        grid.steps = np.asanyarray(steps, dtype=float).reshape((-1, 3))
+        grid.gridshape = tuple(int(n) for n in gridshape)
+        assert(len(grid) == int(np.prod(grid.gridshape)))
+        return grid
+
+    def __array_finalize__(self, obj):
+        self.origin = None
+        self.steps = None
+        self.gridshape = None
+        return
+
+    @property
+    def isGrid(self):
+        """Whether the grid description is (still) valid for these points."""
+        return self.gridshape is not None
+
+
+def makeGrid(u, v=None, w=None, urange=(-4, 4), vrange=None, wrange=None, step=1., origin=None,
+             Qmax=None, dmin=None, recip=None):
+    """
+    Builds the points origin + a*u + b*v (+ c*w) for the coefficients a, b, c running over urange, vrange and wrange.
+    Leaving out w gives the plane spanned by u and v; leaving out v as well gives a line.
+    ----------
+    step:   a single step, or one step per axis
+    Qmax:   keep only points with |Q| <= Qmax (inv. Ang.)
+    dmin:   keep only points with d >= dmin (Ang.)
+    recip:  the reciprocal basis vectors (a*, b*, c*) in inv. Ang., needed for the Qmax and dmin cutoffs
+    ----------
+    Returns a contiguous (N,3) array in r.l.u., which is a QGrid unless points were removed by the cutoffs.
+    """
+    axes = [ax for ax in (u, v, w) if ax is not None]
+    ranges = [urange, urange if vrange is None else vrange, urange if wrange is None else wrange][:len(axes)]
+    steps = np.asanyarray(step, dtype=float).reshape(-1)
+    steps = np.repeat(steps, len(axes)) if len(steps) == 1 else steps
+    if len(steps) != len(axes):
+        raise ValueError('Give a single step or one step per axis.')
+    values = [axisValues(r, s) for r, s in zip(ranges, steps)]
+    Q = combineAxes(axes, values, origin=origin)
+
+    if (Qmax is None) and (dmin is None) and all(len(vals) for vals in values):
+        # Keep the description of the regular grid
+        start = combineAxes(axes, [vals[:1] for vals in values], origin=origin)
+        steps = [s * np.asanyarray(axis, dtype=float) for s, axis in zip(steps, axes)]
+        return QGrid(Q, start, steps, [len(vals) for vals in values])
+    elif (Qmax is not None) or (dmin is not None):
+        if recip is None:
+            raise ValueError('The reciprocal basis (recip) is needed for the Qmax and dmin cutoffs.')
+        Qcut = np.inf if Qmax is None else Qmax
+        Qcut = Qcut if dmin is None else min(Qcut, 2.*np.pi/dmin)
+        Qc = np.dot(Q, np.asanyarray(recip, dtype=float))
+        Q = Q[np.einsum('ij,ij->i', Qc, Qc) <= Qcut**2.]
+    return np.ascontiguousarray(Q)
+
+
+def makeShell(recip, dmin, dmax=np.inf, offset=None):
+    """
+    Builds all points h + offset (h integer) with d-spacings dmin <= d <= dmax (Ang.), i.e. the reflections within a
+    shell of reciprocal space, e.g. for a powder pattern. Q = 0 is never included.
+    ----------
+    recip:  the reciprocal basis vectors (a*, b*, c*) in inv. Ang.
+    offset: a propagation vector (r.l.u.) added to every point
+    ----------
+    Returns a contiguous (N,3) array in r.l.u.
+    """
+    B = np.asanyarray(recip, dtype=float).reshape((3, 3))
+    offset = np.zeros(3) if offset is None else np.asanyarray(offset, dtype=float).reshape(3)
+    Qmax = 2.*np.pi/dmin
+    Qmin = 0. if dmax is None or np.isinf(dmax) else 2.*np.pi/dmax
+    # |h_i + k_i| = |Q.a_i|/2 pi <= Qmax |a_i|/2 pi, with the direct vectors a_i the columns of 2 pi B^-1
+    amax = Qmax * np.linalg.norm(np.linalg.inv(B), axis=0)
+    values = [np.arange(np.ceil(-a - k), np.floor(a - k) + 1.) for a, k in zip(amax, offset)]
+    Q = combineAxes(np.eye(3), values, origin=offset)
+    Q2 = np.einsum('ij,ij->i', np.dot(Q, B), np.dot(Q, B))
+    keep = (Q2 <= Qmax**2.) & (Q2 >= Qmin**2.) & (Q2 > 0.)
+    return np.ascontiguousarray(Q[keep])
+
+
+class SatelliteTable(object):
+    """
+    The magnetic reflections Q = hkl + s k_n (s = +1 or -1) of a set of parent reflections hkl and propagation vectors
+    k_n, built and sorted by |Q| once. Each row keeps its parent reflection, k index and sign, and the rows of each
+    satellite (k_n, s) are grouped, and group holds the index into groups of each row, so that the magnetic structure
+    factor of a multi-k structure is evaluated with the Fourier components of k_n (their complex conjugates for s = -1)
+    of each row.
+    """
+    def __init__(self, hkl, ks, pairs=True, lattice=None, tol=1e-6):
+        """
+        With pairs=True, the -k_n satellites are included as well unless -k_n = k_n (mod 1). The rows are sorted by |Q|
+        if a ReciprocalLattice is given, and otherwise ordered by satellite, then parent.
+        """
+        hkl = np.atleast_2d(np.asanyarray(hkl, dtype=float))
+        ks = np.asanyarray(ks, dtype=float).reshape((-1, 3))
+        signed = []
+        for n, k in enumerate(ks):
+            signed.append((n, 1))
+            if pairs and not np.allclose(2.*k, np.round(2.*k), atol=tol):
+                signed.append((n, -1))
+        kindex = np.repeat([n for n, s in signed], len(hkl))
+        sign = np.repeat([s for n, s in signed], len(hkl))
+        parent = np.tile(np.arange(len(hkl)), len(signed))
+        Q = hkl[parent] + sign[:, None]*ks[kindex]
+        order = np.arange(len(Q)) if lattice is None else np.argsort(lattice.norm(Q))
+
+        self.ks = ks
+        self.Q = np.ascontiguousarray(Q[order])
+        self.parent = parent[order]
+        self.hkl = hkl[self.parent]
+        self.kindex = kindex[order]
+        self.sign = sign[order]
+        self.groups = [(n, s, np.where((self.kindex == n) & (self.sign == s))[0]) for n, s in signed]
+        self.group = np.empty(len(self.Q), dtype=int)
+        for g, (n, s, rows) in enumerate(self.groups):
+            self.group[rows] = g
+        return
+
+    def __len__(self):
+        return len(self.Q)
+
+
+def getCommensurability(k, maxorder=48, tol=1e-6):
+    """
+    Returns the smallest integer D such that D k is a reciprocal lattice vector, so that the phases exp(2 pi i k.l) of
+    the lattice translations l are the D-th roots of unity, or 0 if k is incommensurate (no D up to maxorder).
+    """
+    k = np.asanyarray(k, dtype=float).reshape(-1)
+    for D in range(1, maxorder + 1):
+        if np.allclose(D*k, np.round(D*k), atol=tol):
+            return D
+    return 0
+
+
+def parseSymmetryOperation(xyz):
+    """
+    Returns the rotation (3,3) and translation (3,) of an operation written as an xyz string of a CIF, e.g.
+    '-x+y, -x, z+1/2', so that the operations of a CIF are read without pymatgen.
+    """
+    parts = xyz.lower().replace(' ', '').replace("'", '').split(',')
+    if len(parts) != 3:
+        raise ValueError('Cannot parse the symmetry operation ' + repr(xyz))
+    R = np.zeros((3, 3))
+    t = np.zeros(3)
+
+    def number(term):
+        num, slash, den = term.partition('/')
+        return float(num) / (float(den) if slash else 1.)
+
+    for i, part in enumerate(parts):
+        for term in re.findall(r'[+-]?[^+-]+', part):
+            sign = -1. if term[0] == '-' else 1.
+            term = term.lstrip('+-')
+            if term[-1] in 'xyz':
+                coeff = term[:-1].rstrip('*')
+                R[i, 'xyz'.index(term[-1])] += sign * (number(coeff) if coeff else 1.)
+            else:
+                t[i] += sign * number(term)
+    return R, t
+
+
+def getSymmetryOperations(spacegroup=None, xyz=None):
+    """
+    Returns the rotations (Nops,3,3) and translations (Nops,3) of the space group acting on fractional coordinates as
+    x' = R x + t, with the identity first. The operations listed in a CIF (xyz strings, e.g. '-y, x, z+1/2') are used
+    when given since they match the setting of the atomic coordinates. Otherwise they are generated by pymatgen from
+    the H-M symbol, which is only imported then.
+    """
+    if xyz:
+        R, t = zip(*[parseSymmetryOperation(op) for op in xyz])
+    elif spacegroup is not None:
+        from pymatgen.symmetry.groups import SpaceGroup
+        ops = list(SpaceGroup(spacegroup).symmetry_ops)
+        R, t = [op.rotation_matrix for op in ops], [op.translation_vector for op in ops]
+    else:
+        raise ValueError('Need either the H-M symbol or the xyz strings of the space group.')
+    R = np.round(np.array(R, dtype=float))
+    t = np.array(t, dtype=float) % 1.
+    t[np.isclose(t, 1.)] = 0.
+
+    # Sort for reproducibility, identity first
+    notidentity = np.any(R.reshape((-1, 9)) != np.eye(3).reshape(9), axis=1) | np.any(t != 0., axis=1)
+    keys = np.column_stack((t, R.reshape((-1, 9)), notidentity)).T
+    order = np.lexsort(keys)
+    return R[order], t[order]
+
+
+def getSitePermutations(d, R, t, labels=None, tol=1e-3):
+    """
+    Finds for each operation the site p(j) and lattice vector L_j such that R d_j + t = d_p(j) + L_j.
+    If labels are given, sites can only map onto sites with the same label.
+    ----------
+    Returns perm (Nops,Natoms), which is -1 where no image was found, and L (Nops,Natoms,3).
+    """
+    d = np.atleast_2d(np.asanyarray(d, dtype=float))
+    Nat = len(d)
+    perm = -np.ones((len(R), Nat), dtype=int)
+    L = np.zeros((len(R), Nat, 3))
+    same = None if labels is None else np.equal.outer(np.asanyarray(labels), np.asanyarray(labels))
+    for k in range(len(R)):
+        diff = (np.dot(d, R[k].T) + t[k])[:, None, :] - d[None, :, :]
+        shift = np.round(diff)
+        match = np.all(np.abs(diff - shift) < tol, axis=2)
+        if same is not None:
+            match &= same
+        found = match.any(axis=1)
+        p = np.argmax(match, axis=1)
+        perm[k, found] = p[found]
+        L[k] = shift[np.arange(Nat), p]
+    return perm, L
+
+
+def getLaueOperations(R, t, L=None, friedel=True):
+    """
+    Combines the operations (R, t) with Friedel's law (-R) into the Laue operations acting on Q (as the row vector Q R)
+    and removes duplicate rotations, preferring operations that need no Friedel conjugation or lattice shifts.
+    ----------
+    L: (Nops,Natoms,3) lattice vectors from getSitePermutations. The relation between F(Q) and F(QR) only holds where
+       Q.L_j is the same for all sites modulo 1, which is always the case for integer Q.
+    ----------
+    Returns the rotations, translations, reference lattice shifts (Nops,3), the lattice shift differences
+    (list of (m,3) arrays) and Friedel flags of the Laue operations.
+    """
+    L = np.zeros((len(R), 1, 3)) if L is None else np.asanyarray(L)
+    dL = [np.unique(Lk - Lk[0], axis=0) for Lk in L]
+    dL = [dl[np.any(dl != 0., axis=1)] for dl in dL]
+
+    ops = [(Rk, tk, Lk[0], dl, False) for Rk, tk, Lk, dl in zip(R, t, L, dL)]
+    if friedel:
+        ops += [(-Rk, tk, Lk[0], dl, True) for Rk, tk, Lk, dl in zip(R, t, L, dL)]
+    ops = sorted(ops, key=lambda op: (op[4], len(op[3]) > 0))  # stable: identity stays first
+
+    laue = OrderedDict()
+    for op in ops:
+        key = tuple(op[0].astype(int).reshape(9))
+        if key not in laue:
+            laue[key] = op
+    Rl, tl, L0, dL, conj = zip(*laue.values())
+    return np.array(Rl), np.array(tl), np.array(L0), list(dL), np.array(conj)
+
+
+class LaueReduction(object):
+    """
+    Reduces a set of Q to the reflections that are unique under a set of Laue operations, keeping the index map back
+    to the full set. Structure factors are then evaluated for the unique reflections only and scattered back by expand.
+    Each point is mapped onto the lexicographically largest of its images among the operations valid at that point.
+    """
+    def __init__(self, Q, R, t=None, L0=None, dL=None, conj=None, decimals=6, chunk=None):
+        """
+        The arguments follow the output of getLaueOperations. The first operation must be the identity.
+        """
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        R = np.asanyarray(R, dtype=float)
+        Nops = len(R)
+        t = np.zeros((Nops, 3)) if t is None else np.asanyarray(t, dtype=float)
+        L0 = np.zeros((Nops, 3)) if L0 is None else np.asanyarray(L0, dtype=float)
+        dL = [np.zeros((0, 3))]*Nops if dL is None else dL
+        conj = np.zeros(Nops, dtype=bool) if conj is None else np.asanyarray(conj, dtype=bool)
+        assert(np.allclose(R[0], np.eye(3)))
+
+        N = len(Q)
+        op = np.zeros(N, dtype=int)
+        reps = np.empty((N, 3))
+        chunk = getChunkSize(Nops, itemsize=8*6) if chunk is None else chunk
+        for start in range(0, N, chunk):
+            Qc = Q[start:start+chunk]
+            images = np.round(np.einsum('ni,kij->knj', Qc, R), decimals)
+            valid = np.ones(images.shape[:2], dtype=bool)
+            for k in range(1, Nops):
+                if len(dL[k]):
+                    x = np.dot(Qc, dL[k].T)
+                    valid[k] = np.all(np.abs(x - np.round(x)) < 10.**-decimals, axis=1)
+            # Lexicographic maximum of the valid images
+            best = valid.copy()
+            for i in range(3):
+                comp = np.where(best, images[:, :, i], -np.inf)
+                best &= (comp == comp.max(axis=0))
+            k = np.argmax(best, axis=0)
+            op[start:start+chunk] = k
+            reps[start:start+chunk] = images[k, np.arange(len(Qc))]
+
+        self.Q = Q
+        self.op = op
+        self.unique, self.index, self.inverse = np.unique(reps, axis=0, return_index=True, return_inverse=True)
+        self.inverse = self.inverse.reshape(-1)
+        # Evaluate at the exact (unrounded) image of each representative
+        self.unique = np.einsum('ni,nij->nj', Q[self.index], R[op[self.index]])
+        self.conj = conj[op]
+        self.phase = np.exp(2.*np.pi*1j * np.einsum('ni,ni->n', Q, t[op] - L0[op]))
+        return
+
+    @property
+    def multiplicity(self):
+        """The number of points of the full set mapped onto each unique reflection."""
+        return np.bincount(self.inverse, minlength=len(self.unique))
+
+    def expand(self, Fu, squared=False):
+        """
+        Scatters the values computed at the unique reflections back onto the full set of Q. Complex structure factors
+        pick up the phase exp(2 pi i Q.(t-L)) of the operation (and the Friedel conjugate), which is not needed for
+        squared values.
+        """
+        F = np.asanyarray(Fu)[self.inverse]
+        if squared:
+            return F
+        F = np.where(self.conj, np.conj(F), F)
+        return F * self.phase.astype(np.result_type(F.dtype, np.complex64), copy=False)
+
+
+class ReflectionConditions(object):
+    """
+    Index of the reflection conditions of a space group (centring, glide and screw conditions).
+    An integer hkl is systematically absent when an operation (R, t) leaves it invariant (hR = h) while
+    exp(2 pi i h.t) != 1, since then F(h) = exp(2 pi i h.t) F(h) = 0.
+    """
+    def __init__(self, R, t, tol=1e-6):
+        """
+        Only the operations with a translation that is not a lattice vector can give a condition. These are kept once
+        for each distinct pair of rotation and translation.
+        """
+        R = np.asanyarray(R, dtype=float)
+        t = np.asanyarray(t, dtype=float) % 1.
+        nontrivial = np.any((t > tol) & (t < 1.-tol), axis=1)
+        ops = OrderedDict()
+        for Rk, tk in zip(R[nontrivial], t[nontrivial]):
+            ops.setdefault(tuple(np.round(np.hstack((Rk.reshape(9), tk)), 6)), (Rk, tk))
+        self.R = np.array([Rk for Rk, _ in ops.values()]).reshape((-1, 3, 3))
+        self.t = np.array([tk for _, tk in ops.values()]).reshape((-1, 3))
+        self.tol = tol
+        self._absent = None
+        return
+
+    def __len__(self):
+        return len(self.R)
+
+    def isAbsent(self, Q):
+        """
+        Returns a read-only boolean mask over Q (r.l.u.) flagging the systematically absent reflections. Non-integer Q
+        are never flagged. The mask of the last Q is kept, so that e.g. refinements which keep the symmetry do not
+        evaluate it again.
+        """
+        Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        key = fingerprint(Q)
+        cached = self._absent
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        absent = np.zeros(len(Q), dtype=bool)
+        integer = np.all(np.abs(Q - np.round(Q)) < self.tol, axis=1)
+        Qi = Q[integer]
+        for Rk, tk in zip(self.R, self.t):
+            fixed = np.all(np.abs(np.dot(Qi, Rk) - Qi) < self.tol, axis=1)
+            x = np.dot(Qi, tk)
+            absent[integer] |= fixed & (np.abs(x - np.round(x)) > self.tol)
+        absent.flags.writeable = False
+        self._absent = (key, absent)
+        return absent
@@ -821,6 +821,36 @@ class MagRepGroup(OrderedDict):
             m = bvg.getMagneticMoment(d)
         return m
 
+    def getBasisVectorGroups(self, Nrep=None):
+        """
+        Returns the BasisVectorGroups whose coefficients describe the moments and their coefficients: those of the
+        BasisVectorCollection with its coeffs if there is one, and otherwise those of the irrep Nrep (IR0 by default)
+        with their coeff, as an OrderedDict keyed by the names of the refinement parameters.
+        """
+        groups = OrderedDict()
+        if self.bvc:
+            for (key, bvg), coeff in zip(self.bvc.items(), numpy.atleast_1d(self.bvc.coeffs)):
+                groups[key] = (bvg, coeff)
+        else:
+            irrep = self['G'+str(self.IR0 if Nrep is None else Nrep)]
+            for bvg in irrep.values():
+                groups[irrep.name+'_'+bvg.name] = (bvg, bvg.coeff)
+        return groups
+
+    def scanIrreps(self, magnetic, Qm, coeffs, **kwargs):
+        """
+        Returns an OrderedDict of the intensities (K, N) at Qm of the magnetic structure (whose Crystal holds this
+        MagRepGroup) for the batch of candidate coefficient vectors coeffs[name] (K, G) of each irrep named in coeffs,
+        e.g. {'G1': ..., 'G3': ...}, with G the number of BasisVectorGroups of the irrep.
+        kwargs are passed to MagneticStructure.calcCandidateIntensities.
+        """
+        if magnetic.crystal.magrepgroup is not self:
+            raise ValueError('The magnetic structure does not belong to the Crystal of this MagRepGroup.')
+        if self.bvc:
+            raise ValueError('The irreps are scanned separately; unset the BasisVectorCollection first.')
+        return OrderedDict((name, magnetic.calcCandidateIntensities(Qm, C, Nrep=self[name].N, **kwargs))
+                           for name, C in coeffs.items())
+
     def setBasisVectorCollection(self, basisvectorcollection=None):
         """"""
         self.basisvectorcollection = basisvectorcollection
@@ -0,0 +1,92 @@
+"""
+On-disk cache of the parsed contents of CIF files, keyed by a hash of the file content.
+Reopening a known CIF reads a single npz file and skips pymatgen entirely.
+"""
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+# The cache directory can be moved with the MAGNEUPY_CACHE environment variable.
+CACHE_DIR = os.environ.get('MAGNEUPY_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'magneupy'))
+# Bumped whenever the stored fields change, so that old entries are not read.
+CACHE_VERSION = 1
+
+SPACEGROUP_KEY = '_symmetry_space_group_name_H-M'
+SYMOP_KEYS = ['_symmetry_equiv_pos_as_xyz', '_space_group_symop_operation_xyz']
+SITE_KEYS = ['matrix', 'frac_coords', 'coords', 'species', 'occupancy']
+
+
+def hashFile(filename):
+    """
+    Returns the hex digest of the content of a file.
+    """
+    with open(filename, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def getCachePath(digest, cachedir=None):
+    """"""
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    return os.path.join(cachedir, 'cif-v' + str(CACHE_VERSION) + '-' + digest + '.npz')
+
+
+def parseCIF(cifname):
+    """
+    Parses a CIF file with pymatgen into a dict of arrays: the direct lattice vectors as rows ('matrix'), the fractional
+    and Cartesian coordinates, species strings and occupancies of the sites, and the space group and symmetry
+    operations under their CIF keys.
+    """
+    from pymatgen.io.cif import CifFile, CifParser
+
+    # Use pymatgen methods to parse the CIF file.
+    cifparser = CifParser(cifname)
+    ciffile   = CifFile.from_file(cifname)
+    cifblock  = ciffile.data[list(ciffile.data.keys())[0]]
+
+    # obtain the final object from which to pull the pertinent info
+    struc = cifparser.get_structures(False)[0]
+
+    cif = dict()
+    cif['matrix'] = np.array(struc.lattice.matrix, dtype=float)
+    cif['frac_coords'] = np.array([site.frac_coords for site in struc.sites], dtype=float).reshape((-1,3))
+    cif['coords'] = np.array([site.coords for site in struc.sites], dtype=float).reshape((-1,3))
+    cif['species'] = np.array([site.species_string for site in struc.sites], dtype=str)
+    cif['occupancy'] = np.array([site.species.num_atoms for site in struc.sites], dtype=float)
+    if SPACEGROUP_KEY in cifblock.data:
+        cif[SPACEGROUP_KEY] = np.array(cifblock.data[SPACEGROUP_KEY], dtype=str)
+    for key in SYMOP_KEYS:
+        if key in cifblock.data:
+            cif[key] = np.array(list(cifblock.data[key]), dtype=str).reshape(-1)
+    return cif
+
+
+def loadCIF(cifname, cachedir=None, cache=True):
+    """
+    Returns the parsed contents of a CIF file (see parseCIF) from the cache, parsing and storing them on a miss.
+    A cache that cannot be read or written is ignored.
+    """
+    if not cache:
+        return parseCIF(cifname)
+
+    path = getCachePath(hashFile(cifname), cachedir=cachedir)
+    if os.path.exists(path):
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                cif = dict((key, npz[key]) for key in npz.files)
+            if all(key in cif for key in SITE_KEYS):
+                return cif
+        except (OSError, ValueError):
+            pass
+
+    cif = parseCIF(cifname)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that concurrent jobs never read a partial entry.
+        fd, tmpname = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **cif)
+        os.replace(tmpname, path)
+    except OSError:
+        print('Failed to write the CIF cache to ' + str(path) + '... Continuing without it.')
+    return cif
@@ -1,5 +1,7 @@
 import inspect
 import string
+import hashlib
+import numpy as np
 
 # --------------
 # Define some general helper methods
@@ -33,6 +35,14 @@ def getFamilyAttributes(obj, family, return_labels=False):
         return attrs
 
 
+def fingerprint(arr):
+    """
+    Returns a hashable fingerprint of the shape, type and content of an array, for use as a key of memoized results.
+    """
+    arr = np.ascontiguousarray(arr)
+    return arr.shape, arr.dtype.str, hashlib.blake2b(arr.view(np.uint8), digest_size=16).hexdigest()
+
+
 def stripDigits(name):
     """"""
     pstr = string.digits
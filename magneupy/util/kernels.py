@@ -0,0 +1,529 @@
+"""
+Vectorized kernels for the structure factor calculations.
+All Q are taken in r.l.u. and all coordinates as fractional coordinates.
+
+The kernels run in double precision by default. With precision='single' the phases Q.d are still formed in double and
+reduced modulo 1, and only then cast to float32, so the phase error is that of a single turn (pi 2^-24 rad) whatever
+the size of Q. The exponentials and the sums over atoms are done in complex64, which bounds the absolute error of F by
+about 1e-6 sum_j |b_j| (relative to the largest possible |F|, not to |F| itself, so weak reflections lose relative
+precision). The same holds for the magnetic structure factor with b_j replaced by |f_j m_j|.
+
+With workers > 1, the chunks of Q are evaluated in a pool of threads writing into disjoint rows of the same output.
+NumPy releases the GIL in the matrix products and the exponentials, so the threads run concurrently without copying
+any inputs or outputs between processes.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Default memory budget (in bytes) for the temporaries of a single Q chunk.
+CHUNK_BYTES = 2**26
+
+# The (float, complex) dtypes of each precision
+PRECISION = {'double': (np.float64, np.complex128), 'single': (np.float32, np.complex64)}
+
+
+def getChunkSize(ncols, itemsize=16, budget=None):
+    """
+    Returns the number of Q rows that can be evaluated at once so that an (nrows, ncols) temporary of the given
+    itemsize stays within the memory budget.
+    """
+    budget = CHUNK_BYTES if budget is None else budget
+    return max(1, int(budget // (itemsize * max(1, ncols))))
+
+
+def getWorkers(workers=None):
+    """
+    Returns the number of threads for workers: None or 1 for serial evaluation, 0 or a negative number for all cores.
+    """
+    if workers is None:
+        return 1
+    workers = int(workers)
+    return (os.cpu_count() or 1) if workers <= 0 else workers
+
+
+def getParallelChunkSize(N, ncols, itemsize=16, workers=None):
+    """
+    Returns the number of Q rows per chunk such that the temporaries of all workers together stay within the memory
+    budget, and that each worker gets at least one chunk.
+    """
+    workers = getWorkers(workers)
+    chunk = getChunkSize(ncols, itemsize=itemsize, budget=CHUNK_BYTES // workers)
+    return max(1, min(chunk, -(-N // workers)))
+
+
+def mapChunks(func, N, chunk, workers=None):
+    """
+    Calls func(start, stop) for the consecutive chunks of N rows, in a pool of threads if workers > 1.
+    The calls must write into disjoint rows of a shared output. Exceptions of the workers are raised here.
+    """
+    workers = getWorkers(workers)
+    bounds = [(start, min(start + chunk, N)) for start in range(0, N, max(1, int(chunk)))]
+    if workers == 1 or len(bounds) <= 1:
+        for start, stop in bounds:
+            func(start, stop)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(func, start, stop) for start, stop in bounds]:
+            future.result()
+    return
+
+
+def getPrecision(precision='double'):
+    """
+    Returns the (float, complex) dtypes of a precision, 'double' or 'single'.
+    """
+    try:
+        return PRECISION[precision]
+    except KeyError:
+        raise ValueError('The precision must be one of ' + str(list(PRECISION.keys())) + ', not ' + str(precision))
+
+
+def phaseMatrix(Q, d, precision='double'):
+    """
+    Returns exp(2 pi i Q D^T) (N, Natoms) for Q (N,3) in r.l.u. and fractional coordinates d (Natoms,3).
+    In single precision Q.d is reduced modulo 1 before the cast (see the module docstring).
+    """
+    if precision == 'double':
+        return np.exp(1j * np.dot(Q, 2. * np.pi * d.T))
+    ftype, ctype = getPrecision(precision)
+    x = np.dot(Q, d.T)
+    x -= np.rint(x)
+    x = np.multiply(x, 2. * np.pi, out=np.empty(x.shape, dtype=ftype), casting='same_kind')
+    # The (vectorized) real cosine and sine are much faster than the complex exponential
+    E = np.empty(x.shape, dtype=ctype)
+    np.cos(x, out=E.real)
+    np.sin(x, out=E.imag)
+    return E
+
+
+def getPhaseBlock(Q, d, start, stop, precision='double', phases=None, columns=None):
+    """
+    Returns the phase matrix of the rows start:stop of Q, taken from the precomputed phases if given (restricted to the
+    columns, if given) and evaluated by phaseMatrix otherwise.
+    """
+    if phases is None:
+        return phaseMatrix(Q[start:stop], d, precision=precision)
+    return phases[start:stop] if columns is None else phases[start:stop, columns]
+
+
+def nuclearStructureFactor(Q, d, b, chunk=None, out=None, T=None, species=None, precision='double', workers=None,
+                           phases=None):
+    """
+    Computes F(Q) = sum_j b_j exp(2 pi i Q.d_j) for all atoms at once as the matrix product exp(2 pi i Q D^T) b.
+    The product is blocked over Q so that the (chunk, Natoms) phase matrix stays within the memory budget.
+    ----------
+    Q: (N,3) array of wavevectors in r.l.u.
+    d: (Natoms,3) array of fractional coordinates
+    b: (Natoms,) array of scattering lengths
+    T: optional (N, Nspecies) table of Debye-Waller factors, with species (Natoms,) giving the column of each atom.
+       The atoms are then summed per species first, F = sum_s T_s [exp(2 pi i Q D^T) W]_s with W_js = b_j if s = species_j.
+    precision: 'double' (complex128) or 'single' (complex64, see the module docstring)
+    workers: number of threads evaluating the chunks (see getWorkers)
+    phases: optional precomputed phaseMatrix(Q, d) (N, Natoms), e.g. kept across calls, instead of evaluating the phases
+    """
+    ftype, ctype = getPrecision(precision)
+    Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+    d = np.atleast_2d(np.asanyarray(d, dtype=float))
+    b = np.asanyarray(b).reshape(-1).astype(ctype)
+    N = len(Q)
+    if out is None:
+        out = np.zeros(N, dtype=ctype)
+    if len(b) == 0:
+        return out
+    if chunk is None:
+        chunk = getParallelChunkSize(N, len(b), itemsize=np.dtype(ctype).itemsize, workers=workers)
+    if T is not None:
+        T = np.asanyarray(T).astype(ftype, copy=False)
+        W = np.zeros((len(b), T.shape[1]), dtype=ctype)
+        W[np.arange(len(b)), species] = b
+
+    def block(start, stop):
+        E = getPhaseBlock(Q, d, start, stop, precision, phases)
+        if T is None:
+            out[start:stop] = np.dot(E, b)
+        else:
+            out[start:stop] = np.einsum('ns,ns->n', np.dot(E, W), T[start:stop])
+
+    mapChunks(block, N, chunk, workers=workers)
+    return out
+
+
+def magneticStructureFactor(Q, d, m, f=None, species=None, chunk=None, out=None, precision='double', workers=None,
+                            phases=None, columns=None, groups=None):
+    """
+    Computes F_M(Q) = sum_j f_j(Q) m_j exp(2 pi i Q.d_j) for all magnetic atoms at once. The atoms are summed per
+    form factor species first, F_M = sum_s f_s [exp(2 pi i Q D^T) W]_s with W_js = m_j if s = species_j, so each block
+    of Q costs a single (chunk, Nmag) x (Nmag, 3 Nspecies) matrix product.
+    ----------
+    Q: (N,3) array of wavevectors in r.l.u.
+    d: (Nmag,3) array of fractional coordinates
+    m: (Nmag,3) array of (complex) moments, including any prefactor, or a stack (G,Nmag,3) of them with groups
+    f: optional (N, Nspecies) table of form factors, with species (Nmag,) giving the column of each atom
+    precision, workers: see nuclearStructureFactor
+    phases, columns: optional precomputed phase matrix (N, Natoms) of a set of atoms containing the magnetic ones at the
+                     columns (Nmag,), e.g. the phases shared with the nuclear structure factor
+    groups: optional (N,) index of the moments in the stack m used at each Q, e.g. the Fourier components of the
+            satellite of each row of a reciprocal.SatelliteTable; the phases are then computed once for all of them
+    ----------
+    Returns the (N,3) complex array F_M, not yet projected perpendicular to Q.
+    """
+    ftype, ctype = getPrecision(precision)
+    Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+    d = np.atleast_2d(np.asanyarray(d, dtype=float))
+    G = 1 if groups is None else len(m)
+    m = np.asanyarray(m).reshape((G, -1, 3)).astype(ctype)
+    Nmag = m.shape[1]
+    N = len(Q)
+    if out is None:
+        out = np.zeros((N, 3), dtype=ctype)
+    if Nmag == 0 or N == 0:
+        return out
+    if f is None:
+        W = m.transpose((1, 0, 2))
+    else:
+        f = np.asanyarray(f).reshape((N, -1)).astype(ftype, copy=False)
+        W = np.zeros((Nmag, G, f.shape[1], 3), dtype=ctype)
+        W[np.arange(Nmag), :, species] = m.transpose((1, 0, 2))
+    W = W.reshape((Nmag, -1))
+    if chunk is None:
+        chunk = getParallelChunkSize(N, Nmag + W.shape[1], itemsize=np.dtype(ctype).itemsize, workers=workers)
+
+    def block(start, stop):
+        E = getPhaseBlock(Q, d, start, stop, precision, phases, columns)
+        EW = np.dot(E, W)
+        if groups is not None:
+            EW = EW.reshape((stop - start, G, -1))[np.arange(stop - start), groups[start:stop]]
+        if f is None:
+            out[start:stop] = EW
+        else:
+            out[start:stop] = np.einsum('ns,nsa->na', f[start:stop], EW.reshape((stop - start, -1, 3)))
+
+    mapChunks(block, N, chunk, workers=workers)
+    return out
+
+
+def basisAmplitudes(Q, d, psi, atoms, f=None, species=None, chunk=None, precision='double', workers=None, phases=None,
+                    columns=None):
+    """
+    Computes the amplitudes A_v(Q) = f_j(Q) psi_v exp(2 pi i Q.d_j) of basis vectors psi_v on the magnetic atoms j(v),
+    so that the magnetic structure factor of any moments m_j = sum_v w_v psi_v (over the v with j(v) = j) is the
+    small product F_M(Q) = sum_v w_v A_v(Q) (see magneticStructureFactor).
+    ----------
+    Q: (N,3) array of wavevectors in r.l.u.
+    d: (Nmag,3) array of fractional coordinates
+    psi: (Nbv,3) array of (complex) basis vectors, including any prefactor
+    atoms: (Nbv,) magnetic atom of each basis vector
+    f, species: form factor table (N, Nspecies) and the species (Nmag,) of the magnetic atoms
+    phases, columns: see magneticStructureFactor
+    ----------
+    Returns the (N, Nbv, 3) complex array of the A_v, not yet projected perpendicular to Q.
+    """
+    ftype, ctype = getPrecision(precision)
+    Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+    d = np.atleast_2d(np.asanyarray(d, dtype=float))
+    psi = np.asanyarray(psi).reshape((-1, 3)).astype(ctype)
+    atoms = np.asanyarray(atoms, dtype=int).reshape(-1)
+    N = len(Q)
+    out = np.zeros((N, len(psi), 3), dtype=ctype)
+    if N == 0 or len(psi) == 0:
+        return out
+    f = None if f is None else np.asanyarray(f).reshape((N, -1)).astype(ftype, copy=False)
+    species = None if f is None else np.asanyarray(species, dtype=int)[atoms]
+    if chunk is None:
+        chunk = getParallelChunkSize(N, len(d) + 4*len(psi), itemsize=np.dtype(ctype).itemsize, workers=workers)
+
+    def block(start, stop):
+        E = getPhaseBlock(Q, d, start, stop, precision, phases, columns)[:, atoms]
+        if f is not None:
+            E *= f[start:stop, species]
+        np.multiply(E[:, :, None], psi, out=out[start:stop])
+
+    mapChunks(block, N, chunk, workers=workers)
+    return out
+
+
+def sharedStructureFactors(Q, d, b, m, columns, f=None, species=None, T=None, Tspecies=None, chunk=None,
+                           precision='double', workers=None, phases=None):
+    """
+    Computes the nuclear F(Q) (see nuclearStructureFactor) and the magnetic F_M(Q) (see magneticStructureFactor) from
+    the same phase matrix, with the magnetic atoms given as a subset of the columns of the atoms, so that the
+    exponentials are only evaluated once for both, e.g. for polarized cross sections.
+    ----------
+    Q: (N,3) array of wavevectors in r.l.u.
+    d, b: (Natoms,3) fractional coordinates and (Natoms,) scattering lengths of all atoms
+    m, columns: (Nmag,3) moments (including any prefactor) of the magnetic atoms and their (Nmag,) indices into d
+    f, species: form factor table (N, Nspecies) and the species of the magnetic atoms (see magneticStructureFactor)
+    T, Tspecies: Debye-Waller table (N, Nspecies) and the species of all atoms (see nuclearStructureFactor)
+    phases: optional precomputed phaseMatrix(Q, d) (see nuclearStructureFactor)
+    ----------
+    Returns F (N,) and F_M (N,3).
+    """
+    ftype, ctype = getPrecision(precision)
+    Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+    d = np.atleast_2d(np.asanyarray(d, dtype=float))
+    b = np.asanyarray(b).reshape(-1).astype(ctype)
+    m = np.asanyarray(m).reshape((-1, 3)).astype(ctype)
+    columns = np.asanyarray(columns, dtype=int).reshape(-1)
+    N = len(Q)
+    F, Fm = np.zeros(N, dtype=ctype), np.zeros((N, 3), dtype=ctype)
+    if N == 0 or len(b) == 0:
+        return F, Fm
+
+    # The nuclear and magnetic weights of the atoms side by side, so that one product with the phase matrix gives both
+    Tn = 1 if T is None else np.asanyarray(T).shape[1]
+    Sm = 1 if f is None else np.asanyarray(f).shape[1]
+    W = np.zeros((len(b), Tn + 3*Sm), dtype=ctype)
+    W[np.arange(len(b)), 0 if T is None else Tspecies] = b
+    Wm = np.zeros((len(m), Sm, 3), dtype=ctype)
+    Wm[np.arange(len(m)), 0 if f is None else species] = m
+    np.add.at(W[:, Tn:], columns, Wm.reshape((len(m), -1)))
+    T = None if T is None else np.asanyarray(T).astype(ftype, copy=False)
+    f = None if f is None else np.asanyarray(f).reshape((N, -1)).astype(ftype, copy=False)
+    if chunk is None:
+        chunk = getParallelChunkSize(N, len(b) + W.shape[1], itemsize=np.dtype(ctype).itemsize, workers=workers)
+
+    def block(start, stop):
+        EW = np.dot(getPhaseBlock(Q, d, start, stop, precision, phases), W)
+        F[start:stop] = EW[:, 0] if T is None else np.einsum('ns,ns->n', EW[:, :Tn], T[start:stop])
+        EWm = EW[:, Tn:].reshape((stop - start, Sm, 3))
+        Fm[start:stop] = EWm[:, 0] if f is None else np.einsum('ns,nsa->na', f[start:stop], EWm)
+
+    mapChunks(block, N, chunk, workers=workers)
+    return F, Fm
+
+
+def magneticInteractionVector(F, Qh, vector=True, intensity=False, chiral=False):
+    """
+    Computes the magnetic interaction vector M_perp = Qh x (F x Qh) = F - (F.Qh) Qh, its square
+    |M_perp|^2 = |F|^2 - |F.Qh|^2 and the chiral term i (M_perp x M_perp^*) = 2 (Qh.(Re F x Im F)) Qh from the
+    projections F.Qh, without forming the cross products or a conjugate copy. The general forms with |Qh|^2 are used,
+    so that M_perp vanishes for Qh = 0 (Q = 0) just as the cross products do.
+    Since |M_perp|^2 is found by a difference, its absolute error is about eps |F|^2.
+    ----------
+    F: (N,3) complex magnetic structure factor
+    Qh: (N,3) Cartesian unit vectors along Q, e.g. from ReciprocalLattice.unit
+    vector, intensity, chiral: which of M_perp (N,3), |M_perp|^2 (N,) and the (real) chiral term (N,3) to return
+    ----------
+    Returns the requested arrays as a tuple in the above order, or a single array if only one is requested.
+    """
+    F = np.asanyarray(F)
+    Qh = np.asanyarray(Qh).astype(F.real.dtype, copy=False)
+    s = np.einsum('na,na->n', Qh, Qh)
+    FQ = np.einsum('na,na->n', F, Qh)
+    results = []
+    if vector:
+        M = np.multiply(F, s[:, None])
+        M -= Qh * FQ[:, None]
+        results.append(M)
+    if intensity:
+        F2 = np.einsum('na,na->n', F.real, F.real) + np.einsum('na,na->n', F.imag, F.imag)
+        I = s * (s*F2 - (FQ.real**2 + FQ.imag**2))
+        results.append(np.maximum(I, 0., out=I))
+    if chiral:
+        C = np.einsum('na,na->n', Qh, np.cross(F.real, F.imag))
+        results.append((2.*s*C)[:, None] * Qh)
+    return results[0] if len(results) == 1 else tuple(results)
+
+
+def intensityMatrices(P):
+    """
+    Returns the Hermitian matrices H_gh(Q) = P_g(Q)^H P_h(Q) (N, G, G) of the perpendicular amplitudes P (N, G, 3) of
+    G coefficients, so that |M_perp(Q)|^2 = c^H H(Q) c for the coefficient vector c (G,).
+    """
+    P = np.asanyarray(P)
+    return np.matmul(P.conj(), P.transpose((0, 2, 1)))
+
+
+def quadraticFormIntensities(P, C, chunk=None, workers=None):
+    """
+    Evaluates |M_perp|^2 = c^H H(Q) c (see intensityMatrices) for the K candidate coefficient vectors C (K, G) at all
+    N Q at once. Since H = P^H P has rank 3 at most, it is evaluated through its factor as |sum_g c_g P_g|^2, which
+    costs 3 G instead of G^2 per candidate and Q, as one matrix product per chunk of candidates.
+    ----------
+    P: (N, G, 3) complex perpendicular amplitudes of the coefficients
+    C: (K, G) candidate coefficient vectors
+    workers: number of threads evaluating the chunks of candidates (see getWorkers)
+    ----------
+    Returns the (K, N) array of intensities.
+    """
+    P = np.asanyarray(P)
+    N, G = P.shape[:2]
+    C = np.atleast_2d(np.asanyarray(C)).astype(P.dtype, copy=False)
+    if C.shape[1] != G:
+        raise ValueError('The candidates need ' + str(G) + ' coefficients each, not ' + str(C.shape[1]))
+    K = len(C)
+    out = np.empty((K, N), dtype=P.real.dtype)
+    if K == 0 or N == 0:
+        return out
+    # The coefficients as rows of one (G, 3N) matrix, so that each chunk of candidates is a single product
+    Pt = np.ascontiguousarray(P.transpose((1, 0, 2))).reshape((G, 3*N))
+    if chunk is None:
+        chunk = getParallelChunkSize(K, 6*N, itemsize=np.dtype(P.dtype).itemsize, workers=workers)
+
+    def block(start, stop):
+        M = np.dot(C[start:stop], Pt).reshape((stop - start, N, 3))
+        out[start:stop] = np.einsum('kna,kna->kn', M.real, M.real) + np.einsum('kna,kna->kn', M.imag, M.imag)
+
+    mapChunks(block, K, chunk, workers=workers)
+    return out
+
+
+def debyeWallerFactors(Q, U):
+    """
+    Computes the table of Debye-Waller factors exp(-Q.U.Q/2) for Cartesian displacement tensors U (Nspecies,3,3)
+    in Ang.^2 at Cartesian Q (N,3) in inv. Ang. For isotropic U = Uiso 1 this is exp(-Biso s^2), with s = |Q|/4 pi and
+    Biso = 8 pi^2 Uiso.
+    """
+    Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+    U = np.asanyarray(U, dtype=float).reshape((-1, 3, 3))
+    return np.exp(-0.5 * np.einsum('ni,sij,nj->ns', Q, U, Q))
+
+
+class IncrementalStructureFactor(object):
+    """
+    Keeps F(Q) from nuclearStructureFactor together with the coordinates, scattering lengths (and Debye-Waller table)
+    it was computed from. When only some atoms change, F is updated by subtracting their old terms and adding the new
+    ones, so the cost scales with the number of moved atoms rather than the size of the cell.
+    ----------
+    refresh: number of incremental updates after which F is recomputed from scratch to drop the accumulated rounding
+    maxfraction: fraction of changed atoms above which a full recomputation is cheaper
+    precision, workers: see nuclearStructureFactor
+    """
+    def __init__(self, Q, d, b, chunk=None, T=None, species=None, refresh=1000, maxfraction=0.5, precision='double',
+                 workers=None):
+        """"""
+        self.Q = np.atleast_2d(np.asanyarray(Q, dtype=float))
+        self.chunk = chunk
+        self.precision = precision
+        self.workers = workers
+        self.refresh = refresh
+        self.maxfraction = maxfraction
+        self.compute(d, b, T=T, species=species)
+        return
+
+    def compute(self, d, b, T=None, species=None):
+        """
+        Computes F from scratch and keeps copies of the inputs.
+        """
+        self.d = np.atleast_2d(np.array(d, dtype=float))
+        self.b = np.array(b).reshape(-1)
+        self.T = T
+        self.species = None if species is None else np.array(species)
+        self.F = nuclearStructureFactor(self.Q, self.d, self.b, chunk=self.chunk, T=T, species=species,
+                                        precision=self.precision, workers=self.workers)
+        self.updates = 0
+        return self.F
+
+    def getChanged(self, d, b, species=None):
+        """
+        Returns the indices of the atoms whose coordinates, scattering lengths or species differ from the kept ones.
+        """
+        changed = np.any(d != self.d, axis=1) | (b != self.b)
+        if species is not None:
+            changed |= (species != self.species)
+        return np.where(changed)[0]
+
+    def update(self, d, b, T=None, species=None):
+        """
+        Returns F(Q) for the new coordinates d and scattering lengths b, updated incrementally where possible.
+        """
+        d = np.atleast_2d(np.asanyarray(d, dtype=float))
+        b = np.asanyarray(b).reshape(-1)
+        if d.shape != self.d.shape or (T is not self.T) or np.result_type(b, self.b) != self.b.dtype \
+                or self.updates >= self.refresh:
+            return self.compute(d, b, T=T, species=species)
+
+        moved = self.getChanged(d, b, species=species)
+        if len(moved) == 0:
+            return self.F
+        if len(moved) > self.maxfraction * len(b):
+            return self.compute(d, b, T=T, species=species)
+
+        # F += sum_moved (b_new exp(2 pi i Q.d_new) - b_old exp(2 pi i Q.d_old)), in a single kernel call
+        dd = np.vstack((d[moved], self.d[moved]))
+        bb = np.hstack((b[moved], -self.b[moved]))
+        ss = None if species is None else np.hstack((species[moved], self.species[moved]))
+        self.F += nuclearStructureFactor(self.Q, dd, bb, chunk=self.chunk, T=T, species=ss, precision=self.precision,
+                                         workers=self.workers)
+        self.d[moved] = d[moved]
+        self.b[moved] = b[moved]
+        if species is not None:
+            self.species[moved] = species[moved]
+        self.updates += 1
+        return self.F
+
+
+def getSpreadingWidth(tol):
+    """
+    Returns the half width (in grid points) of the Gaussian used by nufftStructureFactor for a relative accuracy tol,
+    about one point per digit for the oversampling ratio R = 2 (Greengard & Lee, Table 1).
+    """
+    return int(min(16, max(2, np.ceil(-np.log10(tol)) + 1)))
+
+
+def nufftStructureFactor(origin, steps, shape, d, b, tol=1e-6, T=None, species=None, R=2, budget=None):
+    """
+    Computes F(Q) = sum_j b_j exp(2 pi i Q.d_j) on the regular grid Q = origin + sum_a n_a steps_a (n_a = 0..shape_a-1,
+    the first axis varying slowest, as from reciprocal.makeGrid) with a type-1 nonuniform FFT: the atoms are spread onto
+    an R times oversampled grid with a Gaussian, Fourier transformed, and the Gaussian is deconvolved (Greengard & Lee,
+    SIAM Rev. 46, 443 (2004)). The cost is O(N_atoms (2 Msp)^D + N_Q log N_Q) rather than O(N_atoms N_Q), with an
+    absolute error of about tol sum_j |b_j|.
+    ----------
+    origin: (3,) first point of the grid in r.l.u.
+    steps: (D,3) step vectors of the D grid axes in r.l.u.
+    shape: (D,) number of points along each axis
+    T, species: Debye-Waller table and species of the atoms (see nuclearStructureFactor); one transform per species
+    ----------
+    Returns the complex128 (N_Q,) structure factor.
+    """
+    shape = tuple(int(M) for M in np.atleast_1d(shape))
+    steps = np.asanyarray(steps, dtype=float).reshape((len(shape), 3))
+    d = np.atleast_2d(np.asanyarray(d, dtype=float))
+    b = np.asanyarray(b).reshape(-1).astype(np.complex128)
+    if T is not None:
+        F = np.zeros(int(np.prod(shape)), dtype=np.complex128)
+        for s in range(T.shape[1]):
+            mine = (species == s)
+            if mine.any():
+                F += T[:, s] * nufftStructureFactor(origin, steps, shape, d[mine], b[mine], tol=tol, R=R, budget=budget)
+        return F
+
+    D = len(shape)
+    M = np.array(shape)
+    Msp = getSpreadingWidth(tol)
+    Mr = np.maximum(2*Msp, np.ceil(R*M).astype(int))
+    tau = np.pi * Msp / (M.astype(float)**2 * R * (R - 0.5))
+
+    # Positions of the atoms along the grid axes; the modes n_a = k_a + M_a//2 are centred on k_a = 0
+    y = np.dot(d, steps.T)
+    c = b * np.exp(2.*np.pi*1j * (np.dot(d, np.asanyarray(origin, dtype=float).reshape(3)) + np.dot(y, M//2)))
+    x = 2.*np.pi * (y - np.floor(y))
+
+    # Spread onto the oversampled grid, in chunks of atoms
+    f = np.zeros(int(np.prod(Mr)), dtype=np.complex128)
+    offsets = np.arange(-Msp + 1, Msp + 1)
+    P = len(offsets)
+    chunk = getChunkSize(P**D, itemsize=64, budget=budget)
+    for start in range(0, len(b), chunk):
+        xc = x[start:start+chunk]
+        weights, index = c[start:start+chunk], 0
+        for a in range(D):
+            # The Gaussian weights of the 2 Msp nearest grid points along axis a, as the next axis of the outer product
+            pos = np.floor(xc[:, a] * Mr[a] / (2.*np.pi)).astype(int)[:, None] + offsets
+            w = np.exp(-(2.*np.pi * pos / Mr[a] - xc[:, a, None])**2 / (4.*tau[a]))
+            newaxis = (len(xc),) + (1,)*a + (P,)
+            weights = weights[..., None] * w.reshape(newaxis)
+            index = np.multiply(index, Mr[a])[..., None] + np.mod(pos, Mr[a]).reshape(newaxis)
+        index, weights = index.reshape(-1), weights.reshape(-1)
+        f += np.bincount(index, weights=weights.real, minlength=len(f))
+        f += 1j * np.bincount(index, weights=weights.imag, minlength=len(f))
+
+    # Fourier transform and deconvolve the Gaussian at the centred modes
+    F = np.fft.ifftn(f.reshape(tuple(Mr)))
+    k = [np.arange(M[a]) - M[a]//2 for a in range(D)]
+    F = F[np.ix_(*[np.mod(k[a], Mr[a]) for a in range(D)])]
+    for a in range(D):
+        expand = (None,)*a + (slice(None),) + (None,)*(D - a - 1)
+        F = F * (np.sqrt(np.pi / tau[a]) * np.exp(k[a]**2 * tau[a]))[expand]
+    return F.reshape(-1)
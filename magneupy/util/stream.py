@@ -0,0 +1,47 @@
+"""
+Helpers to evaluate structure factors block by block over very large sets of Q and to write the blocks straight to HDF5.
+"""
+import numpy as np
+import h5py
+
+
+def iterChunks(N, chunk):
+    """
+    Yields the (start, stop) bounds of consecutive chunks of N rows.
+    """
+    chunk = max(1, int(chunk))
+    for start in range(0, N, chunk):
+        yield start, min(start + chunk, N)
+
+
+def writeBlocks(filename, blocks, N, dataset='F', coords=None, mode='a', **kwargs):
+    """
+    Writes the (start, stop, values) blocks of a generator into the dataset of an HDF5 file (or open h5py.File/Group),
+    so that the full (N,...) array is never held in memory. The dataset is created from the dtype and trailing shape
+    of the first block and replaced if it exists. If coords (a sliceable (N,3) array of Q) is given, the Q of each
+    block are stored in dataset + '_Q' as well. Additional kwargs (e.g. compression) are passed to create_dataset.
+    ----------
+    Returns the number of rows written.
+    """
+    if isinstance(filename, (h5py.File, h5py.Group)):
+        return _writeBlocks(filename, blocks, N, dataset, coords, **kwargs)
+    with h5py.File(filename, mode) as f:
+        return _writeBlocks(f, blocks, N, dataset, coords, **kwargs)
+
+
+def _writeBlocks(group, blocks, N, dataset, coords, **kwargs):
+    """"""
+    out, Qout, written = None, None, 0
+    for start, stop, values in blocks:
+        values = np.asanyarray(values)
+        if out is None:
+            for name in [dataset, dataset + '_Q']:
+                if name in group: del group[name]
+            out = group.create_dataset(dataset, shape=(N,)+values.shape[1:], dtype=values.dtype, **kwargs)
+            if coords is not None:
+                Qout = group.create_dataset(dataset + '_Q', shape=(N,3), dtype=float, **kwargs)
+        out[start:stop] = values
+        if Qout is not None:
+            Qout[start:stop] = np.asanyarray(coords[start:stop], dtype=float)
+        written += stop - start
+    return written
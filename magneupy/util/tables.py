@@ -0,0 +1,305 @@
+"""
+Process-wide lookup table of the neutron scattering lengths and magnetic form factor coefficients of the ions.
+The entries are keyed by (element, isotope, charge) and pulled from periodictable once, on first use or by preloadIons.
+The magnetic form factors f(|Q|) of the last few |Q| arrays are memoized as well (see getFormFactor), and may be
+interpolated from fine tables instead of evaluated at every point (see FormFactorTable).
+"""
+from collections import namedtuple, OrderedDict
+import string
+import threading
+import numpy as np
+import periodictable as pt
+
+from .functions import fingerprint
+
+_LETTERS = frozenset(string.ascii_letters)
+_DIGITS = frozenset(string.digits)
+
+# The table of IonProperties, and the parsed keys of the raw (element, isotope, charge) arguments
+_ions = {}
+_keys = {}
+
+# LRU memo of the form factors, keyed by (ion, S, L, orbital, fingerprint of |Q|), and the fingerprints of read-only
+# |Q| arrays (e.g. from the ReciprocalLattice memo) by id, which saves hashing them again.
+FORMFACTOR_MAXSIZE = 64
+_formfactors = OrderedDict()
+_fingerprints = OrderedDict()
+_lock = threading.Lock()
+
+# The FormFactorTables by (ion, S, L, orbital, kind, Qmax, step)
+INTERPOLATIONS = ('linear', 'cubic')
+_tables = {}
+
+
+class IonProperties(namedtuple('IonProperties', ['element', 'isotope', 'charge', 'Z', 'b_c', 'b', 'j0', 'j2'])):
+    """
+    Scattering properties of an ion.
+    ----------
+    Attributes:
+    Z: atomic number
+    b_c: coherent scattering length (fm)
+    b: complex coherent scattering length (fm), which differs from b_c for absorbers
+    j0, j2: the (A, a, B, b, C, c, D) coefficients of <j0> and <j2>, or None if periodictable has no form factor
+    """
+    __slots__ = ()
+
+    def j0_Q(self, Q):
+        """
+        Returns <j0> at |Q| in inv. Ang.
+        """
+        return formFactorIntegral(self.j0, Q, self)
+
+    def j2_Q(self, Q):
+        """
+        Returns <j2> at |Q| in inv. Ang.
+        """
+        return formFactorIntegral(self.j2, Q, self) * (np.asanyarray(Q, dtype=float) / (4.*np.pi))**2
+
+
+def formFactorIntegral(coeffs, Q, ion=None):
+    """
+    Evaluates A exp(-a s^2) + B exp(-b s^2) + C exp(-c s^2) + D with s = |Q|/4 pi.
+    """
+    if coeffs is None:
+        raise KeyError('No magnetic form factor is tabulated for ' + str(ion))
+    A, a, B, b, C, c, D = coeffs
+    s2 = (np.asanyarray(Q, dtype=float) / (4.*np.pi))**2
+    return A*np.exp(-a*s2) + B*np.exp(-b*s2) + C*np.exp(-c*s2) + D
+
+
+def parseIon(element, isotope=None, charge=None):
+    """
+    Returns the key (element, isotope, charge) of the table. Bytes are decoded and all but the letters of the element
+    name are stripped. The charge is kept as an int when possible; otherwise Ce and Mn default to 3+.
+    """
+    raw = (element, isotope, charge)
+    key = _keys.get(raw)
+    if key is not None:
+        return key
+
+    elname = element.decode() if isinstance(element, bytes) else str(element)
+    elname = ''.join(ch for ch in elname if ch in _LETTERS)
+    if isinstance(charge, bytes):
+        charge = charge.decode()
+    if charge is not None:
+        try:
+            charge = int(charge)
+        except ValueError:
+            charge = ''.join(ch for ch in charge if ch in _DIGITS)
+            charge = int(charge) if charge else (3 if elname in ('Ce', 'Mn') else None)
+    isotope = None if isotope is None else int(isotope)
+
+    key = _keys[raw] = (elname, isotope, charge)
+    return key
+
+
+def getIon(element, isotope=None, charge=None):
+    """
+    Returns the IonProperties of the given element (str or bytes), isotope (mass number, None for the natural
+    abundance) and charge. Each ion is only looked up in periodictable once per process.
+    """
+    key = parseIon(element, isotope=isotope, charge=charge)
+    ion = _ions.get(key)
+    if ion is None:
+        ion = _ions[key] = _buildIon(*key)
+    return ion
+
+
+def _buildIon(elname, isotope, charge):
+    """"""
+    element = pt.elements.symbol(elname)
+    if isotope is not None:
+        element = element[isotope]
+    b_c = element.neutron.b_c
+    b = getattr(element.neutron, 'b_c_complex', None)
+    b = complex(b_c if b is None else b)
+
+    j0, j2 = None, None
+    if charge is not None:
+        # Due to a bug in the tables, the form factor of cerium is only found with the 'charge key' 2
+        charge_key = 2 if elname == 'Ce' else charge
+        try:
+            ff = element.ion[charge].magnetic_ff[charge_key]
+            j0, j2 = tuple(ff.j0), tuple(ff.j2)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+    return IonProperties(elname, isotope, charge, element.number, b_c, b, j0, j2)
+
+
+def getLandeFactor(S=1/2, L=3):
+    """
+    Returns the spin, orbital and total Lande factors (gS, gL, gJ) for J = |L-S|.
+    """
+    J = np.abs(L-S)
+    gL = 1./2. + (L*(L+1)-S*(S+1))/(2*J*(J+1))
+    gS = 1. + (S*(S+1)-L*(L+1))/(J*(J+1))
+    return gS, gL, gL + gS
+
+
+def magneticFormFactor(ion, Q, S=1/2, L=3, orbital=True):
+    """
+    Evaluates the magnetic form factor of an IonProperties at |Q| (inv. Ang.) in the dipole approximation: for the full
+    J with orbital=True (Lovesey, Eq. 7.26), otherwise for the spin S with quenched L (Lovesey, Eq. 7.23).
+    """
+    gS, gL, gJ = getLandeFactor(S=S, L=L)
+    j0 = ion.j0_Q(Q)
+    j2 = ion.j2_Q(Q)
+    if orbital:
+        return (gS*j0 + gL*j0 + gL*j2)/gJ
+    return j0 + j2*(gJ-2)/gJ
+
+
+class FormFactorTable(object):
+    """
+    The magnetic form factor of an ion (see magneticFormFactor) tabulated on a uniform |Q| grid from 0 to Qmax
+    (inv. Ang.) and interpolated, linearly or with a cubic spline, which is much cheaper than the analytic expansion for
+    large arrays. Points beyond Qmax are evaluated analytically.
+    ----------
+    Attributes:
+    Q, f: the table
+    error: the largest absolute deviation from the analytic form factor at the midpoints of the table, where the
+           interpolation error peaks (about step^2 max|f''|/8 for 'linear' and far smaller for 'cubic')
+    """
+    def __init__(self, element, charge=None, S=1/2, L=3, orbital=True, kind='cubic', Qmax=20., step=5e-3):
+        """"""
+        if kind not in INTERPOLATIONS:
+            raise ValueError('The interpolation must be one of ' + str(INTERPOLATIONS) + ', not ' + str(kind))
+        self.ion = getIon(element, charge=charge)
+        self.S, self.L, self.orbital = S, L, orbital
+        self.kind = kind
+        n = int(np.ceil(Qmax / step)) + 1
+        self.step = float(step)
+        self.Q = self.step * np.arange(n)
+        self.Qmax = self.Q[-1]
+        self.f = self.evaluate(self.Q)
+        # The polynomial coefficients of each interval in the offset u = (Q - Q_i)/step, highest power first
+        if kind == 'cubic':
+            from scipy.interpolate import CubicSpline
+            coeffs = CubicSpline(self.Q, self.f).c * (self.step**np.arange(3, -1, -1))[:, None]
+        else:
+            coeffs = np.vstack((np.diff(self.f), self.f[:-1]))
+        self.coeffs = np.ascontiguousarray(coeffs)
+        mid = self.Q[:-1] + self.step/2.
+        self.error = float(np.abs(self(mid) - self.evaluate(mid)).max())
+        return
+
+    def evaluate(self, Q):
+        """
+        Returns the analytic form factor at |Q| (inv. Ang.).
+        """
+        return magneticFormFactor(self.ion, Q, S=self.S, L=self.L, orbital=self.orbital)
+
+    def __call__(self, Q):
+        """
+        Returns the interpolated form factor at |Q| (inv. Ang., any shape).
+        """
+        Q = np.asanyarray(Q, dtype=float)
+        shape = Q.shape
+        Q = Q.reshape(-1)
+        # Uniform table: the interval follows from Q directly, without a search
+        u = np.multiply(Q, 1./self.step)
+        i = u.astype(np.intp)
+        np.minimum(i, len(self.Q) - 2, out=i)
+        u -= i
+        f = np.take(self.coeffs[0], i)
+        for c in self.coeffs[1:]:
+            f *= u
+            f += np.take(c, i)
+        beyond = Q > self.Qmax
+        if np.any(beyond):
+            f[beyond] = self.evaluate(Q[beyond])
+        return f.reshape(shape)
+
+
+def getFormFactorTable(element, charge=None, S=1/2, L=3, orbital=True, kind='cubic', Qmax=20., step=5e-3):
+    """
+    Returns the FormFactorTable of the ion, which is only built once per process.
+    """
+    key = (parseIon(element, charge=charge), S, L, orbital, kind, Qmax, step)
+    table = _tables.get(key)
+    if table is None:
+        table = _tables[key] = FormFactorTable(element, charge=charge, S=S, L=L, orbital=orbital, kind=kind, Qmax=Qmax,
+                                               step=step)
+    return table
+
+
+def _getQKey(Q):
+    """"""
+    if Q.flags.writeable or Q.base is not None:
+        return fingerprint(Q)
+    with _lock:
+        cached = _fingerprints.get(id(Q))
+        if cached is not None and cached[0] is Q:
+            _fingerprints.move_to_end(id(Q))
+            return cached[1]
+    key = fingerprint(Q)
+    with _lock:
+        # Keep a reference, so that the id is not reused while the entry lives
+        _fingerprints[id(Q)] = (Q, key)
+        while len(_fingerprints) > FORMFACTOR_MAXSIZE:
+            _fingerprints.popitem(last=False)
+    return key
+
+
+def getFormFactor(element, Q, charge=None, S=1/2, L=3, orbital=True, interpolate=None):
+    """
+    Returns the (read-only) magnetic form factor of the ion at |Q| (inv. Ang., any shape), see magneticFormFactor.
+    With interpolate='linear' or 'cubic' it is interpolated from the FormFactorTable of the ion instead.
+    The results for the last FORMFACTOR_MAXSIZE combinations of ion, S, L, orbital and |Q| array are kept, so repeated
+    calls with the same arrays (e.g. in every iteration of a refinement) only cost a lookup. This is safe to call from
+    several threads.
+    """
+    ion = getIon(element, charge=charge)
+    Q = np.asanyarray(Q, dtype=float)
+    key = (parseIon(element, charge=charge), S, L, orbital, interpolate, _getQKey(Q))
+    with _lock:
+        f = _formfactors.get(key)
+        if f is not None:
+            _formfactors.move_to_end(key)
+            return f
+    if interpolate is None:
+        f = magneticFormFactor(ion, Q, S=S, L=L, orbital=orbital)
+    else:
+        f = getFormFactorTable(element, charge=charge, S=S, L=L, orbital=orbital, kind=interpolate)(Q)
+    f.flags.writeable = False
+    with _lock:
+        _formfactors[key] = f
+        while len(_formfactors) > FORMFACTOR_MAXSIZE:
+            _formfactors.popitem(last=False)
+    return f
+
+
+def preloadIons(ions=None):
+    """
+    Fills the table ahead of time, e.g. at startup. ions is an iterable of element names or (element, isotope, charge)
+    tuples; by default every element with its tabulated magnetic ions is loaded.
+    """
+    if ions is None:
+        ions = []
+        for element in pt.elements:
+            if element.number == 0:
+                continue
+            ions.append((element.symbol, None, None))
+            for charge in getattr(element, 'magnetic_ff', {}):
+                ions.append((element.symbol, None, charge))
+    for ion in ions:
+        if isinstance(ion, (str, bytes)):
+            ion = (ion,)
+        try:
+            getIon(*ion)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+    return len(_ions)
+
+
+def clearIons():
+    """
+    Empties the table and the memoized form factors.
+    """
+    _ions.clear()
+    _keys.clear()
+    _tables.clear()
+    with _lock:
+        _formfactors.clear()
+        _fingerprints.clear()
+    return
@@ -0,0 +1,46 @@
+"""
+Shared fixtures of the magneupy tests: small crystals and magnetic structures built from the CIFs in tests/data.
+"""
+import contextlib
+import io
+import os
+import tempfile
+
+# Keep the parsed CIFs of the tests out of the user's cache (see util.cifcache)
+os.environ.setdefault('MAGNEUPY_CACHE', tempfile.mkdtemp(prefix='magneupy-tests-'))
+
+import numpy as np
+import pytest
+
+import magneupy
+from magneupy import magnetic
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def buildStructures(cif, magname=None, qm=(0, 0, 0), moment=None, Qmax=3):
+    """
+    Returns the Crystal of tests/data/cif and, with magname, a MagneticStructure of that element with the propagation
+    vector qm and the Cartesian moment (3,) on every magnetic atom.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        crystal = magneupy.Crystal(cif=os.path.join(DATA, cif), Qmax=Qmax)
+        if magname is None:
+            return crystal, None
+        ms = magnetic.MagneticStructure(magnames=[magname], qms=[list(qm)], parents=[crystal], plane='hhl')
+    if moment is not None:
+        for magatom in ms.magatoms.values():
+            magatom.moment = np.asanyarray(moment, dtype=complex).reshape((1, 3))
+    return crystal, ms
+
+
+def getSatellites(qm, hmax=3):
+    """Returns the satellites G +- qm of all integer G with |h|, |k|, |l| <= hmax."""
+    G = np.array(np.meshgrid(*[np.arange(-hmax, hmax + 1)]*3, indexing='ij'), dtype=float).reshape((3, -1)).T
+    qm = np.asanyarray(qm, dtype=float)
+    return np.vstack((G + qm, G - qm))
+
+
+@pytest.fixture
+def structures():
+    return buildStructures
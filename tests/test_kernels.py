@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+
+from magneupy.magnetic import MAGNETIC_LENGTH
+from magneupy.util.kernels import nuclearStructureFactor, magneticStructureFactor, sharedStructureFactors, \
+    magneticInteractionVector, debyeWallerFactors, IncrementalStructureFactor
+
+
+def naiveNuclear(Q, d, b, T=None, species=None):
+    """F(Q) = sum_j b_j T_j(Q) exp(2 pi i Q.d_j), one atom at a time."""
+    F = np.zeros(len(Q), dtype=complex)
+    for j in range(len(d)):
+        Tj = 1. if T is None else T[:, species[j]]
+        F += b[j] * Tj * np.exp(2j*np.pi*np.dot(Q, d[j]))
+    return F
+
+
+def naiveMagnetic(Q, d, m, f=None, species=None):
+    """F_M(Q) = sum_j f_j(Q) m_j exp(2 pi i Q.d_j), one atom at a time."""
+    F = np.zeros((len(Q), 3), dtype=complex)
+    for j in range(len(d)):
+        fj = 1. if f is None else f[:, species[j]]
+        F += (fj * np.exp(2j*np.pi*np.dot(Q, d[j])))[:, None] * m[j]
+    return F
+
+
+@pytest.fixture
+def arrays():
+    rng = np.random.default_rng(0)
+    Q = rng.uniform(-6, 6, (500, 3))
+    d = rng.random((13, 3))
+    b = rng.normal(size=13) + 0.01j*rng.normal(size=13)
+    species = rng.integers(0, 3, 13)
+    T = rng.uniform(0.5, 1., (500, 3))
+    m = rng.normal(size=(13, 3)) + 1j*rng.normal(size=(13, 3))
+    return rng, Q, d, b, species, T, m
+
+
+@pytest.mark.parametrize('chunk, workers', [(None, None), (37, None), (37, 3)])
+def test_nuclear_kernel(arrays, chunk, workers):
+    rng, Q, d, b, species, T, m = arrays
+    assert np.allclose(nuclearStructureFactor(Q, d, b, chunk=chunk, workers=workers), naiveNuclear(Q, d, b),
+                       rtol=1e-12, atol=1e-12)
+    assert np.allclose(nuclearStructureFactor(Q, d, b, chunk=chunk, T=T, species=species, workers=workers),
+                       naiveNuclear(Q, d, b, T, species), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('chunk, workers', [(None, None), (37, None), (37, 3)])
+def test_magnetic_kernel(arrays, chunk, workers):
+    rng, Q, d, b, species, T, m = arrays
+    assert np.allclose(magneticStructureFactor(Q, d, m, chunk=chunk, workers=workers), naiveMagnetic(Q, d, m),
+                       rtol=1e-12, atol=1e-12)
+    assert np.allclose(magneticStructureFactor(Q, d, m, f=T, species=species, chunk=chunk, workers=workers),
+                       naiveMagnetic(Q, d, m, T, species), rtol=1e-12, atol=1e-12)
+
+    # a stack of moments, one chosen per Q
+    stack = np.stack((m, 2.*m.conj(), rng.normal(size=m.shape)))
+    groups = rng.integers(0, len(stack), len(Q))
+    expected = np.empty((len(Q), 3), dtype=complex)
+    for g in range(len(stack)):
+        expected[groups == g] = naiveMagnetic(Q[groups == g], d, stack[g], T[groups == g], species)
+    F = magneticStructureFactor(Q, d, stack, f=T, species=species, chunk=chunk, workers=workers, groups=groups)
+    assert np.allclose(F, expected, rtol=1e-12, atol=1e-12)
+
+
+def test_shared_structure_factors(arrays):
+    rng, Q, d, b, species, T, m = arrays
+    columns = np.array([1, 4, 5, 11])
+    F, Fm = sharedStructureFactors(Q, d, b, m[columns], columns, f=T, species=species[columns], T=T,
+                                   Tspecies=species)
+    assert np.allclose(F, naiveNuclear(Q, d, b, T, species), rtol=1e-12, atol=1e-12)
+    assert np.allclose(Fm, naiveMagnetic(Q, d[columns], m[columns], T, species[columns]), rtol=1e-12, atol=1e-12)
+
+
+def test_single_precision(arrays):
+    rng, Q, d, b, species, T, m = arrays
+    F = nuclearStructureFactor(Q, d, b, precision='single')
+    Fm = magneticStructureFactor(Q, d, m, f=T, species=species, precision='single')
+    assert F.dtype == np.complex64 and Fm.dtype == np.complex64
+    expected = naiveNuclear(Q, d, b)
+    assert np.abs(F - expected).max() < 1e-4*np.abs(expected).max()
+    expected = naiveMagnetic(Q, d, m, T, species)
+    assert np.abs(Fm - expected).max() < 1e-4*np.abs(expected).max()
+
+
+def test_incremental_kernel(arrays):
+    rng, Q, d, b, species, T, m = arrays
+    inc = IncrementalStructureFactor(Q, d, b)
+    for it in range(20):
+        j = rng.integers(len(d), size=2)
+        d[j] += rng.normal(0, 0.01, (2, 3))
+        b[j[0]] *= 0.9
+        inc.update(d, b)
+    assert inc.updates > 0
+    assert np.allclose(inc.F, naiveNuclear(Q, d, b), rtol=1e-10, atol=1e-10)
+
+
+def test_interaction_vector(arrays):
+    rng, Q, d, b, species, T, m = arrays
+    F = naiveMagnetic(Q, d, m)
+    Qh = Q / np.linalg.norm(Q, axis=1)[:, None]
+    M = np.cross(Qh, np.cross(F, Qh))
+    assert np.allclose(magneticInteractionVector(F, Qh), M, rtol=1e-12, atol=1e-12)
+    I, C = magneticInteractionVector(F, Qh, vector=False, intensity=True, chiral=True)
+    assert np.allclose(I, np.sum(np.abs(M)**2., axis=1), rtol=1e-12)
+    assert np.allclose(C, np.real(1j*np.cross(M, M.conj())), rtol=1e-12, atol=1e-12)
+
+
+def test_nuclear_structure_factor(structures):
+    crystal, ms = structures('MnO.cif')
+    nuclear = crystal.nuclear
+    nuclear.setDisplacement(Biso=0.7)
+    Q = np.random.default_rng(1).integers(-5, 6, (2000, 3)).astype(float)
+    d, b = nuclear.getAtomArrays()
+    U = nuclear.getDisplacementArrays()
+    T = debyeWallerFactors(nuclear.rlu2ang(Q), U)
+    expected = naiveNuclear(Q, d, b, T, np.arange(len(d)))
+    F = nuclear.calcNuclearStructureFactor(Q, absences=False, useDebyeWaller=True)
+    assert np.allclose(F, expected, rtol=1e-12, atol=1e-12)
+    # the absences only zero reflections that vanish anyway
+    assert np.allclose(nuclear.calcNuclearStructureFactor(Q, useDebyeWaller=True), expected, rtol=1e-12, atol=1e-10)
+    F = nuclear.calcNuclearStructureFactor(Q, absences=False, useDebyeWaller=True, precision='single')
+    assert np.abs(F - expected).max() < 1e-4*np.abs(expected).max()
+
+
+@pytest.mark.parametrize('absences', [False, True])
+def test_incremental_structure_factor(structures, absences):
+    crystal, ms = structures('hcp.cif')
+    nuclear = crystal.nuclear
+    rng = np.random.default_rng(2)
+    Q = rng.integers(-4, 5, (1500, 3)).astype(float)
+    nuclear.calcNuclearStructureFactor(Q, incremental=True, absences=absences)
+    for it in range(10):
+        atom = nuclear.atoms[rng.integers(len(nuclear.atoms))]
+        atom.d = atom.d + rng.normal(0, 0.01, 3)
+        F = nuclear.calcNuclearStructureFactor(Q, incremental=True, absences=absences)
+        assert np.allclose(F, nuclear.calcNuclearStructureFactor(Q, absences=absences), rtol=1e-10, atol=1e-10)
+    assert nuclear._incremental[1].updates > 0
+    d, b = nuclear.getAtomArrays()
+    expected = naiveNuclear(Q, d, b)
+    if absences:
+        absent = nuclear.getAbsences(Q)
+        expected[absent] = 0.
+    assert np.allclose(F, expected, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('precision, rtol', [('double', 1e-12), ('single', 1e-4)])
+def test_magnetic_structure_factor(structures, precision, rtol):
+    rng = np.random.default_rng(3)
+    crystal, ms = structures('MnO.cif', 'Mn', (0.5, 0.5, 0.5))
+    magatoms = list(ms.magatoms.values())
+    for magatom in magatoms:
+        magatom.moment = (rng.normal(size=3) + 1j*rng.normal(size=3)).reshape((1, 3))
+    Q = rng.integers(-4, 5, (1500, 3)) + 0.5
+    d = np.array([magatom.d for magatom in magatoms], dtype=float).reshape((-1, 3))
+    m = MAGNETIC_LENGTH*np.array([magatom.moment for magatom in magatoms]).reshape((-1, 3))
+    f = np.column_stack([magatom.get_form_factor(Q, return_Q=True)[1] for magatom in magatoms])
+    expected = naiveMagnetic(Q, d, m, f, np.arange(len(d)))
+    F = ms.calcMagneticStructureFactor(Q, perpendicular=False, precision=precision)
+    assert np.abs(F - expected).max() <= rtol*np.abs(expected).max()
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from conftest import getSatellites
+
+
+@pytest.mark.parametrize('qm', [(0, 0, 0), (0, 0, 0.5), (0, 0.3, 0)])
+@pytest.mark.parametrize('moment', [(1, 1, 0), (1, 0, 0), (1, 2, 3)])
+def test_symmetrize_hexagonal(structures, qm, moment):
+    # The Cartesian moments of a hexagonal cell must be rotated by A R A^-1, not by R
+    crystal, ms = structures('hcp.cif', 'Co', qm, moment)
+    Q = getSatellites(qm)
+    I = ms.calcMagneticIntensity(Q)
+    assert np.allclose(ms.calcMagneticIntensity(Q, symmetrize=True), I, rtol=0., atol=1e-12*I.max())
+
+
+def test_default_path_uses_satellites(structures):
+    # Qm=None evaluates every satellite with the Fourier components of its own propagation vector
+    crystal, ms = structures('MnO.cif', 'Mn', (0.5, 0.5, 0.5), Qmax=2)
+    ms.qms = [[0.5, 0.5, 0.5], [0, 0, 0.3]]
+    rng = np.random.default_rng(0)
+    for magatom in ms.magatoms.values():
+        magatom.setFourierComponents(rng.normal(size=(2, 3)) + 1j*rng.normal(size=(2, 3)))
+    Fm = ms.getMagneticStructureFactor(returned=True)
+    table = ms.getSatelliteTable(pairs=False)
+    assert np.array_equal(Fm.coords, table.Q)
+    assert np.allclose(Fm.values, ms.calcSatelliteIntensity(table), rtol=1e-12, atol=0.)
+
+    # one kernel call for all satellites gives the same as evaluating each satellite group on its own
+    table = ms.getSatelliteTable()
+    F = ms.calcSatelliteStructureFactor(table, perpendicular=False)
+    for n, sign, rows in table.groups:
+        expected = ms.calcMagneticStructureFactor(table.Q[rows], perpendicular=False, k=n, sign=sign)
+        assert np.allclose(F[rows], expected, rtol=1e-12, atol=1e-14)
+
+
+@pytest.mark.parametrize('moment, count', [((1, 0, 0), 6), ((1, 1, 0), 12), ((0, 0, 1), 2)])
+def test_domains_hexagonal(structures, moment, count):
+    # Ferromagnetic hcp Co: the domains are the distinct orientations of the Cartesian moment under 6/mmm
+    crystal, ms = structures('hcp.cif', 'Co', (0, 0, 0), moment)
+    assert len(ms.getDomains()) == count
+
+    # the operations merged into a domain leave the intensity unchanged
+    R, t = ms.nuclear.getSymmetryOperations()
+    Q = getSatellites((0, 0, 0))
+    I = ms.calcMagneticIntensity(Q)
+    for g in ms.getConfigurationStabilizer():
+        assert np.allclose(ms.calcMagneticIntensity(np.dot(Q, R[g])), I, rtol=1e-12, atol=1e-14)
@@ -0,0 +1,10 @@
+import numpy as np
+
+
+def test_unresolved_spacegroup(structures):
+    # A symbol pymatgen rejects and no symmetry operations in the CIF: the structure is built without absences
+    crystal, ms = structures('P21c_nosymops.cif', Qmax=2)
+    nuclear = crystal.nuclear
+    assert nuclear is not None and crystal.spacegroup == 'P 21/c'
+    assert nuclear.getAbsences(nuclear.Q) is None
+    assert np.all(np.isfinite(nuclear.calcNuclearStructureFactor(nuclear.Q)))
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from magneupy.reciprocal import makeShell
+
+DMIN = 0.8
+
+
+@pytest.mark.parametrize('cif, magname, qm, moment', [
+    ('hcp.cif', 'Co', (0, 0, 0), (1, 1, 0)),
+    ('hcp.cif', 'Co', (0, 0.3, 0), (1, 2, 3)),
+    ('MnO.cif', 'Mn', (0.5, 0.5, 0.5), (1, 2, 0)),
+])
+def test_reflection_totals(structures, cif, magname, qm, moment):
+    # The multiplicities of the unique reflections must add up to the brute-force sum over the whole shell
+    crystal, ms = structures(cif, magname, qm, moment)
+    crystal.magnetic = ms
+    reflections = crystal.getPowderReflections(DMIN)
+    totals = [np.sum((reflections.multiplicity*reflections.F2)[reflections.magnetic == magnetic])
+              for magnetic in (False, True)]
+
+    B = crystal.nuclear.lattice.B
+    Fn = crystal.nuclear.calcNuclearStructureFactor(makeShell(B, DMIN, np.inf), absences=False)
+    k = np.asanyarray(qm, dtype=float)
+    Im = ms.calcMagneticIntensity(makeShell(B, DMIN, np.inf, offset=k)).sum()
+    if not np.allclose(2.*k, np.round(2.*k)):
+        Im += ms.calcMagneticIntensity(makeShell(B, DMIN, np.inf, offset=-k)).sum()
+    assert np.isclose(totals[0], np.sum(np.abs(Fn)**2.), rtol=1e-10)
+    assert np.isclose(totals[1], Im, rtol=1e-10)
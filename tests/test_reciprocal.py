@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from magneupy.reciprocal import parseSymmetryOperation
+
+
+@pytest.mark.parametrize('xyz, R, t', [
+    ('x, y, z', np.eye(3), (0, 0, 0)),
+    ('-x+y, -x, z+1/2', ((-1, 1, 0), (-1, 0, 0), (0, 0, 1)), (0, 0, 0.5)),
+    ('1/4+y, -x+0.75, -z', ((0, 1, 0), (-1, 0, 0), (0, 0, -1)), (0.25, 0.75, 0)),
+    ('X-Y,-Y,1/3-Z', ((1, -1, 0), (0, -1, 0), (0, 0, -1)), (0, 0, 1/3)),
+])
+def test_parse_symmetry_operation(xyz, R, t):
+    Rp, tp = parseSymmetryOperation(xyz)
+    assert np.array_equal(Rp, np.asanyarray(R, dtype=float))
+    assert np.allclose(tp, t)